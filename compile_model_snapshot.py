@@ -0,0 +1,6 @@
+import pipeline.annotator as an
+import pipeline.config as config
+
+#one time step after installing or updating the MedCAT model files, writes the snapshot the annotator loads from in later runs
+annotator = an.Annotator(lazy_load=True)
+annotator.compile_model_snapshot(config.Config().medcat_config["model_snapshot_dir"])
@@ -14,7 +14,7 @@ analyzer = al.Analyzer()
 search_term = "atrial fibrillation"
 es_index_name = "ads_letters"
 batch_size = 10000
-cohort = builder.build_cohort(search_term, es_index_name, batch_size, trust_site = "UCLH")
+cohort = builder.build_cohort(search_term, es_index_name, batch_size, use_cache = True, trust_site = "UCLH")
 
 cohort = cohort.reset_index().iloc[:, 1:]
 
@@ -2,10 +2,8 @@ import pandas as pd
 import time
 from datetime import datetime
 from random import sample
-import statsmodels.api as sm
 import numpy as np
 import pipeline.config as config
-from scipy.stats import chi2_contingency, kruskal
 
 class Analyzer:
     def __init__(self):
@@ -124,6 +122,8 @@ class Analyzer:
         test_cols: list of columns names for categories testing differences across e.g. medication categories
         cat_cars: list of categorical variables to test across medication categories
         '''
+        from scipy.stats import chi2_contingency
+        
         
         for var in cat_vars:
             gr = cohort.groupby(var)
@@ -144,6 +144,8 @@ class Analyzer:
         cont_cars: list of continuous variables to test across medication categories
         '''
         
+        from scipy.stats import kruskal
+        
         tests = {}
         for col in test_cols:
             d = cohort[cohort[col] == 1]
@@ -364,6 +366,8 @@ class Analyzer:
         add_constant: boolean on whether to add constant to regression
         significance_level: set significance threshold as integer for summary table
         """
+        import statsmodels.api as sm
+        
         X = cohort[factors]
 
         if add_constant:
@@ -0,0 +1,141 @@
+import sqlite3
+import hashlib
+import pickle
+import zlib
+import json
+import time
+import os
+
+class AnnotationCache:
+    '''
+    Persistent, content addressed cache of document annotations stored in SQLite.
+    Entries are keyed by a hash of the note text and a fingerprint of the annotation model (model files and accuracy settings),
+    so unchanged notes are not re-annotated between runs until the model changes. The least recently used entries are evicted once the cache exceeds max_bytes
+    '''
+    def __init__(self, db_path, model_fingerprint, max_bytes=5 * 1024 ** 3, commit_every=1000):
+        '''
+        db_path: filepath for the SQLite database
+        model_fingerprint: string identifying the annotation model, see get_model_fingerprint
+        max_bytes: integer for the maximum total size of cached annotations in bytes
+        commit_every: number of writes between commits
+        '''
+        self.db_path = db_path
+        self.model_fingerprint = model_fingerprint
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.n_uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS annotations_last_access ON annotations (last_access)")
+        self.db.commit()
+
+    @staticmethod
+    def get_model_fingerprint(model_paths, settings):
+        '''
+        Return a fingerprint of the annotation model from the size and modification time of every model file and the model settings
+        model_paths: list of model file or directory paths (e.g. CDB, vocab and MetaCAT directory)
+        settings: dictionary of settings that change the annotations (e.g. MIN_ACC, MIN_CONCEPT_LENGTH)
+        '''
+        file_stats = []
+        for model_path in model_paths:
+            if os.path.isdir(model_path):
+                paths = [os.path.join(root, filename) for root, _, filenames in os.walk(model_path) for filename in filenames]
+            else:
+                paths = [model_path]
+
+            for path in sorted(paths):
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    file_stats.append([path, stat.st_size, stat.st_mtime])
+
+        fingerprint = json.dumps({"files": file_stats, "settings": settings}, sort_keys=True)
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def get_key(self, notetext):
+        '''
+        Return the cache key for a note text under the current model fingerprint
+        notetext: the document text
+        '''
+        return hashlib.sha256((self.model_fingerprint + notetext).encode("utf-8")).hexdigest()
+
+    def get(self, notetext):
+        '''
+        Return the cached annotations for a note text, or None on a cache miss
+        notetext: the document text
+        '''
+        key = self.get_key(notetext)
+        row = self.db.execute("SELECT value FROM annotations WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute("UPDATE annotations SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.maybe_commit()
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, notetext, annotations):
+        '''
+        Store the annotations for a note text
+        notetext: the document text
+        annotations: list of annotation dictionaries
+        '''
+        value = zlib.compress(pickle.dumps(annotations, protocol=pickle.HIGHEST_PROTOCOL))
+        self.db.execute("INSERT OR REPLACE INTO annotations (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                        (self.get_key(notetext), value, len(value), time.time()))
+        self.maybe_commit()
+
+    def maybe_commit(self):
+        '''
+        Commit once commit_every writes have accumulated
+        '''
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        '''
+        Commit pending writes and evict least recently used entries if the cache exceeds max_bytes
+        '''
+        self.db.commit()
+        self.n_uncommitted = 0
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the total cache size is within max_bytes
+        '''
+        total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM annotations").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        bytes_to_free = total_bytes - self.max_bytes
+        freed = 0
+        keys = []
+        for key, size in self.db.execute("SELECT key, size FROM annotations ORDER BY last_access"):
+            if freed >= bytes_to_free:
+                break
+            keys.append((key,))
+            freed += size
+
+        self.db.executemany("DELETE FROM annotations WHERE key = ?", keys)
+        self.db.commit()
+        print("Evicted %s cached annotations (%s MB)" % (len(keys), round(freed / 1024 ** 2, 2)))
+
+    def get_stats(self):
+        '''
+        Return the cache hit / miss statistics for this run
+        '''
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+    def close(self):
+        '''
+        Commit pending writes and close the database
+        '''
+        self.commit()
+        self.db.close()
@@ -0,0 +1,111 @@
+import json
+import os
+
+def to_json_value(x):
+    '''
+    json default handler for numpy / pandas values in annotated documents
+    x: value json cannot serialise natively
+    '''
+    if hasattr(x, "item"):
+        return x.item()
+    return str(x)
+
+class AnnotationCheckpoint:
+    '''
+    Periodically flushes annotated documents to append-only jsonl shards in checkpoint_dir, tracked by a manifest,
+    so a long annotation run can resume after a crash without re-annotating completed documents
+    '''
+    def __init__(self, checkpoint_dir, flush_every=1000):
+        '''
+        checkpoint_dir: directory for the shards and manifest.json
+        flush_every: number of annotated documents buffered in memory before a shard is written
+        '''
+        self.checkpoint_dir = checkpoint_dir
+        self.flush_every = flush_every
+        self.manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        self.buffer = []
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        '''
+        Return the manifest of written shards, or an empty manifest if none has been written
+        '''
+        if not os.path.exists(self.manifest_path):
+            return {"shards": [], "n_docs": 0}
+
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def reset(self):
+        '''
+        Remove all shards and the manifest and start a new checkpoint
+        '''
+        for filename in os.listdir(self.checkpoint_dir):
+            if filename.startswith("shard_") or filename.startswith("manifest.json"):
+                os.remove(os.path.join(self.checkpoint_dir, filename))
+        self.manifest = {"shards": [], "n_docs": 0}
+        self.buffer = []
+
+    def append(self, doc_entry):
+        '''
+        Add an annotated document, writing a shard once flush_every documents are buffered
+        doc_entry: annotated document dictionary -> {"pat_metadata":[], "doc_metadata":[], "annotations":[]}
+        '''
+        self.buffer.append(doc_entry)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered documents to a new shard and record it in the manifest. The shard is written before the manifest so a crash never leaves a listed partial shard
+        '''
+        if len(self.buffer) == 0:
+            return
+
+        shard_name = "shard_%05d.jsonl" % len(self.manifest["shards"])
+        shard_path = os.path.join(self.checkpoint_dir, shard_name)
+        with open(shard_path + ".tmp", "w") as f:
+            for doc_entry in self.buffer:
+                f.write(json.dumps(doc_entry, default=to_json_value) + "\n")
+        os.replace(shard_path + ".tmp", shard_path)
+
+        self.manifest["shards"].append({"name": shard_name, "n_docs": len(self.buffer)})
+        self.manifest["n_docs"] += len(self.buffer)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+        self.buffer = []
+
+    def get_completed_note_ids(self):
+        '''
+        Return the set of note ids already written to shards
+        '''
+        return set([doc_entry["doc_metadata"]["note_id"] for doc_entry in ShardedAnnotatedCohort(self.checkpoint_dir)])
+
+class ShardedAnnotatedCohort:
+    '''
+    Lazily loaded annotated cohort backed by the shards of an AnnotationCheckpoint.
+    Can be iterated repeatedly (e.g. once per risk score) without holding the whole cohort in memory
+    '''
+    def __init__(self, checkpoint_dir):
+        '''
+        checkpoint_dir: directory with the shards and manifest.json written by AnnotationCheckpoint
+        '''
+        self.checkpoint_dir = checkpoint_dir
+        manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        self.manifest = {"shards": [], "n_docs": 0}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def __len__(self):
+        return self.manifest["n_docs"]
+
+    def __iter__(self):
+        for shard in self.manifest["shards"]:
+            with open(os.path.join(self.checkpoint_dir, shard["name"])) as f:
+                for line in f:
+                    yield json.loads(line)
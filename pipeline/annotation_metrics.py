@@ -0,0 +1,166 @@
+import pandas as pd
+import numpy as np
+import heapq
+import json
+import time
+import os
+
+class AnnotationMetrics:
+    '''
+    Collects per document annotation telemetry: latency histograms bucketed by document length, entities per document, documents/sec,
+    MB/sec of note text and peak memory per worker, and keeps the slowest documents for a top N report.
+    Metrics are written as a JSON file and a Prometheus textfile (for the node exporter textfile collector)
+    '''
+    #upper bounds of the document length buckets in characters
+    LENGTH_BUCKETS = [1000, 2000, 5000, 10000, 20000, 50000, np.inf]
+    #upper bounds of the latency histogram buckets in seconds
+    LATENCY_BUCKETS_S = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, np.inf]
+    #upper bounds of the entities per document histogram buckets
+    ENTITY_BUCKETS = [0, 5, 10, 25, 50, 100, 250, np.inf]
+
+    def __init__(self, top_n=50):
+        '''
+        top_n: number of slowest documents kept for the slow note report
+        '''
+        self.top_n = top_n
+        self.start_time = time.time()
+        self.end_time = None
+
+        self.n_docs = 0
+        self.n_cached_docs = 0
+        self.n_chars = 0
+        self.latency_counts = np.zeros((len(self.LENGTH_BUCKETS), len(self.LATENCY_BUCKETS_S)), dtype=np.int64)
+        self.latency_sums = np.zeros(len(self.LENGTH_BUCKETS))
+        self.entity_counts = np.zeros(len(self.ENTITY_BUCKETS), dtype=np.int64)
+        self.n_entities = 0
+        self.worker_rss_bytes = {}
+        #min heap of (latency_s, note_id, n_chars) for the slowest documents
+        self.slowest = []
+
+    def record_doc(self, note_id, n_chars, latency_s, n_entities):
+        '''
+        Record an annotated document
+        note_id: clinicalnotekey of the document
+        n_chars: length of the note text
+        latency_s: seconds spent annotating the document (summed over chunks), or None if the annotations came from the cache
+        n_entities: number of entities annotated in the document
+        '''
+        self.n_docs += 1
+        self.n_chars += n_chars
+        self.n_entities += n_entities
+        self.entity_counts[np.searchsorted(self.ENTITY_BUCKETS, n_entities)] += 1
+
+        if latency_s is None:
+            self.n_cached_docs += 1
+            return
+
+        length_bucket = np.searchsorted(self.LENGTH_BUCKETS, n_chars)
+        self.latency_counts[length_bucket, np.searchsorted(self.LATENCY_BUCKETS_S, latency_s)] += 1
+        self.latency_sums[length_bucket] += latency_s
+
+        entry = (latency_s, str(note_id), n_chars)
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def record_worker_rss(self, pid, rss_bytes):
+        '''
+        Record the resident memory of an annotation worker, keeping the peak per worker
+        pid: worker process id
+        rss_bytes: resident memory of the worker in bytes
+        '''
+        self.worker_rss_bytes[pid] = max(rss_bytes, self.worker_rss_bytes.get(pid, 0))
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def format_bound(self, bound):
+        return "+Inf" if np.isinf(bound) else str(bound)
+
+    def get_slowest(self):
+        '''
+        Return the slowest documents as a pandas dataframe sorted from slowest
+        '''
+        slowest = sorted(self.slowest, reverse=True)
+        return pd.DataFrame([{"clinicalnotekey": note_id, "latency_s": round(latency_s, 4), "n_chars": n_chars} for latency_s, note_id, n_chars in slowest], columns=["clinicalnotekey", "latency_s", "n_chars"])
+
+    def to_dict(self):
+        '''
+        Return the metrics as a dictionary
+        '''
+        elapsed = max((self.end_time or time.time()) - self.start_time, 1e-6)
+
+        latency_by_length = {}
+        for i, length_bound in enumerate(self.LENGTH_BUCKETS):
+            count = int(self.latency_counts[i].sum())
+            latency_by_length["le_" + self.format_bound(length_bound)] = {
+                "count": count,
+                "mean_latency_s": round(self.latency_sums[i] / count, 4) if count > 0 else None,
+                "histogram": {self.format_bound(bound): int(n) for bound, n in zip(self.LATENCY_BUCKETS_S, self.latency_counts[i])}}
+
+        return {"elapsed_s": round(elapsed, 2),
+                "n_docs": self.n_docs,
+                "n_cached_docs": self.n_cached_docs,
+                "docs_per_sec": round(self.n_docs / elapsed, 2),
+                "mb_per_sec": round(self.n_chars / 1024 ** 2 / elapsed, 4),
+                "entities_per_doc": round(self.n_entities / self.n_docs, 2) if self.n_docs > 0 else None,
+                "entities_histogram": {self.format_bound(bound): int(n) for bound, n in zip(self.ENTITY_BUCKETS, self.entity_counts)},
+                "latency_by_length": latency_by_length,
+                "worker_peak_rss_mb": {str(pid): round(rss / 1024 ** 2, 2) for pid, rss in self.worker_rss_bytes.items()},
+                "slowest_docs": self.get_slowest().to_dict("records")}
+
+    def write_json(self, filepath):
+        '''
+        Write the metrics to a JSON file
+        filepath: path of the JSON file
+        '''
+        with open(filepath, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, filepath):
+        '''
+        Write the metrics in the Prometheus text exposition format, written to a temporary file and renamed so the textfile collector never reads a partial file
+        filepath: path of the .prom file
+        '''
+        metrics = self.to_dict()
+        lines = ["# HELP annotation_doc_latency_seconds Seconds to annotate a document by document length in characters",
+                 "# TYPE annotation_doc_latency_seconds histogram"]
+        for i, length_bound in enumerate(self.LENGTH_BUCKETS):
+            length_label = self.format_bound(length_bound)
+            cumulative = np.cumsum(self.latency_counts[i])
+            for bound, n in zip(self.LATENCY_BUCKETS_S, cumulative):
+                lines.append('annotation_doc_latency_seconds_bucket{doc_chars_le="%s",le="%s"} %s' % (length_label, self.format_bound(bound), n))
+            lines.append('annotation_doc_latency_seconds_sum{doc_chars_le="%s"} %s' % (length_label, self.latency_sums[i]))
+            lines.append('annotation_doc_latency_seconds_count{doc_chars_le="%s"} %s' % (length_label, cumulative[-1]))
+
+        lines.append("# HELP annotation_doc_entities Entities annotated per document")
+        lines.append("# TYPE annotation_doc_entities histogram")
+        for bound, n in zip(self.ENTITY_BUCKETS, np.cumsum(self.entity_counts)):
+            lines.append('annotation_doc_entities_bucket{le="%s"} %s' % (self.format_bound(bound), n))
+        lines.append("annotation_doc_entities_sum %s" % self.n_entities)
+        lines.append("annotation_doc_entities_count %s" % self.n_docs)
+
+        for name, help_text, value in [("annotation_docs_total", "Documents annotated", self.n_docs),
+                                       ("annotation_cached_docs_total", "Documents served from the annotation cache", self.n_cached_docs),
+                                       ("annotation_docs_per_second", "Documents annotated per second", metrics["docs_per_sec"]),
+                                       ("annotation_megabytes_per_second", "MB of note text annotated per second", metrics["mb_per_sec"])]:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+
+        lines.append("# HELP annotation_worker_peak_rss_bytes Peak resident memory of each annotation worker")
+        lines.append("# TYPE annotation_worker_peak_rss_bytes gauge")
+        for pid, rss in self.worker_rss_bytes.items():
+            lines.append('annotation_worker_peak_rss_bytes{pid="%s"} %s' % (pid, rss))
+
+        with open(filepath + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(filepath + ".tmp", filepath)
+
+    def write_slowest_report(self, filepath):
+        '''
+        Write the top N slowest documents by clinicalnotekey to a csv
+        filepath: path of the csv file
+        '''
+        self.get_slowest().to_csv(filepath, index=False)
@@ -1,116 +1,271 @@
 import pandas as pd
-import numpy as np
 import os
 import time
 from datetime import datetime
 import logging
 import psutil
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pipeline.config as config
+from pipeline.annotation_cache import AnnotationCache
+from pipeline.annotation_checkpoint import AnnotationCheckpoint, ShardedAnnotatedCohort
+from pipeline.compact_annotations import CompactAnnotations
+from pipeline.text_chunker import TextChunker
+from pipeline.model_snapshot import ModelSnapshot
+from pipeline.demographics import DemographicsProvider
+from pipeline.resource_governor import ResourceGovernor
+from pipeline.annotation_metrics import AnnotationMetrics
+from pipeline.quarantine import AnnotationQuarantine, call_with_timeout, call_without_timeout
+from pipeline.dictionary_annotator import DictionaryAnnotator
+from pipeline.paragraph_cache import ParagraphCache, split_paragraphs
 
 log = logging.getLogger(__name__)
 
-from medcat.cat import CAT
-from medcat.utils.vocab import Vocab
-from medcat.cdb import CDB
-from tokenizers import ByteLevelBPETokenizer
-from medcat.meta_cat import MetaCAT
+#NOTE - medcat (and with it spacy, tokenizers and torch) is imported in load_medcat, and the spacy DocBin cache in get_doc_cache, so stages that do not annotate do not pay for the import
+
+#annotator loaded once in each process pool worker by init_annotation_worker
+worker_annotator = None
+
+def init_annotation_worker(annotation_mode, threads_per_worker):
+    '''
+    Process pool initializer, pins intra-op thread counts so workers do not oversubscribe the machine and loads the annotation model once per worker
+    annotation_mode: annotation mode passed to Annotator
+    threads_per_worker: number of torch / OpenMP threads each worker may use
+    '''
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[var] = str(threads_per_worker)
+    
+    try:
+        import torch
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass
+    
+    global worker_annotator
+    worker_annotator = Annotator(annotation_mode, lazy_load=False)
+
+def annotate_batch(batch):
+    '''
+    Annotate a batch of documents in a process pool worker and return their annotations and annotation latencies in input order, with the worker's pid and resident memory
+    batch: list of documents as dictionaries with clinicalnotekey and notetext
+    '''
+    results = [worker_annotator.annotate_doc_timed(doc) for doc in batch]
+    #workers are not shut down cleanly enough to flush at exit, so the tokenised docs of each batch are written as they complete
+    worker_annotator.flush_doc_cache()
+    return {"pid": os.getpid(), "rss_bytes": psutil.Process().memory_info().rss, "results": results,
+            "paragraph_stats": worker_annotator.get_paragraph_stats(), "doc_cache_stats": worker_annotator.get_doc_cache_stats()}
 
 class Annotator:
-    def __init__(self, annotation_mode="MedCAT"):
+    def __init__(self, annotation_mode="MedCAT", lazy_load=None):
+        '''
+        annotation_mode: annotation backend, "MedCAT", "MedCATCodelist" (MedCAT with MetaCAT negation only run on entities whose cui is in a codelist)
+                         or "Dictionary" (codelist term matching with NegEx style negation, no MedCAT models needed)
+        lazy_load: optional boolean on whether to defer loading the annotation model until the first document is annotated, defaults to medcat_config["lazy_load_model"]
+        '''
         self.annotation_mode = annotation_mode
         print("Initializing " + self.annotation_mode + " as the annotator...")
         
-        self.annotation_model = ""
+        self.annotation_model = None
+        self.load_times = {}
+        
+        #for the MedCATCodelist mode, MetaCAT models applied after NER and the union of codelist cuis they are applied to
+        self.meta_cats = []
+        self.codelist_cuis = set()
         
+        #ResourceGovernor adapting batch sizes and AnnotationMetrics collecting telemetry during annotate_cohort, None outside of it
+        self.governor = None
+        self.metrics = None
+        #seconds spent annotating each document (summed over its chunks) and failure reasons by clinicalnotekey, popped as annotate_cohort consumes the document
+        self.latencies = {}
+        self.errors = {}
+        self.last_error = None
+        
+        #in paragraph reuse mode, annotations of paragraphs already seen in this run are reused, each worker keeps its own cache and reports its counts with each batch
+        self.paragraph_cache = None
+        if config.Config().medcat_config["paragraph_reuse"]:
+            self.paragraph_cache = ParagraphCache(config.Config().medcat_config["paragraph_cache_size"])
+        self.worker_paragraph_stats = {}
+        
+        #when medcat_config["docbin_cache_dir"] is set, tokenised and tagged spacy docs are cached on disk so later runs only redo concept linking and MetaCAT.
+        #the cache and the split of the spacy pipeline into cached and remaining pipes are set up on first use by get_doc_cache
+        self.doc_cache = None
+        self.doc_cache_unavailable = False
+        self.cached_pipes = None
+        self.remaining_pipes = None
+        self.worker_doc_cache_stats = {}
+        
+        #documents taking longer than timeout_s to annotate are abandoned and quarantined
+        self.timeout_s = config.Config().medcat_config["doc_timeout_s"]
+        
+        #long notes are annotated in chunks, counts are reported at the end of annotate_cohort
+        self.chunker = TextChunker(config.Config().medcat_config["max_chunk_chars"], config.Config().medcat_config["chunk_overlap_chars"])
+        self.n_chunked_docs = 0
+        self.n_chunks = 0
+        
+        if lazy_load is None:
+            lazy_load = config.Config().medcat_config["lazy_load_model"]
+        
+        if not lazy_load:
+            self.load_annotation_model()
+    
+    def load_annotation_model(self):
+        '''
+        Load the annotation model for the annotation mode and return it
+        '''
         if self.annotation_mode == "MedCAT":
-            start = time.time()
-            print("Start loading MedCAT at: ", datetime.fromtimestamp(start))
-            
-            cdb_path = config.Config().medcat_config["cdb_path"]
-            vocab_path = config.Config().medcat_config["vocab_path"]
-            meta_path = config.Config().medcat_config["meta_path"]
-            
-            #NOTE - this api does not work with MedCAT v1
-            cdb = CDB()
-            cdb.load_dict(cdb_path)
-            vocab = Vocab()
-            vocab.load_dict(path=vocab_path)
-            meta_neg = MetaCAT(save_dir=meta_path)
-            meta_neg.load()
-            
-            self.annotation_model = CAT(cdb=cdb, vocab=vocab, meta_cats=[meta_neg])
-            self.annotation_model.train = False 
-            
-            #NOTE - consider moving accuracy settings to config
-            self.annotation_model.spacy_cat.MIN_ACC = 0.3
-            self.annotation_model.spacy_cat.MIN_ACC_TH = 0.3
-            self.annotation_model.spacy_cat.MIN_CONCEPT_LENGTH = 2
-            
-            end = time.time()
-            print("Finish loading MedCAT at: ", datetime.fromtimestamp(end))
-            print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
+            self.annotation_model = self.load_medcat()
+        elif self.annotation_mode == "MedCATCodelist":
+            self.annotation_model = self.load_medcat(meta_on_codelist_only=True)
+        elif self.annotation_mode == "Dictionary":
+            self.annotation_model = self.load_dictionary()
+        
+        return self.annotation_model
     
-    def add_female_flag(self, x):
+    def get_codelist_paths(self):
         '''
-        Row wise operation to convert "Female" string entry to binary flag
-        x: row entry for gender assumes "Female" or "Male" string
+        Return the filepaths of the configured codelists
         '''
-        if x == "Female":
-            return 1
-        else:
-            return 0
+        codelists_config = config.Config().codelists_config
+        return [codelists_config["chadsvasc_path"], codelists_config["hasbled_path"], codelists_config["meds_path"]]
+    
+    def load_dictionary(self):
+        '''
+        Build the dictionary annotator from the codelist terms and return it
+        '''
+        stage_start = time.time()
+        dictionary_config = config.Config().dictionary_config
+        annotation_model = DictionaryAnnotator(self.get_codelist_paths(), dictionary_config["negation_window_words"], dictionary_config["min_term_length"])
+        self.record_load_time("dictionary", stage_start)
         
-    #NOTE - This function can be refactored if have ethics to include patient metadata in CogStack. At Trust where pipeline was developed this data had to be loaded in separately.
-    def add_demographic_data(self, cohort, metadata_csv_file):
+        return annotation_model
+    
+    def get_annotation_model(self):
         '''
-        Given a cohort (pre-annotation) and a csv with date of birth and gender for a list of patient mrns, map date of birth and gender data to patient mrns in cohort and return updated cohort. 
-        Function also applies a series of demographic filters (removes Na's from date of birth and gender, removes legacy dates out of time range, removes individuals with age >= 18 years old)
-        cohort: pandas dataframe of cohort extracted from CogStack
-        metadata_csv_file: filepath with fields primary_mrn, date_of_birth and gender
+        Return the annotation model, loading it on first use
+        '''
+        if self.annotation_model is None:
+            self.load_annotation_model()
+        
+        return self.annotation_model
+    
+    def record_load_time(self, stage, stage_start):
+        '''
+        Record and print the time taken by a model loading stage
+        stage: name of the loading stage
+        stage_start: time the stage started
+        '''
+        self.load_times[stage] = round(time.time() - stage_start, 2)
+        print("Loaded", stage, "in", self.load_times[stage], "seconds")
+    
+    def get_source_fingerprint(self):
+        '''
+        Return a fingerprint of the CDB and vocab files, used to check a model snapshot is up to date
+        '''
+        medcat_config = config.Config().medcat_config
+        return AnnotationCache.get_model_fingerprint([medcat_config["cdb_path"], medcat_config["vocab_path"]], {})
+    
+    def load_medcat_sources(self):
+        '''
+        Load the MedCAT CDB and vocab from the model files and return them
+        '''
+        from medcat.utils.vocab import Vocab
+        from medcat.cdb import CDB
+        
+        medcat_config = config.Config().medcat_config
+        
+        #NOTE - this api does not work with MedCAT v1
+        stage_start = time.time()
+        cdb = CDB()
+        cdb.load_dict(medcat_config["cdb_path"])
+        self.record_load_time("cdb", stage_start)
+        
+        stage_start = time.time()
+        vocab = Vocab()
+        vocab.load_dict(path=medcat_config["vocab_path"])
+        self.record_load_time("vocab", stage_start)
+        
+        return cdb, vocab
+    
+    def compile_model_snapshot(self, snapshot_dir=None):
+        '''
+        One time compile step, loads the CDB and vocab from the model files and writes a memory mappable snapshot that later runs load from instead
+        snapshot_dir: optional directory for the snapshot, defaults to medcat_config["model_snapshot_dir"]
         '''
-        metadata = pd.read_csv(metadata_csv_file)
-        print("Cohort size prior to joining age and gender metadata", len(cohort))
+        if snapshot_dir is None:
+            snapshot_dir = config.Config().medcat_config["model_snapshot_dir"]
         
-        metadata["patientprimarymrn"] = metadata["primary_mrn"]
+        cdb, vocab = self.load_medcat_sources()
+        ModelSnapshot(snapshot_dir).write({"cdb": cdb, "vocab": vocab}, self.get_source_fingerprint())
+    
+    def load_medcat(self, meta_on_codelist_only=False):
+        '''
+        Load MedCAT, using the CDB and vocab from the model snapshot when it is up to date with the model files, and return the CAT annotation model
+        meta_on_codelist_only: boolean on whether to build CAT for NER only and keep MetaCAT aside in meta_cats, to be run by get_codelist_entities on codelist entities only
+        '''
+        start = time.time()
+        print("Start loading MedCAT at: ", datetime.fromtimestamp(start))
         
-        cohort = pd.merge(cohort, metadata, on="patientprimarymrn", how="left")
-        print("Cohort size post joining age and gender metadata", len(cohort))
+        medcat_config = config.Config().medcat_config
         
-        #filter out Na's from dob and gender
-        print("Cohort size prior to removing dob and gender na's", len(cohort))
-        cohort = cohort[cohort['gender'].notna()]
-        cohort = cohort[cohort['date_of_birth'].notna()]
-        print("Cohort size post removing dob and gender na's", len(cohort))
+        stage_start = time.time()
+        from medcat.cat import CAT
+        from medcat.meta_cat import MetaCAT
+        self.record_load_time("medcat imports", stage_start)
         
-        #add binary flag for female
-        cohort["female"] = cohort["gender"].apply(self.add_female_flag)
+        snapshot = None
+        if medcat_config["model_snapshot_dir"] is not None:
+            snapshot = ModelSnapshot(medcat_config["model_snapshot_dir"])
         
-        #add age from date of birth
-        today = pd.to_datetime("today")
-        cohort['date_of_birth_dt'] = pd.to_datetime(cohort['date_of_birth'])
-        cohort["age"] = (today - cohort['date_of_birth_dt']) / np.timedelta64(1, 'Y')
+        if snapshot is not None and snapshot.is_fresh(self.get_source_fingerprint()):
+            stage_start = time.time()
+            objects = snapshot.load()
+            cdb = objects["cdb"]
+            vocab = objects["vocab"]
+            self.record_load_time("cdb and vocab snapshot", stage_start)
+        else:
+            if snapshot is not None:
+                print("Model snapshot missing or out of date, loading model files. Run compile_model_snapshot to speed up later runs")
+            cdb, vocab = self.load_medcat_sources()
         
-        #check and remove any encounter dates outside of time range (01/01/2011 - 01/01/2019)
-        cohort["encounterdate_dt"] = pd.to_datetime(cohort["encounterdate"])
-        print("# dates < 01/01/2011", len(cohort[cohort["encounterdate_dt"] < pd.to_datetime('01/01/2011')]))
-        print("# dates > 01/01/2019", len(cohort[cohort["encounterdate_dt"] > pd.to_datetime('01/01/2019')]))
-        print("Cohort size prior to removing dates outside of time range", len(cohort))
-        cohort = cohort[cohort["encounterdate_dt"] < pd.to_datetime('01/01/2019')]
-        cohort = cohort[cohort["encounterdate_dt"] >= pd.to_datetime('01/01/2011')]
-        print("Cohort size post removing dates outside of time range", len(cohort))
+        stage_start = time.time()
+        meta_neg = MetaCAT(save_dir=medcat_config["meta_path"])
+        meta_neg.load()
+        self.record_load_time("meta_cat", stage_start)
         
+        stage_start = time.time()
+        if meta_on_codelist_only:
+            self.meta_cats = [meta_neg]
+            self.codelist_cuis = self.get_codelist_cuis()
+            annotation_model = CAT(cdb=cdb, vocab=vocab, meta_cats=[])
+        else:
+            annotation_model = CAT(cdb=cdb, vocab=vocab, meta_cats=[meta_neg])
+        annotation_model.train = False 
         
-        #remove individuals with age >= 18 years old
-        print("Cohort size prior to removing age >=18 years old", len(cohort))
-        cohort = cohort[cohort["age"] >= 18]
-        print("Cohort size post removing age >=18 years old", len(cohort))
+        annotation_model.spacy_cat.MIN_ACC = medcat_config["min_acc"]
+        annotation_model.spacy_cat.MIN_ACC_TH = medcat_config["min_acc_th"]
+        annotation_model.spacy_cat.MIN_CONCEPT_LENGTH = medcat_config["min_concept_length"]
+        self.record_load_time("cat pipeline", stage_start)
         
-        #reset index
-        cohort = cohort.reset_index().iloc[:, 1:]
+        end = time.time()
+        print("Finish loading MedCAT at: ", datetime.fromtimestamp(end))
+        print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
+        print("MedCAT load times (seconds):", self.load_times)
         
-        print("Cohort size for annotation", len(cohort))
+        return annotation_model
+    
+    #NOTE - This function can be refactored if have ethics to include patient metadata in CogStack. At Trust where pipeline was developed this data had to be loaded in separately.
+    def add_demographic_data(self, cohort, metadata_csv_file):
+        '''
+        Given a cohort (pre-annotation) and a csv with date of birth and gender for a list of patient mrns, map date of birth and gender data to patient mrns in cohort and return updated cohort. 
+        Function also applies a series of demographic filters (removes Na's from date of birth and gender, removes legacy dates out of time range, removes individuals with age < 18 years old)
+        cohort: pandas dataframe of cohort extracted from CogStack
+        metadata_csv_file: filepath with fields primary_mrn, date_of_birth and gender
+        '''
+        es_config = config.Config().es_config
+        provider = DemographicsProvider(metadata_csv_file, es_config["demographics_lookup_path"], es_config["demographics_chunk_size"])
         
-        return cohort
+        return provider.add_demographics(cohort)
         
     def add_pat_metadata(self, doc):
         '''
@@ -137,55 +292,820 @@ class Annotator:
     
     def add_annotations(self, doc):
         '''
-        Apply annotations to document using loaded annotation model and return an array of annotations
+        Apply annotations to document using loaded annotation model under the per document timeout and return an array of annotations,
+        or None if the annotation model fails or times out on the document (the reason is kept in last_error)
         doc: document in string format from target cohort, assumes column label "notetext" for input cohort dataframe
         '''
+        #a lazily loaded model (and the DocBin cache) is loaded before the timeout starts, so a slow model load is not counted against (and does not quarantine) the first document
+        self.get_annotation_model()
+        self.get_doc_cache()
+        
+        self.last_error = None
         try: 
-            annotations = self.annotation_model.get_entities(doc["notetext"])
+            annotations = call_with_timeout(self.annotate_doc_text, self.timeout_s, doc)
         except Exception as e: 
             print(e)
             print('failed on ', doc["clinicalnotekey"])
             log.error('failed on ' + str(doc["clinicalnotekey"]))
+            self.last_error = type(e).__name__ + ": " + str(e)
+            return None
+        
+        return annotations
+    
+    def annotate_doc_text(self, doc):
+        '''
+        Annotate the note text of a document, paragraph by paragraph in paragraph reuse mode, and return an array of annotations
+        doc: document as a dictionary with clinicalnotekey and notetext
+        '''
+        if self.paragraph_cache is not None:
+            return self.annotate_paragraphs(doc)
+        
+        return self.annotate_text_chunked(doc["notetext"], doc)
+    
+    def annotate_text_chunked(self, text, doc):
+        '''
+        Annotate a text, in chunks if it is longer than the chunk size, and return an array of annotations
+        text: the text to annotate
+        doc: document the text belongs to, as a dictionary with clinicalnotekey and notetext
+        '''
+        if self.chunker.needs_chunking(text):
+            chunks = self.chunker.split(text)
+            self.record_chunks(doc, len(chunks))
+            return self.chunker.merge([(offset, self.annotate_text(chunk)) for offset, chunk in chunks])
+        
+        return self.annotate_text(text)
+    
+    def annotate_paragraphs(self, doc):
+        '''
+        Annotate a document paragraph by paragraph, reusing the cached annotations of paragraphs seen before and only running the model on novel paragraphs,
+        and return an array of annotations in document coordinates. Paragraphs are annotated without the surrounding text, so entities near paragraph edges can
+        be disambiguated slightly differently from annotating the whole note
+        doc: document as a dictionary with clinicalnotekey and notetext
+        '''
+        paragraph_annotations = []
+        for offset, paragraph in split_paragraphs(doc["notetext"]):
+            annotations = self.paragraph_cache.get(paragraph)
+            if annotations is None:
+                annotations = self.annotate_text_chunked(paragraph, doc)
+                self.paragraph_cache.put(paragraph, annotations)
+            paragraph_annotations.append((offset, annotations))
+        
+        #merge copies the cached annotations before shifting them into document coordinates
+        return self.chunker.merge(paragraph_annotations)
+    
+    def get_paragraph_stats(self):
+        '''
+        Return the paragraph reuse counts of this annotator, None outside paragraph reuse mode
+        '''
+        if self.paragraph_cache is None:
+            return None
+        
+        return self.paragraph_cache.get_stats()
+    
+    def report_paragraph_reuse(self):
+        '''
+        Print the paragraph reuse rate of the run, summed over this process and the annotation workers
+        '''
+        all_stats = [stats for stats in self.worker_paragraph_stats.values() if stats is not None]
+        if self.paragraph_cache is not None:
+            all_stats.append(self.paragraph_cache.get_stats())
+        if len(all_stats) == 0:
+            return
+        
+        stats = {key: sum([worker_stats[key] for worker_stats in all_stats]) for key in all_stats[0]}
+        stats.update(ParagraphCache.get_reuse_rates(stats))
+        print("Paragraph reuse:", stats)
+    
+    def annotate_text(self, text):
+        '''
+        Apply the loaded annotation model to a text and return an array of annotations
+        text: the text to annotate
+        '''
+        if self.annotation_mode == "MedCATCodelist":
+            return self.get_codelist_entities(text)
+        
+        if self.annotation_mode == "MedCAT" and self.get_doc_cache() is not None:
+            doc = self.run_medcat(text)
+            if doc is None:
+                return []
+            return self.doc_to_entities(doc, set([(ent.start_char, ent.end_char) for ent in doc.ents]))
+        
+        return self.get_annotation_model().get_entities(text)
+    
+    def get_doc_cache(self):
+        '''
+        Return the DocBin cache of tokenised docs, creating it on first use, or None if medcat_config["docbin_cache_dir"] is not set or the annotation mode does not use MedCAT.
+        The spacy pipeline is split before medcat_config["docbin_resume_pipe"], the pipes before it must not depend on the CDB or the MedCAT thresholds
+        '''
+        if self.doc_cache is not None:
+            return self.doc_cache
+        
+        medcat_config = config.Config().medcat_config
+        if medcat_config["docbin_cache_dir"] is None or self.doc_cache_unavailable or self.annotation_mode not in ["MedCAT", "MedCATCodelist"]:
+            return None
+        
+        nlp = self.get_annotation_model().nlp.nlp
+        pipe_names = [name for name, proc in nlp.pipeline]
+        if medcat_config["docbin_resume_pipe"] not in pipe_names:
+            print("Pipe", medcat_config["docbin_resume_pipe"], "not in the spacy pipeline", pipe_names, "- not caching tokenised docs")
+            self.doc_cache_unavailable = True
+            return None
+        
+        from pipeline.docbin_cache import DocBinCache
+        
+        split = pipe_names.index(medcat_config["docbin_resume_pipe"])
+        self.cached_pipes = nlp.pipeline[:split]
+        self.remaining_pipes = nlp.pipeline[split:]
+        self.doc_cache = DocBinCache(medcat_config["docbin_cache_dir"], nlp.vocab, DocBinCache.get_pipeline_fingerprint(nlp, pipe_names[:split]), medcat_config["docbin_shard_size"])
+        
+        return self.doc_cache
+    
+    def run_medcat(self, text):
+        '''
+        Run the MedCAT spacy pipeline on a text and return the annotated doc. With the DocBin cache the tokenised doc is read from the cache, or tokenised and added to it,
+        and only the remaining pipes (concept linking and MetaCAT) are run
+        text: the text to annotate
+        '''
+        doc_cache = self.get_doc_cache()
+        if doc_cache is None:
+            return self.get_annotation_model()(text)
+        
+        #cache reads and writes run with the timeout deferred so an AnnotationTimeout cannot leave the cache's shard and index out of step
+        doc = call_without_timeout(doc_cache.get, text)
+        if doc is None:
+            doc = self.get_annotation_model().nlp.nlp.make_doc(text)
+            for name, proc in self.cached_pipes:
+                doc = proc(doc)
+            call_without_timeout(doc_cache.put, text, doc)
+        
+        for name, proc in self.remaining_pipes:
+            doc = proc(doc)
+        
+        return doc
+    
+    def flush_doc_cache(self):
+        '''
+        Write the tokenised docs added to the DocBin cache since the last flush
+        '''
+        if self.doc_cache is not None:
+            self.doc_cache.flush()
+    
+    def get_doc_cache_stats(self):
+        '''
+        Return the DocBin cache hit counts of this annotator, None if the cache is not in use
+        '''
+        if self.doc_cache is None:
+            return None
+        
+        return self.doc_cache.get_stats()
+    
+    def report_doc_cache(self):
+        '''
+        Print the DocBin cache hit rate of the run, summed over this process and the annotation workers
+        '''
+        all_stats = [stats for stats in self.worker_doc_cache_stats.values() if stats is not None]
+        if self.doc_cache is not None:
+            all_stats.append(self.doc_cache.get_stats())
+        if len(all_stats) == 0:
+            return
+        
+        hits = sum([stats["hits"] for stats in all_stats])
+        misses = sum([stats["misses"] for stats in all_stats])
+        print("Tokenised doc cache: %s hits, %s misses (%s hit rate)" % (hits, misses, round(hits / max(hits + misses, 1), 4)))
+    
+    def get_codelist_cuis(self):
+        '''
+        Return the union of cuis in the configured codelists
+        '''
+        return set(pd.concat([pd.read_csv(path, usecols=["cui"]) for path in self.get_codelist_paths()])["cui"].dropna())
+    
+    def get_codelist_entities(self, text):
+        '''
+        Run MedCAT NER on a text, then run MetaCAT in one batch over only the entities whose cui is in a codelist, and return all entities as an array of annotations.
+        Entities outside the codelists have no meta annotations, RiskScorer never reads them
+        text: the text to annotate
+        '''
+        doc = self.run_medcat(text)
+        if doc is None:
+            return []
+        
+        entities = list(doc.ents)
+        codelist_entities = [ent for ent in entities if ent._.cui in self.codelist_cuis]
+        
+        if len(codelist_entities) > 0:
+            #MetaCAT classifies every entity in doc.ents, so restrict them to the codelist entities for the MetaCAT pass.
+            #span extension values are stored on the doc by character offsets so the meta annotations are kept when all entities are restored
+            doc.ents = codelist_entities
+            for meta_cat in self.meta_cats:
+                doc = meta_cat(doc)
+            doc.ents = entities
+        
+        log.debug("MetaCAT run on " + str(len(codelist_entities)) + " of " + str(len(entities)) + " entities")
+        
+        return self.doc_to_entities(doc, set([(ent.start_char, ent.end_char) for ent in codelist_entities]))
+    
+    def doc_to_entities(self, doc, meta_spans):
+        '''
+        Convert the entities of a MedCAT annotated spacy doc to an array of annotations in the get_entities structure
+        doc: spacy doc annotated by CAT
+        meta_spans: set of (start, end) character offsets of the entities MetaCAT was run on
+        '''
+        cdb = self.get_annotation_model().cdb
+        
+        annotations = []
+        for ent in doc.ents:
+            cui = ent._.cui
+            annotation = {"cui": cui,
+                          "source_value": ent.text,
+                          "start": ent.start_char,
+                          "end": ent.end_char,
+                          "pretty_name": cdb.cui2pretty_name.get(cui, ""),
+                          "tui": cdb.cui2tui.get(cui, ""),
+                          "acc": getattr(ent._, "acc", None),
+                          "id": len(annotations),
+                          "meta_anns": {}}
+            if (ent.start_char, ent.end_char) in meta_spans:
+                annotation["meta_anns"] = getattr(ent._, "meta_anns", None) or {}
+            annotations.append(annotation)
         
         return annotations
     
+    def annotate_doc_timed(self, doc):
+        '''
+        Annotate a document with add_annotations and return the annotations, the seconds taken and the failure reason (None on success)
+        doc: document as a dictionary with clinicalnotekey and notetext
+        '''
+        #model load time is kept out of the document's latency
+        self.get_annotation_model()
+        
+        start = time.time()
+        annotations = self.add_annotations(doc)
+        
+        return annotations, time.time() - start, self.last_error
+    
+    def record_error(self, note_id, error):
+        '''
+        Record why annotating a document (or one of its chunks) failed
+        note_id: clinicalnotekey of the document
+        error: failure reason, None if annotation succeeded
+        '''
+        if error is not None:
+            self.errors[note_id] = error
+    
+    def record_latency(self, note_id, latency_s):
+        '''
+        Add to the annotation time recorded for a document
+        note_id: clinicalnotekey of the document
+        latency_s: seconds spent annotating the document or one of its chunks
+        '''
+        self.latencies[note_id] = self.latencies.get(note_id, 0.0) + latency_s
+    
+    def record_chunks(self, doc, n_chunks):
+        '''
+        Record that a long document was split into chunks for annotation
+        doc: document as a dictionary with clinicalnotekey and notetext
+        n_chunks: number of chunks the document was split into
+        '''
+        self.n_chunked_docs += 1
+        self.n_chunks += n_chunks
+        log.debug("Chunked " + str(doc["clinicalnotekey"]) + " of length " + str(len(doc["notetext"])) + " into " + str(n_chunks) + " chunks")
+    
+    def split_docs(self, docs, chunk_offsets, doc_chunk_counts):
+        '''
+        Split long documents into chunk documents so the chunks of a document can be annotated by different workers
+        docs: iterable of documents as dictionaries with clinicalnotekey and notetext
+        chunk_offsets: deque the offset of each chunk in its document is appended to, in input order
+        doc_chunk_counts: deque the number of chunks of each document is appended to, in input order
+        '''
+        for doc in docs:
+            chunks = self.chunker.split(doc["notetext"])
+            if len(chunks) > 1:
+                self.record_chunks(doc, len(chunks))
+            doc_chunk_counts.append(len(chunks))
+            for offset, chunk in chunks:
+                chunk_offsets.append(offset)
+                yield {"clinicalnotekey": doc["clinicalnotekey"], "notetext": chunk}
+    
+    def annotate_docs_parallel_chunked(self, docs, n_workers, batch_size, max_in_flight_batches, threads_per_worker):
+        '''
+        Annotate documents with a pool of worker processes, spreading the chunks of long documents across workers and merging their annotations, and yield the annotations in input order
+        docs: iterable of documents as dictionaries with clinicalnotekey and notetext
+        n_workers: number of worker processes
+        batch_size: number of chunks sent to a worker at a time
+        max_in_flight_batches: maximum number of batches submitted but not yet consumed
+        threads_per_worker: number of torch / OpenMP threads each worker may use
+        '''
+        #chunks are submitted before their results are consumed, so the offsets and counts for a result are always queued by the time it arrives
+        chunk_offsets = collections.deque()
+        doc_chunk_counts = collections.deque()
+        chunk_annotations = []
+        
+        for annotations in self.annotate_docs_parallel(self.split_docs(docs, chunk_offsets, doc_chunk_counts), n_workers, batch_size, max_in_flight_batches, threads_per_worker):
+            chunk_annotations.append((chunk_offsets.popleft(), annotations))
+            if len(chunk_annotations) < doc_chunk_counts[0]:
+                continue
+            
+            doc_chunk_counts.popleft()
+            if any([annotations is None for _, annotations in chunk_annotations]):
+                yield None
+            elif len(chunk_annotations) == 1:
+                yield chunk_annotations[0][1]
+            else:
+                yield self.chunker.merge(chunk_annotations)
+            chunk_annotations = []
+    
+    def annotate_docs_parallel(self, docs, n_workers, batch_size, max_in_flight_batches, threads_per_worker):
+        '''
+        Annotate documents with a pool of worker processes, each loading the annotation model once, and yield the annotations in input order
+        docs: iterable of documents as dictionaries with clinicalnotekey and notetext
+        n_workers: number of worker processes
+        batch_size: number of documents sent to a worker at a time
+        max_in_flight_batches: maximum number of batches submitted but not yet consumed, bounds memory held by pending documents and results
+        threads_per_worker: number of torch / OpenMP threads each worker may use
+        '''
+        batch = []
+        pending = collections.deque()
+        
+        executor = self.create_annotation_pool(n_workers, threads_per_worker)
+        try:
+            for doc in docs:
+                #the governor shrinks batches and batches in flight under memory pressure and grows them back with headroom
+                if self.governor is not None:
+                    batch_size = self.governor.get_batch_size()
+                    max_in_flight_batches = self.governor.get_in_flight_limit()
+                
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    pending.append((batch, executor.submit(annotate_batch, batch)))
+                    batch = []
+                
+                while len(pending) >= max_in_flight_batches:
+                    annotations, executor = self.get_batch_results(pending, executor, n_workers, threads_per_worker)
+                    for doc_annotations in annotations:
+                        yield doc_annotations
+            
+            if len(batch) > 0:
+                pending.append((batch, executor.submit(annotate_batch, batch)))
+            
+            while len(pending) > 0:
+                annotations, executor = self.get_batch_results(pending, executor, n_workers, threads_per_worker)
+                for doc_annotations in annotations:
+                    yield doc_annotations
+        finally:
+            executor.shutdown()
+    
+    def create_annotation_pool(self, n_workers, threads_per_worker):
+        '''
+        Return a process pool of annotation workers, each loading the annotation model once
+        n_workers: number of worker processes
+        threads_per_worker: number of torch / OpenMP threads each worker may use
+        '''
+        return ProcessPoolExecutor(max_workers=n_workers, initializer=init_annotation_worker, initargs=(self.annotation_mode, threads_per_worker))
+    
+    def get_batch_results(self, pending, executor, n_workers, threads_per_worker):
+        '''
+        Wait for the oldest pending batch, record its latencies and worker memory and return its annotations in input order together with the executor to keep using.
+        If a worker died (e.g. killed for running out of memory or a segfault in a C extension) the pool is broken: the documents of the batch are returned as failed
+        so annotate_cohort quarantines them, the pool is restarted and the other batches in flight on the broken pool are resubmitted
+        pending: deque of (batch, future) tuples for the batches submitted to the pool, the oldest is removed
+        executor: the process pool the batches were submitted to
+        n_workers: number of worker processes
+        threads_per_worker: number of torch / OpenMP threads each worker may use
+        '''
+        batch, future = pending.popleft()
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            print("Annotation worker died, quarantining", len(batch), "documents and restarting the worker pool")
+            log.error("Annotation worker died: " + str(e))
+            for doc in batch:
+                self.record_error(doc["clinicalnotekey"], "BrokenProcessPool: annotation worker died while annotating the batch")
+            
+            executor.shutdown(wait=False)
+            executor = self.create_annotation_pool(n_workers, threads_per_worker)
+            for i in range(len(pending)):
+                pending_batch, pending_future = pending[i]
+                if not pending_future.done() or pending_future.cancelled() or pending_future.exception() is not None:
+                    pending[i] = (pending_batch, executor.submit(annotate_batch, pending_batch))
+            
+            return [None] * len(batch), executor
+        
+        if self.metrics is not None:
+            self.metrics.record_worker_rss(result["pid"], result["rss_bytes"])
+        self.worker_paragraph_stats[result["pid"]] = result["paragraph_stats"]
+        self.worker_doc_cache_stats[result["pid"]] = result["doc_cache_stats"]
+        
+        annotations = []
+        for doc, (doc_annotations, latency_s, error) in zip(batch, result["results"]):
+            self.record_latency(doc["clinicalnotekey"], latency_s)
+            self.record_error(doc["clinicalnotekey"], error)
+            annotations.append(doc_annotations)
+        
+        return annotations, executor
+    
+    def get_model_fingerprint(self):
+        '''
+        Return a fingerprint of the annotation model files and settings, used to key cached annotations
+        '''
+        medcat_config = config.Config().medcat_config
+        model_paths = [medcat_config["cdb_path"], medcat_config["vocab_path"], medcat_config["meta_path"]]
+        settings = {"annotation_mode": self.annotation_mode,
+                    "min_acc": medcat_config["min_acc"],
+                    "min_acc_th": medcat_config["min_acc_th"],
+                    "min_concept_length": medcat_config["min_concept_length"]}
+        
+        if self.annotation_mode == "MedCATCodelist":
+            model_paths = model_paths + self.get_codelist_paths()
+        
+        #with the DocBin cache, MedCAT mode builds entities with doc_to_entities rather than CAT.get_entities
+        if self.annotation_mode == "MedCAT":
+            settings["docbin_cache"] = medcat_config["docbin_cache_dir"] is not None
+        
+        if self.annotation_mode == "Dictionary":
+            model_paths = self.get_codelist_paths()
+            settings = {"annotation_mode": self.annotation_mode, "dictionary": config.Config().dictionary_config}
+        
+        #how notes are split for annotation changes the annotations, in every mode
+        settings["max_chunk_chars"] = medcat_config["max_chunk_chars"]
+        settings["chunk_overlap_chars"] = medcat_config["chunk_overlap_chars"]
+        settings["paragraph_reuse"] = medcat_config["paragraph_reuse"]
+        
+        return AnnotationCache.get_model_fingerprint(model_paths, settings)
+    
+    def annotate_docs_cached(self, docs, annotation_cache, n_workers=1):
+        '''
+        Annotate documents, returning cached annotations where available and only sending cache misses to the annotation model, and yield the annotations in input order
+        docs: iterable of documents as dictionaries with clinicalnotekey and notetext
+        annotation_cache: AnnotationCache for the current model, the caller commits it once the documents are consumed
+        n_workers: number of worker processes, 1 annotates in the current process
+        '''
+        #documents in input order paired with their cached annotations (None for misses still being annotated)
+        pending = collections.deque()
+        
+        def get_misses():
+            for doc in docs:
+                annotations = annotation_cache.get(doc["notetext"])
+                pending.append((doc, annotations))
+                if annotations is None:
+                    yield doc
+        
+        for annotations in self.annotate_docs_model(get_misses(), n_workers):
+            #yield the cache hits queued ahead of the miss this result belongs to
+            while pending[0][1] is not None:
+                yield pending.popleft()[1]
+            
+            doc, _ = pending.popleft()
+            if annotations is not None:
+                annotation_cache.put(doc["notetext"], annotations)
+            yield annotations
+        
+        while len(pending) > 0:
+            yield pending.popleft()[1]
+    
+    def annotate_docs(self, cohort, n_workers=1, annotation_cache=None):
+        '''
+        Annotate the note text of each document in the cohort, in a single process or with a pool of worker processes, and yield the annotations in cohort order
+        cohort: pandas dataframe with clinicalnotekey and notetext columns
+        n_workers: number of worker processes, 1 annotates in the current process
+        annotation_cache: optional AnnotationCache, only documents missing from the cache are annotated
+        '''
+        docs = ({"clinicalnotekey": note_id, "notetext": notetext} for note_id, notetext in zip(cohort["clinicalnotekey"], cohort["notetext"]))
+        
+        if annotation_cache is not None:
+            return self.annotate_docs_cached(docs, annotation_cache, n_workers)
+        
+        return self.annotate_docs_model(docs, n_workers)
+    
+    def annotate_docs_model(self, docs, n_workers=1):
+        '''
+        Annotate documents with the annotation model, in a single process or with a pool of worker processes, and yield the annotations in input order
+        docs: iterable of documents as dictionaries with clinicalnotekey and notetext
+        n_workers: number of worker processes, 1 annotates in the current process
+        '''
+        if n_workers <= 1:
+            for doc in docs:
+                annotations, latency_s, error = self.annotate_doc_timed(doc)
+                self.record_latency(doc["clinicalnotekey"], latency_s)
+                self.record_error(doc["clinicalnotekey"], error)
+                yield annotations
+        else:
+            medcat_config = config.Config().medcat_config
+            for annotations in self.annotate_docs_parallel_chunked(docs, n_workers, medcat_config["annotation_batch_size"], medcat_config["max_in_flight_batches"], medcat_config["threads_per_worker"]):
+                yield annotations
+    
+    def write_metrics(self):
+        '''
+        Finish the annotation metrics, print a summary and write the JSON metrics, Prometheus textfile and slowest documents report to the paths in output_config
+        '''
+        output_config = config.Config().output_config
+        self.metrics.finish()
+        
+        metrics = self.metrics.to_dict()
+        print("Annotated %s documents (%s from cache) at %s docs/sec and %s MB/sec, %s entities per document" % (metrics["n_docs"], metrics["n_cached_docs"], metrics["docs_per_sec"], metrics["mb_per_sec"], metrics["entities_per_doc"]))
+        
+        if output_config["annotation_metrics_filepath"] is not None:
+            self.metrics.write_json(output_config["annotation_metrics_filepath"])
+        if output_config["annotation_metrics_prom_filepath"] is not None:
+            self.metrics.write_prometheus(output_config["annotation_metrics_prom_filepath"])
+        if output_config["slowest_docs_filepath"] is not None:
+            self.metrics.write_slowest_report(output_config["slowest_docs_filepath"])
+    
+    def create_governor(self):
+        '''
+        Return a ResourceGovernor configured from medcat_config
+        '''
+        medcat_config = config.Config().medcat_config
+        return ResourceGovernor(medcat_config["annotation_batch_size"], medcat_config["max_in_flight_batches"],
+                                memory_ceiling_gb=medcat_config["memory_ceiling_gb"],
+                                min_available_gb=medcat_config["min_available_gb"],
+                                headroom_available_gb=medcat_config["headroom_available_gb"],
+                                spill_fraction=medcat_config["spill_fraction"],
+                                min_batch_size=medcat_config["min_annotation_batch_size"],
+                                max_batch_size=medcat_config["max_annotation_batch_size"],
+                                interval_s=medcat_config["governor_interval_s"])
+    
     #NOTE - This function (specifically the metadata_csv_file parameter) can be refactored if have ethics to include patient metadata in CogStack. At Trust where pipeline was developed this data had to be loaded in separately.
     #In next version will aim to build in flexibility around this metadata parameter
-    def annotate_cohort(self, cohort, metadata_csv_file):
+    def annotate_cohort(self, cohort, metadata_csv_file, n_workers=None, use_cache=None, checkpoint_dir=None, resume=False, compact=None):
         '''
         Top level convenience function, when given a cohort calls other functions in pipeline on default settings to annotate cohort
         cohort: a pandas dataframe with target cohort information (patient metadata [where available], document metadata and note text)
         metadata_csv_file: filepath with fields primary_mrn, date_of_birth and gender
+        n_workers: optional number of annotation worker processes, defaults to medcat_config["n_workers"]
+        use_cache: optional boolean on whether to reuse annotations cached for unchanged notes and model, defaults to whether medcat_config["annotation_cache_path"] is set
+        checkpoint_dir: optional directory to flush annotated documents to in shards, defaults to medcat_config["annotation_checkpoint_dir"]. When set a lazily loaded ShardedAnnotatedCohort is returned
+        resume: boolean on whether to keep existing shards in checkpoint_dir and skip the documents already annotated in them
+        compact: optional boolean on whether to return a CompactAnnotations columnar store instead of a list of dictionaries, defaults to medcat_config["compact_annotations"]
         '''
         start = time.time()
         print("Starting cohort annotation at: ", datetime.fromtimestamp(start))
         
+        medcat_config = config.Config().medcat_config
+        if n_workers is None:
+            n_workers = medcat_config["n_workers"]
+        if use_cache is None:
+            use_cache = medcat_config["annotation_cache_path"] is not None
+        
+        annotation_cache = None
+        if use_cache:
+            annotation_cache = AnnotationCache(medcat_config["annotation_cache_path"], self.get_model_fingerprint(), medcat_config["annotation_cache_max_bytes"])
+        
+        if checkpoint_dir is None:
+            checkpoint_dir = medcat_config["annotation_checkpoint_dir"]
+        if compact is None:
+            compact = medcat_config["compact_annotations"]
+        
         cohort = self.add_demographic_data(cohort, metadata_csv_file)
         
+        self.n_chunked_docs = 0
+        self.n_chunks = 0
+        self.worker_paragraph_stats = {}
+        self.worker_doc_cache_stats = {}
+        if self.paragraph_cache is not None:
+            self.paragraph_cache = ParagraphCache(medcat_config["paragraph_cache_size"])
+        
+        #built before a resumed run drops the documents already annotated, so their detail can be fetched too
+        detail_loader = None
+        if compact and not medcat_config["compact_store_detail"]:
+            detail_loader = self.get_detail_loader(cohort)
+        
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = AnnotationCheckpoint(checkpoint_dir, medcat_config["checkpoint_flush_every"])
+            if resume:
+                completed_note_ids = checkpoint.get_completed_note_ids()
+                cohort = cohort[~cohort["clinicalnotekey"].isin(completed_note_ids)].reset_index(drop=True)
+                print("Resuming from checkpoint,", len(completed_note_ids), "documents already annotated,", len(cohort), "left to annotate")
+            else:
+                checkpoint.reset()
+        
         annotated_cohort = []
+        if compact and checkpoint is None:
+            annotated_cohort = CompactAnnotations(medcat_config["compact_store_detail"], detail_loader)
+        n_failed = 0
         
-        for idx, doc in cohort.iterrows():
-            memory_available = psutil.virtual_memory().available / (1024.0 ** 3)
+        #memory is sampled on the governor's timer rather than per document
+        self.governor = self.create_governor()
+        self.governor.start()
+        self.metrics = AnnotationMetrics(config.Config().output_config["slowest_docs_top_n"])
+        self.latencies = {}
+        self.errors = {}
+        
+        #documents that time out or fail are persisted with the failure reason for retry_quarantined, a resumed run keeps the earlier quarantine
+        #and drops the entries of documents it annotates successfully at the end of the run
+        quarantine = AnnotationQuarantine(medcat_config["quarantine_filepath"])
+        previously_quarantined = {}
+        if resume:
+            previously_quarantined = quarantine.load()
+        else:
+            quarantine.clear()
+        recovered_note_ids = set()
+        
+        for (idx, doc), doc_annotations in zip(cohort.iterrows(), self.annotate_docs(cohort, n_workers, annotation_cache)):
+            self.governor.record_docs()
             if idx % 100 == 0:
                 print("Completed up to index:", idx, " ", (len(cohort) - idx), "left to process")
-                print("GB memory available: ", str(memory_available))
+                print("Resources: ", self.governor.get_status())
+                if n_workers <= 1:
+                    self.metrics.record_worker_rss(os.getpid(), psutil.Process().memory_info().rss)
             
             log.debug("Index:" + str(idx))
             log.debug("Doc length:" + str(len(doc["notetext"])))
-            log.debug("GB memory available:" + str(memory_available))
+            self.metrics.record_doc(doc["clinicalnotekey"], len(doc["notetext"]), self.latencies.pop(doc["clinicalnotekey"], None), len(doc_annotations) if doc_annotations is not None else 0)
+            
+            #spill completed results to disk before the memory ceiling is reached, switching an in memory run to a checkpointed one
+            if self.governor.should_spill():
+                if checkpoint is None and not compact:
+                    checkpoint_dir = medcat_config["spill_dir"]
+                    print("Approaching memory ceiling, spilling", len(annotated_cohort), "annotated documents to", checkpoint_dir)
+                    checkpoint = AnnotationCheckpoint(checkpoint_dir, medcat_config["checkpoint_flush_every"])
+                    checkpoint.reset()
+                    for doc_entry in annotated_cohort:
+                        checkpoint.append(doc_entry)
+                    annotated_cohort = []
+                if checkpoint is not None:
+                    checkpoint.flush()
+            
+            #quarantine documents the annotation model failed on, they are left out of the checkpoint so a resumed run retries them
+            if doc_annotations is None:
+                n_failed += 1
+                quarantine.add(doc["clinicalnotekey"], self.errors.pop(doc["clinicalnotekey"], "unknown"), len(doc["notetext"]))
+                continue
+            
+            if doc["clinicalnotekey"] in previously_quarantined:
+                recovered_note_ids.add(doc["clinicalnotekey"])
             
             doc_entry = {}
             doc_entry["pat_metadata"] = self.add_pat_metadata(doc)
             doc_entry["doc_metadata"] = self.add_doc_metadata(doc)
-            doc_entry["annotations"] = self.add_annotations(doc)
+            doc_entry["annotations"] = doc_annotations
             
-            annotated_cohort.append(doc_entry)
-            
-            log.debug("Total document list length:" + str(len(annotated_cohort)))
+            if checkpoint is not None:
+                checkpoint.append(doc_entry)
+            elif compact:
+                annotated_cohort.add_doc(doc_entry["pat_metadata"], doc_entry["doc_metadata"], doc_entry["annotations"])
+            else:
+                annotated_cohort.append(doc_entry)
+                log.debug("Total document list length:" + str(len(annotated_cohort)))
+        
+        self.governor.stop()
+        self.governor = None
+        self.write_metrics()
+        self.metrics = None
+        
+        #annotate_docs is consumed through zip, which stops at the last cohort row without resuming the generator, so the cache is committed here
+        if annotation_cache is not None:
+            print("Annotation cache stats:", annotation_cache.get_stats())
+            annotation_cache.close()
+        
+        if len(recovered_note_ids) > 0:
+            quarantine.rewrite([entry for note_id, entry in quarantine.load().items() if note_id not in recovered_note_ids])
+            print("Removed", len(recovered_note_ids), "documents annotated by this run from the quarantine")
+        
+        if n_failed > 0:
+            print("Annotation failed on", n_failed, "documents, quarantined in", quarantine.filepath, "for retry_quarantined")
+        
+        if self.n_chunked_docs > 0:
+            print("Annotated", self.n_chunked_docs, "long documents in", self.n_chunks, "chunks (%s chunks per document)" % round(self.n_chunks / self.n_chunked_docs, 2))
+        
+        self.report_paragraph_reuse()
+        self.flush_doc_cache()
+        self.report_doc_cache()
+        
+        if checkpoint is not None:
+            checkpoint.flush()
+            annotated_cohort = ShardedAnnotatedCohort(checkpoint_dir)
+            if compact:
+                annotated_cohort = CompactAnnotations.from_docs(annotated_cohort, medcat_config["compact_store_detail"], detail_loader)
+        
+        if compact:
+            annotated_cohort = annotated_cohort.finalize()
+            print("Compact annotation store size: %s MB" % round(annotated_cohort.get_nbytes() / 1024 ** 2, 2))
             
         end = time.time()
         print("Cohort annotation finished at: ", datetime.fromtimestamp(end))
         print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
         
         return annotated_cohort
-        
\ No newline at end of file
+    
+    def get_detail_loader(self, cohort):
+        '''
+        Return a function fetching the full entity dictionaries of a cohort document by note id, for a CompactAnnotations store that does not keep them.
+        The annotations are read from the annotation cache when it holds the note, otherwise the note is annotated again
+        cohort: pandas dataframe with clinicalnotekey and notetext columns
+        '''
+        notetexts = dict(zip(cohort["clinicalnotekey"], cohort["notetext"]))
+        
+        def load_detail(note_id):
+            doc = {"clinicalnotekey": note_id, "notetext": notetexts[note_id]}
+            
+            medcat_config = config.Config().medcat_config
+            if medcat_config["annotation_cache_path"] is not None:
+                annotation_cache = AnnotationCache(medcat_config["annotation_cache_path"], self.get_model_fingerprint(), medcat_config["annotation_cache_max_bytes"])
+                try:
+                    annotations = annotation_cache.get(doc["notetext"])
+                finally:
+                    annotation_cache.close()
+                if annotations is not None:
+                    return annotations
+            
+            annotations = self.add_annotations(doc)
+            if annotations is None:
+                raise RuntimeError("Could not annotate " + str(note_id) + " for its entity detail: " + str(self.last_error))
+            return annotations
+        
+        return load_detail
+    
+    def add_annotated_docs(self, annotated_cohort, doc_entries):
+        '''
+        Add annotated documents to an annotated cohort returned by annotate_cohort and return the updated cohort
+        annotated_cohort: list of annotated documents, CompactAnnotations or ShardedAnnotatedCohort
+        doc_entries: list of annotated documents -> [{"pat_metadata":[], "doc_metadata":[], "annotations":[]}]
+        '''
+        if isinstance(annotated_cohort, CompactAnnotations):
+            for doc_entry in doc_entries:
+                annotated_cohort.add_doc(doc_entry["pat_metadata"], doc_entry["doc_metadata"], doc_entry["annotations"])
+            return annotated_cohort.finalize()
+        
+        if isinstance(annotated_cohort, ShardedAnnotatedCohort):
+            checkpoint = AnnotationCheckpoint(annotated_cohort.checkpoint_dir)
+            for doc_entry in doc_entries:
+                checkpoint.append(doc_entry)
+            checkpoint.flush()
+            return ShardedAnnotatedCohort(annotated_cohort.checkpoint_dir)
+        
+        return annotated_cohort + doc_entries
+    
+    def get_annotated_note_ids(self, annotated_cohort):
+        '''
+        Return the set of note ids in an annotated cohort returned by annotate_cohort
+        annotated_cohort: list of annotated documents, CompactAnnotations or ShardedAnnotatedCohort
+        '''
+        if isinstance(annotated_cohort, CompactAnnotations):
+            return set(annotated_cohort.note_ids)
+        
+        if isinstance(annotated_cohort, ShardedAnnotatedCohort):
+            return AnnotationCheckpoint(annotated_cohort.checkpoint_dir).get_completed_note_ids()
+        
+        return set([doc_entry["doc_metadata"]["note_id"] for doc_entry in annotated_cohort])
+    
+    def retry_quarantined(self, cohort, metadata_csv_file, annotated_cohort):
+        '''
+        Retry pass over the documents quarantined by annotate_cohort with relaxed settings (smaller chunks and a longer timeout), merging recovered documents into the annotated cohort.
+        Documents that fail again stay in the quarantine with their new failure reason, quarantined documents already in the annotated cohort are dropped from the quarantine without being annotated again
+        cohort: the pandas dataframe passed to annotate_cohort
+        metadata_csv_file: filepath with fields primary_mrn, date_of_birth and gender
+        annotated_cohort: the annotated cohort returned by annotate_cohort
+        '''
+        medcat_config = config.Config().medcat_config
+        quarantine = AnnotationQuarantine(medcat_config["quarantine_filepath"])
+        entries = quarantine.load()
+        
+        annotated_note_ids = self.get_annotated_note_ids(annotated_cohort)
+        already_annotated = [note_id for note_id in entries if note_id in annotated_note_ids]
+        for note_id in already_annotated:
+            del entries[note_id]
+        if len(already_annotated) > 0:
+            print("Skipping", len(already_annotated), "quarantined documents already in the annotated cohort")
+        
+        if len(entries) == 0:
+            print("No quarantined documents to retry")
+            quarantine.rewrite([])
+            return annotated_cohort
+        
+        print("Retrying", len(entries), "quarantined documents")
+        cohort = self.add_demographic_data(cohort, metadata_csv_file)
+        cohort = cohort[cohort["clinicalnotekey"].isin(list(entries.keys()))]
+        
+        default_chunker = self.chunker
+        default_timeout_s = self.timeout_s
+        self.chunker = TextChunker(medcat_config["retry_max_chunk_chars"], medcat_config["chunk_overlap_chars"])
+        self.timeout_s = medcat_config["retry_timeout_s"]
+        
+        recovered = []
+        try:
+            for idx, doc in cohort.iterrows():
+                entry = entries.pop(doc["clinicalnotekey"], None)
+                if entry is None:
+                    continue
+                doc_annotations = self.add_annotations(doc)
+                if doc_annotations is None:
+                    entry["reason"] = self.last_error
+                    entry["attempts"] += 1
+                    entries[doc["clinicalnotekey"]] = entry
+                    continue
+                
+                doc_entry = {}
+                doc_entry["pat_metadata"] = self.add_pat_metadata(doc)
+                doc_entry["doc_metadata"] = self.add_doc_metadata(doc)
+                doc_entry["annotations"] = doc_annotations
+                recovered.append(doc_entry)
+        finally:
+            self.chunker = default_chunker
+            self.timeout_s = default_timeout_s
+        
+        self.flush_doc_cache()
+        quarantine.rewrite(list(entries.values()))
+        print("Recovered", len(recovered), "quarantined documents,", len(entries), "remain quarantined")
+        
+        return self.add_annotated_docs(annotated_cohort, recovered)
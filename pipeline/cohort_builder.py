@@ -1,30 +1,37 @@
 import pipeline.esconn as esconn
 import pipeline.config as config
+from pipeline.document_filter import DocumentFilter
+from pipeline.cohort_cache import CohortCache
 import pandas as pd
 import time
 from datetime import datetime
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import helpers, NotFoundError
 import os
 import ssl
+import json
+import copy
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 class CohortBuilder:
     def __init__(self):
         print("Initializing Cohort Builder")
         
+        self.config = config.Config()
+        
         print("Connect to ES...")
 
-        es_conn = Elasticsearch([config.Config().es_config["es_url"]], http_auth=(config.Config().es_config["es_user"],config.Config().es_config["es_password"]))
-        
-        if es_conn.ping() is True:
-            print("Connected to ES")
+        self.conn = esconn.get_connector()
+        print("Connected to ES")
     
-        self.es = es_conn
+        self.es = self.conn.es
         
-    def construct_query(self, search_term, batch_size=10000):
+    def construct_query(self, search_term, batch_size=10000, source_fields=None):
         '''
         Given a search term and batch size return a structured ES search query for use in search api
         search_term: a string term to conduct text search with
         batch_size: an integer for the number of documents to be processed in each batch of scroll API (should not require altering)
+        source_fields: optional list of _source fields to retrieve, all fields are retrieved if None
         '''
         query = {"size":batch_size,
          "query":{"bool":
@@ -36,15 +43,44 @@ class CohortBuilder:
                     "should":[],
                     "must_not":[]}}}
         
+        if source_fields is not None:
+            query["_source"] = source_fields
+        
         return query
     
-    def query_es(self, query, index):
+    def construct_queries(self, search_terms, batch_size=10000):
+        '''
+        Given a list of search terms and/or structured ES search queries return a dictionary of labelled queries and a single query for the union of all of them
+        search_terms: a list of strings to conduct text search with and/or structured ES search queries (e.g. synonyms and abbreviations for a condition)
+        batch_size: an integer for the number of documents to be processed in each batch of scroll API (should not require altering)
+        '''
+        queries = {}
+        for i, search_term in enumerate(search_terms):
+            if isinstance(search_term, dict):
+                queries["query_" + str(i)] = search_term
+            else:
+                queries[search_term] = self.construct_query(search_term, batch_size)
+        
+        union_query = {"size":batch_size,
+         "query":{"bool":
+                    {"must":[],
+                    "filter":[],
+                    "should":[query["query"] for query in queries.values()],
+                    "minimum_should_match":1,
+                    "must_not":[]}}}
+        
+        return queries, union_query
+    
+    def query_es(self, query, index, n_slices=1):
         '''
         Given a structured ES search query return an array of results using the scroll API
         query: an array containing a structured ES search query
         index: an ES index that hosts target documents
-        
+        n_slices: an integer for the number of sliced scrolls to retrieve in parallel (1 uses a single scroll)
         '''
+        if n_slices > 1:
+            return self.query_es_sliced(query, index, n_slices)
+        
         es_response = []
         res = helpers.scan(
                 client = self.es,
@@ -57,52 +93,317 @@ class CohortBuilder:
         
         return es_response
     
-    #NOTE: these are a set of optional functions for removing invalid discharge summaries at UCLH which could only be filtered with access to the free text note. They will not be relevant at other Trusts.
-    def remove_stroke_ds(self, x):
+    def query_es_slice(self, query, index, slice_id, n_slices):
         '''
-        Given a cohort note text, add flag for stroke pad discharge summaries at UCLH
-        x: row with notetext data
+        Given a structured ES search query return an array of results for one slice of a sliced scroll and print the throughput for the slice
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        slice_id: an integer for the slice to retrieve (0 to n_slices - 1)
+        n_slices: an integer for the total number of slices
         '''
-        target = x[0:7]
-        target_cl = target.strip()
-
-        if target_cl == "Please":
-            return True
-        else:
-            return False
+        slice_query = dict(query)
+        slice_query["slice"] = {"id": slice_id, "max": n_slices}
+        
+        start = time.time()
+        es_response = []
+        res = helpers.scan(
+                client = self.es,
+                scroll = '2m',
+                query = slice_query, 
+                index = index)
+        
+        for doc in res:
+            es_response.append(doc)
         
-    def remove_emergency_ds(self, x):
+        elapsed = max(time.time() - start, 1e-6)
+        print("Slice %s/%s retrieved %s documents in %s seconds (%s docs/sec)" % (slice_id + 1, n_slices, len(es_response), round(elapsed, 2), round(len(es_response) / elapsed, 2)))
+        
+        return es_response
+    
+    def query_es_sliced(self, query, index, n_slices):
         '''
-        Given a cohort note text, add flag for emergency discharge summaries at UCLH
-        x: row with notetext data
+        Given a structured ES search query return an array of results using n_slices sliced scrolls retrieved in parallel.
+        Slices are merged in slice order so the output is deterministic and contains the same documents as the serial scroll
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        n_slices: an integer for the number of slices and parallel workers
         '''
-        target = x[0:41]
-        target_cl = target.strip()
-
-        if target_cl == "Discharge Summary (Emergency Department)":
-            return True
-        else:
-            return False
+        start = time.time()
         
-    def remove_cc_ds(self, x):
+        with ThreadPoolExecutor(max_workers=n_slices) as executor:
+            futures = [executor.submit(self.query_es_slice, query, index, slice_id, n_slices) for slice_id in range(n_slices)]
+            es_response = []
+            for future in futures:
+                es_response.extend(future.result())
+        
+        elapsed = max(time.time() - start, 1e-6)
+        print("Sliced scroll retrieved %s documents in %s seconds (%s docs/sec)" % (len(es_response), round(elapsed, 2), round(len(es_response) / elapsed, 2)))
+        
+        return es_response
+    
+    async def query_es_term_async(self, client, label, query, index, es_response, term_counts):
         '''
-        Given a cohort note text, add flag for critical care discharge summaries at UCLH
-        x: row with notetext data
+        Scroll through the results of one query with the async ES client, adding documents not yet seen to es_response (keyed by clinicalnotekey) as they arrive
+        client: an AsyncElasticsearch client
+        label: the search term or label for the query, used for reporting hit counts
+        query: an array containing a structured ES search query
+        index: an ES index (or comma separated indices) that hosts target documents
+        es_response: dictionary of clinicalnotekey to ES result shared across queries
+        term_counts: dictionary of label to number of hits shared across queries
         '''
-        if "UCH Critical Care Discharge Summary" in x:
-            return True
-        else:
-            return False
+        from elasticsearch.helpers import async_scan
         
-    def add_keep_doc_flag(self, x):
+        start = time.time()
+        async for doc in async_scan(client, query=query, index=index, scroll='2m'):
+            term_counts[label] += 1
+            key = doc["_source"].get("clinicalnotekey", doc["_id"])
+            if key not in es_response:
+                es_response[key] = doc
+        
+        print("Query for", label, "retrieved", term_counts[label], "documents in %s seconds" % round(time.time() - start, 2))
+    
+    async def query_es_multi_async(self, queries, index, es_response, term_counts):
         '''
-        Given a cohort as a pandas dataframe, add keep doc flag based on previously assigned invalid discharge summary columns
-        x: row with all columns for cohort
+        Run all queries concurrently on one async ES client
+        queries: dictionary of label to structured ES search query
+        index: an ES index (or comma separated indices) that hosts target documents
+        es_response: dictionary of clinicalnotekey to ES result shared across queries
+        term_counts: dictionary of label to number of hits shared across queries
         '''
-        if x["invalid_stroke_ds"] or x["invalid_emergency_ds"] or x["invalid_cc_ds"]:
-            return False
-        else:
-            return True
+        client = esconn.create_async_client()
+        try:
+            await asyncio.gather(*[self.query_es_term_async(client, label, query, index, es_response, term_counts) for label, query in queries.items()])
+        finally:
+            await client.close()
+    
+    def query_es_multi(self, queries, index):
+        '''
+        Given a dictionary of labelled structured ES search queries, run them concurrently and return an array of the union of their results deduplicated by clinicalnotekey
+        queries: dictionary of label to structured ES search query, e.g. from construct_queries
+        index: an ES index (or comma separated indices) that hosts target documents
+        '''
+        start = time.time()
+        es_response = {}
+        term_counts = {label: 0 for label in queries}
+        
+        asyncio.run(self.query_es_multi_async(queries, index, es_response, term_counts))
+        
+        print("Hits per query:", term_counts)
+        print("Unique documents across queries:", len(es_response), "retrieved in %s seconds" % round(time.time() - start, 2))
+        
+        return list(es_response.values())
+    
+    def load_pit_checkpoint(self, checkpoint_dir):
+        '''
+        Load the cursor checkpoint written by query_es_pit, truncating the saved hits to the last checkpointed page, and return it (or None if there is no checkpoint)
+        checkpoint_dir: directory holding checkpoint.json and hits.jsonl
+        '''
+        checkpoint_path = os.path.join(checkpoint_dir, "checkpoint.json")
+        if not os.path.exists(checkpoint_path):
+            return None
+        
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        
+        #drop any page written after the last checkpoint so it is not duplicated on resume
+        with open(os.path.join(checkpoint_dir, "hits.jsonl"), "a") as f:
+            f.truncate(checkpoint["hits_bytes"])
+        
+        return checkpoint
+    
+    def save_pit_checkpoint(self, checkpoint_dir, checkpoint):
+        '''
+        Atomically write the cursor checkpoint for query_es_pit
+        checkpoint_dir: directory holding checkpoint.json and hits.jsonl
+        checkpoint: dictionary with the point in time id, search_after cursor and number of hits and bytes saved
+        '''
+        checkpoint_path = os.path.join(checkpoint_dir, "checkpoint.json")
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+    
+    def clear_checkpoint(self, checkpoint_dir):
+        '''
+        Remove the checkpoint files written by query_es_pit once the cohort has been packaged, anything else in checkpoint_dir is left in place
+        checkpoint_dir: directory holding checkpoint.json and hits.jsonl
+        '''
+        for filename in ["checkpoint.json", "checkpoint.json.tmp", "hits.jsonl"]:
+            path = os.path.join(checkpoint_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def query_es_pit(self, query, index, checkpoint_dir, keep_alive="5m"):
+        '''
+        Given a structured ES search query return an array of results using a point in time and search_after, saving every page and the cursor to checkpoint_dir so an interrupted retrieval resumes where it stopped.
+        Unlike a scroll, the point in time only needs to stay alive between consecutive pages (keep_alive)
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        checkpoint_dir: directory to save retrieved hits (hits.jsonl) and the cursor (checkpoint.json) in
+        keep_alive: how long ES keeps the point in time open between pages
+        '''
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        hits_path = os.path.join(checkpoint_dir, "hits.jsonl")
+        sort = self.config.es_config["pit_sort"]
+        
+        checkpoint = self.load_pit_checkpoint(checkpoint_dir)
+        if checkpoint is not None and (checkpoint["query"] != query or checkpoint["index"] != index):
+            raise ValueError("Checkpoint in %s was created for a different query or index" % checkpoint_dir)
+        
+        if checkpoint is None:
+            checkpoint = {"query": query, "index": index, "pit_id": None, "search_after": None, "n_hits": 0, "hits_bytes": 0, "complete": False}
+            open(hits_path, "w").close()
+        elif not checkpoint["complete"]:
+            print("Resuming retrieval from checkpoint with", checkpoint["n_hits"], "documents already retrieved")
+        
+        start = time.time()
+        while not checkpoint["complete"]:
+            if checkpoint["pit_id"] is None:
+                checkpoint["pit_id"] = self.conn.call_with_backoff(self.es.open_point_in_time, index=index, keep_alive=keep_alive)["id"]
+            
+            body = {key: value for key, value in query.items() if key not in ["query", "size"]}
+            body["query"] = query["query"]
+            body["size"] = query.get("size", 10000)
+            body["pit"] = {"id": checkpoint["pit_id"], "keep_alive": keep_alive}
+            body["sort"] = sort
+            if checkpoint["search_after"] is not None:
+                body["search_after"] = checkpoint["search_after"]
+            
+            try:
+                res = self.conn.call_with_backoff(self.es.search, body=body)
+            except NotFoundError:
+                #the point in time expired while the build was interrupted
+                print("Point in time expired, opening a new one")
+                checkpoint["pit_id"] = None
+                if any(["_shard_doc" in field for field in sort]):
+                    #_shard_doc cursors are only valid within one point in time so retrieval restarts
+                    print("Cursor cannot be reused with a new point in time - restarting retrieval")
+                    checkpoint.update({"search_after": None, "n_hits": 0, "hits_bytes": 0})
+                    open(hits_path, "w").close()
+                continue
+            
+            hits = res["hits"]["hits"]
+            checkpoint["pit_id"] = res.get("pit_id", checkpoint["pit_id"])
+            
+            if len(hits) == 0:
+                self.es.close_point_in_time(body={"id": checkpoint["pit_id"]})
+                checkpoint["complete"] = True
+            else:
+                with open(hits_path, "a") as f:
+                    for hit in hits:
+                        f.write(json.dumps(hit) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                    checkpoint["hits_bytes"] = f.tell()
+                checkpoint["search_after"] = hits[-1]["sort"]
+                checkpoint["n_hits"] += len(hits)
+                print("Retrieved", checkpoint["n_hits"], "documents (%s docs/sec)" % round(checkpoint["n_hits"] / max(time.time() - start, 1e-6), 2))
+            
+            self.save_pit_checkpoint(checkpoint_dir, checkpoint)
+        
+        es_response = []
+        with open(hits_path) as f:
+            for line in f:
+                es_response.append(json.loads(line))
+        
+        return es_response
+    
+    def query_es_chunks(self, query, index, chunk_size=10000):
+        '''
+        Given a structured ES search query yield the results as pandas dataframes of at most chunk_size documents using the scroll API, so the full response is never held in memory
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        chunk_size: an integer for the maximum number of documents in each yielded dataframe
+        '''
+        chunk = []
+        res = helpers.scan(
+                client = self.es,
+                scroll = '2m',
+                query = query, 
+                index = index)
+        
+        for doc in res:
+            chunk.append(doc['_source'])
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk)
+                chunk = []
+        
+        if len(chunk) > 0:
+            yield pd.DataFrame(chunk)
+    
+    def construct_metadata_query(self, query, trust_site=None):
+        '''
+        Given a structured ES search query return a copy that retrieves only document metadata fields plus the note text prefix and flags needed by the trust specific filters, computed server side (phase one of a two-phase build)
+        query: an array containing a structured ES search query
+        trust_site: optional string for the trust whose document filters should be evaluated
+        '''
+        metadata_query = dict(query)
+        metadata_query["_source"] = self.config.es_config["cohort_metadata_fields"]
+        
+        if trust_site is not None:
+            metadata_query["script_fields"] = DocumentFilter.from_config(trust_site).get_script_fields()
+        
+        return metadata_query
+    
+    def fetch_notetext(self, cohort, batch_size=1000, n_workers=1):
+        '''
+        Given a cohort of document metadata with es_index and es_id columns, bulk fetch the note text for each document with the mget API and return the cohort with a notetext column (phase two of a two-phase build)
+        cohort: pandas dataframe with one row per document to retrieve
+        batch_size: an integer for the number of documents retrieved per mget request
+        n_workers: an integer for the number of concurrent mget requests
+        '''
+        cohort = cohort.copy()
+        cohort["notetext"] = None
+        
+        for doc_index, group in cohort.groupby("es_index"):
+            indexer = esconn.ElasticIndexer(self.conn, doc_index)
+            docs = indexer.get_docs(group["es_id"].tolist(), fields=["notetext"], batch_size=batch_size, n_workers=n_workers)
+            cohort.loc[group.index, "notetext"] = [doc.get("notetext") if doc is not None else None for doc in docs]
+        
+        print("Number of documents missing note text after fetch:", cohort["notetext"].isna().sum())
+        cohort = cohort[cohort["notetext"].notna()]
+        
+        return cohort
+    
+    def package_metadata_cohort(self, es_response, **kwargs):
+        '''
+        Given an array of ES results from a metadata query and an optional kwargs flag for trust_site, return a pandas dataframe of document metadata filtered by trust specific filters and with an individual entry for each patient id based on most recent encounter date
+        es_response: an array containing a set of results from ES for a query built with construct_metadata_query
+        '''
+        rows = []
+        for result in es_response:
+            row = dict(result['_source'])
+            row["es_index"] = result["_index"]
+            row["es_id"] = result["_id"]
+            for field, values in result.get("fields", {}).items():
+                row[field] = values[0]
+            rows.append(row)
+        cohort = pd.DataFrame(rows)
+        
+        if "trust_site" in kwargs:
+            print("Remove invalid discharge summaries for", kwargs["trust_site"])
+            print("Number of rows pre invalid discharge summary removal:", len(cohort))
+            
+            cohort = self.flag_invalid_docs(cohort, kwargs["trust_site"], text_col="notetext_prefix", use_script_fields=True)
+            cohort = cohort[cohort["keep_doc"]]
+            
+            print("Number of rows post invalid discharge summary removal:", len(cohort))
+        
+        print("Number of rows pre most recent document selection:", len(cohort))
+        cohort = self.select_most_recent_patient_doc(cohort)
+        print("Number of rows post most recent document selection:", len(cohort))
+        
+        return cohort
+    
+    #NOTE: trust specific filters for removing invalid discharge summaries which could only be filtered with access to the free text note are configured per trust in config (document_filters), e.g. strokepad, emergency department and critical care discharge summaries at UCLH
+    def flag_invalid_docs(self, cohort, trust_site, text_col="notetext", use_script_fields=False):
+        '''
+        Given a cohort as a pandas dataframe and a trust site, add invalid discharge summary flag columns and a keep_doc column for trust specific filters
+        cohort: pandas dataframe containining target cohort (or a chunk of it)
+        trust_site: string for the trust the cohort was extracted from (e.g. "UCLH")
+        text_col: column with the note text to evaluate the filters against
+        use_script_fields: boolean on whether flags for non prefix filters were already computed by ES (two-phase build)
+        '''
+        return DocumentFilter.from_config(trust_site).flag_invalid_docs(cohort, text_col=text_col, use_script_fields=use_script_fields)
     
     #NOTE: functions relevant across Trusts from here again
     def select_most_recent_patient_doc(self, cohort):
@@ -124,6 +425,62 @@ class CohortBuilder:
         
         return cohort
     
+    def merge_most_recent_patient_docs(self, current_cohort, chunk):
+        '''
+        Given the most recent documents per patient seen so far and a new chunk of documents, return an updated dataframe with an individual entry for each patient id based on most recent encounter date
+        current_cohort: pandas dataframe with one document per patient, or None for the first chunk
+        chunk: pandas dataframe with a new chunk of documents
+        '''
+        chunk = chunk.copy()
+        chunk["encounterdate_dt"] = pd.to_datetime(chunk["encounterdate"])
+        chunk = chunk[chunk['encounterdate_dt'].notna()]
+        
+        if current_cohort is not None:
+            chunk = pd.concat([current_cohort, chunk], ignore_index=True)
+        
+        #stable sort so that ties on encounter date resolve deterministically to the last document retrieved
+        return chunk.sort_values('encounterdate_dt', kind='mergesort').groupby('patientprimarymrn').tail(1)
+    
+    def package_cohort_stream(self, chunks, **kwargs):
+        '''
+        Given an iterable of ES result chunks as pandas dataframes and an optional kwargs flag for trust_site, return a pandas dataframe filtered by trust specific filters and with an individual entry for each patient id based on most recent encounter date.
+        Chunks are filtered and reduced as they arrive so memory is bounded by the chunk size plus one document per patient
+        chunks: iterable of pandas dataframes, e.g. from query_es_chunks
+        '''
+        trust_site = kwargs.get("trust_site")
+        cohort = None
+        n_rows = 0
+        n_kept = 0
+        n_invalid = {}
+        if trust_site is not None:
+            n_invalid = {name: 0 for name in DocumentFilter.from_config(trust_site).get_rule_names()}
+        
+        for i, chunk in enumerate(chunks):
+            n_rows += len(chunk)
+            
+            if trust_site is not None:
+                chunk = self.flag_invalid_docs(chunk, trust_site)
+                for col in n_invalid:
+                    n_invalid[col] += int(chunk[col].sum())
+                chunk = chunk[chunk["keep_doc"]]
+            
+            n_kept += len(chunk)
+            cohort = self.merge_most_recent_patient_docs(cohort, chunk)
+            print("Processed chunk", i, "- rows retrieved so far:", n_rows, "patients so far:", len(cohort))
+        
+        if cohort is None:
+            return pd.DataFrame()
+        
+        if n_rows > 0:
+            for col in n_invalid:
+                print(col, "%: ", n_invalid[col] / n_rows)
+        
+        print("Number of rows pre most recent document selection:", n_kept)
+        print("Number of rows post most recent document selection:", len(cohort))
+        print("Distribution of cohort dates: ", cohort["encounterdate_dt"].describe())
+        
+        return cohort
+    
     def package_cohort(self, es_response, **kwargs):
         '''
         Given an array of ES results and an optional kwargs flag for note_type, return a pandas dataframe filtered by target note_type and with an individual entry for each patient id based on most recent encounter date
@@ -134,23 +491,16 @@ class CohortBuilder:
         cohort = pd.DataFrame(es_response_source_docs)
         
         if "trust_site" in kwargs:
-            if kwargs["trust_site"] == "UCLH":
-                print("Remove strokepad, emergency department and critical care discharge summaries")
+            document_filter = DocumentFilter.from_config(kwargs["trust_site"])
+            if len(document_filter.rules) > 0:
+                print("Remove invalid discharge summaries for", kwargs["trust_site"])
                 print("Number of rows pre invalid discharge summary removal:", len(cohort))
                 print("Number of individuals pre invalid discharge summary removal:",len(cohort.groupby("patientprimarymrn").count()))
                 
-                cohort["invalid_stroke_ds"] = cohort["notetext"].apply(self.remove_stroke_ds)
-                cohort["invalid_emergency_ds"] = cohort["notetext"].apply(self.remove_emergency_ds)
-                cohort["invalid_cc_ds"] = cohort["notetext"].apply(self.remove_cc_ds)
-                
-                pct_stroke_ds = len(cohort[cohort["invalid_stroke_ds"]]) / len(cohort)
-                pct_emergency_ds = len(cohort[cohort["invalid_emergency_ds"]]) / len(cohort)
-                pct_cc_ds = len(cohort[cohort["invalid_cc_ds"]]) / len(cohort)
-                print("Invalid stroke ds %: ", pct_stroke_ds)
-                print("Invalid emergency ds %: ", pct_emergency_ds)
-                print("Invalid critical care ds %: ", pct_cc_ds)
+                cohort = document_filter.flag_invalid_docs(cohort)
                 
-                cohort["keep_doc"] = cohort.apply(self.add_keep_doc_flag, axis=1)
+                for col in document_filter.get_rule_names():
+                    print(col, "%: ", cohort[col].sum() / len(cohort))
                 
                 cohort = cohort[cohort["keep_doc"]]
                 cohort = cohort.reset_index()
@@ -178,25 +528,39 @@ class CohortBuilder:
         print("Number of patients:", n_patients)
         
 
-    def build_cohort(self, search_term, index="nifi_epic_raw_notes", batch_size=10000, **kwargs):
+    def build_cohort(self, search_term, index="nifi_epic_raw_notes", batch_size=10000, streaming=False, two_phase=False, use_cache=False, checkpoint_dir=None, **kwargs):
         '''
         Top level convenience function, when given search term, index, batch_size and optional kwargs (e.g. note_type) calls other functions in pipeline to build target cohort
-        search_term: a string term to conduct text search with
+        search_term: a string term to conduct text search with, or a list of terms and/or structured ES search queries whose results are unioned (queried concurrently unless streaming or two_phase)
         index: a string with the ES index hosting target documents
         batch_size: an integer for the number of documents to be processed in each batch of scroll API (should not require altering)
+        streaming: boolean on whether to build the cohort from bounded size chunks rather than materialising every ES hit in memory
+        two_phase: boolean on whether to select the most recent document per patient from metadata only and then fetch note text for the selected documents
+        use_cache: boolean on whether to reuse a cached cohort when the matching documents in the index are unchanged (see CohortCache)
+        checkpoint_dir: optional directory to checkpoint a resumable point in time retrieval to (see query_es_pit), an interrupted build with the same checkpoint_dir resumes where it stopped
         optional kwargs flag for note_type
         '''
         start = time.time()
         print("Starting cohort build at: ", datetime.fromtimestamp(start))
         
-        query = self.construct_query(search_term, batch_size)
-        es_response = self.query_es(query, index)
-            
-        if "trust_site" in kwargs:
-            cohort = self.package_cohort(es_response, trust_site = kwargs["trust_site"])
+        queries = None
+        if isinstance(search_term, list):
+            queries, query = self.construct_queries(search_term, batch_size)
         else:
-            cohort = self.package_cohort(es_response)
+            query = self.construct_query(search_term, batch_size)
+        
+        cohort = None
+        if use_cache:
+            cohort_cache = CohortCache(self.config.es_config["cohort_cache_dir"], self.config.es_config["cohort_cache_max_bytes"])
+            trust_site = kwargs.get("trust_site")
+            document_filters = self.config.es_config["document_filters"].get(trust_site)
+            cache_key = cohort_cache.get_key(query, index, trust_site, cohort_cache.get_index_state(self.es, query, index), document_filters, self.get_retrieval_settings(streaming, two_phase))
+            cohort = cohort_cache.get(cache_key)
         
+        if cohort is None:
+            cohort = self.retrieve_cohort(query, index, streaming=streaming, two_phase=two_phase, queries=queries, checkpoint_dir=checkpoint_dir, **kwargs)
+            if use_cache:
+                cohort_cache.put(cache_key, cohort)
                 
         self.get_cohort_size(cohort)
         end = time.time()
@@ -204,6 +568,194 @@ class CohortBuilder:
         print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
         return cohort
     
+    def get_retrieval_settings(self, streaming=False, two_phase=False):
+        '''
+        Return the retrieval mode settings that change the columns of a retrieved cohort, used to key cached cohorts
+        streaming: boolean on whether the cohort is built from bounded size chunks of cohort_source_fields
+        two_phase: boolean on whether the cohort is built from cohort_metadata_fields and note text fetched for the selected documents
+        '''
+        source_fields = None
+        if streaming:
+            source_fields = self.config.es_config["cohort_source_fields"]
+        elif two_phase:
+            source_fields = self.config.es_config["cohort_metadata_fields"]
+        
+        return {"streaming": streaming, "two_phase": two_phase and not streaming, "source_fields": source_fields}
+    
+    def retrieve_cohort(self, query, index, streaming=False, two_phase=False, queries=None, checkpoint_dir=None, **kwargs):
+        '''
+        Given a structured ES search query and an index, retrieve and package the matching documents using the selected retrieval mode and return the cohort as a pandas dataframe
+        query: an array containing a structured ES search query
+        index: a string with the ES index hosting target documents
+        streaming: boolean on whether to build the cohort from bounded size chunks rather than materialising every ES hit in memory
+        two_phase: boolean on whether to select the most recent document per patient from metadata only and then fetch note text for the selected documents
+        queries: optional dictionary of labelled queries making up a union query, run concurrently instead of query when neither streaming nor two_phase
+        checkpoint_dir: optional directory for a resumable point in time retrieval (not used when streaming), its checkpoint files are removed once the cohort is packaged
+        optional kwargs flag for trust_site
+        '''
+        query = copy.deepcopy(query)
+        queries = copy.deepcopy(queries)
+        if "trust_site" in kwargs:
+            must_not_clauses = DocumentFilter.from_config(kwargs["trust_site"]).get_es_must_not_clauses()
+            query["query"]["bool"]["must_not"].extend(must_not_clauses)
+            if queries is not None:
+                for term_query in queries.values():
+                    term_query["query"]["bool"]["must_not"].extend(must_not_clauses)
+        
+        if streaming:
+            query["_source"] = self.config.es_config["cohort_source_fields"]
+            chunks = self.query_es_chunks(query, index, chunk_size=self.config.es_config["stream_chunk_size"])
+            cohort = self.package_cohort_stream(chunks, **kwargs)
+        elif two_phase:
+            query = self.construct_metadata_query(query, kwargs.get("trust_site"))
+            if checkpoint_dir is not None:
+                es_response = self.query_es_pit(query, index, checkpoint_dir)
+            else:
+                es_response = self.query_es(query, index, n_slices=self.config.es_config["scroll_slices"])
+            cohort = self.package_metadata_cohort(es_response, **kwargs)
+            cohort = self.fetch_notetext(cohort, batch_size=self.config.es_config["mget_batch_size"], n_workers=self.config.es_config["mget_workers"])
+            if checkpoint_dir is not None:
+                self.clear_checkpoint(checkpoint_dir)
+        else:
+            if checkpoint_dir is not None:
+                es_response = self.query_es_pit(query, index, checkpoint_dir)
+            elif queries is not None:
+                es_response = self.query_es_multi(queries, index)
+            else:
+                es_response = self.query_es(query, index, n_slices=self.config.es_config["scroll_slices"])
+            
+            if "trust_site" in kwargs:
+                cohort = self.package_cohort(es_response, trust_site = kwargs["trust_site"])
+            else:
+                cohort = self.package_cohort(es_response)
+            if checkpoint_dir is not None:
+                self.clear_checkpoint(checkpoint_dir)
+        
+        return cohort
+    
+    def get_watermark(self, cohort):
+        '''
+        Given a packaged cohort, return the raw encounterdate value of the most recent document, for use as the lower bound of an incremental refresh
+        cohort: pandas dataframe containining target cohort with an encounterdate_dt column
+        '''
+        return cohort.loc[cohort["encounterdate_dt"].idxmax(), "encounterdate"]
+    
+    def save_cohort(self, cohort, cohort_path, **kwargs):
+        '''
+        Persist a packaged cohort to parquet together with a json sidecar holding the encounterdate watermark and the query settings it was built with
+        cohort: pandas dataframe containining target cohort
+        cohort_path: filepath for the parquet file, the watermark is saved to cohort_path + ".json"
+        optional kwargs with query settings to record (e.g. search_term, index, trust_site)
+        '''
+        cohort.reset_index(drop=True).to_parquet(cohort_path, index=False)
+        
+        cohort_metadata = dict(kwargs)
+        cohort_metadata["watermark"] = str(self.get_watermark(cohort))
+        cohort_metadata["n_documents"] = len(cohort)
+        cohort_metadata["saved_at"] = datetime.now().isoformat()
+        with open(cohort_path + ".json", "w") as f:
+            json.dump(cohort_metadata, f, indent=2)
+    
+    def load_cohort(self, cohort_path):
+        '''
+        Load a cohort persisted with save_cohort and return the cohort and its metadata (including the watermark)
+        cohort_path: filepath for the parquet file
+        '''
+        cohort = pd.read_parquet(cohort_path)
+        with open(cohort_path + ".json") as f:
+            cohort_metadata = json.load(f)
+        
+        return cohort, cohort_metadata
+    
+    def construct_watermark_query(self, search_term, watermark, batch_size=10000):
+        '''
+        Return the cohort query restricted to documents with an encounterdate at or after the watermark
+        search_term: a string term to conduct text search with, or a list of terms and/or structured ES search queries whose results are unioned
+        watermark: raw encounterdate value of the most recent document in the stored cohort
+        batch_size: an integer for the number of documents to be processed in each batch of scroll API
+        '''
+        if isinstance(search_term, list):
+            _, query = self.construct_queries(search_term, batch_size)
+        else:
+            query = self.construct_query(search_term, batch_size)
+        #gte rather than gt so documents ingested late with the watermark date are not missed, duplicates are removed on clinicalnotekey in refresh_cohort
+        query["query"]["bool"]["filter"].append({"range": {"encounterdate": {"gte": watermark}}})
+        
+        return query
+    
+    def count_since_watermark(self, search_term, watermark, index, batch_size=10000):
+        '''
+        Return the number of documents matching the cohort query with an encounterdate at or after the watermark
+        search_term: a string term to conduct text search with, or a list of terms and/or structured ES search queries whose results are unioned
+        watermark: raw encounterdate value of the most recent document in the stored cohort, or None to count every matching document
+        index: a string with the ES index hosting target documents
+        batch_size: an integer for the number of documents to be processed in each batch of scroll API
+        '''
+        if watermark is None:
+            if isinstance(search_term, list):
+                _, query = self.construct_queries(search_term, batch_size)
+            else:
+                query = self.construct_query(search_term, batch_size)
+        else:
+            query = self.construct_watermark_query(search_term, watermark, batch_size)
+        
+        return self.conn.call_with_backoff(self.es.count, index=index, body={"query": query["query"]})["count"]
+    
+    def refresh_cohort(self, search_term, cohort_path, index="nifi_epic_raw_notes", batch_size=10000, streaming=False, two_phase=False, **kwargs):
+        '''
+        Top level convenience function for incremental cohort builds. If no cohort is stored at cohort_path a full cohort is built and saved, otherwise only documents with an encounterdate at or after the stored watermark are retrieved, merged into the stored cohort with one document per patient and saved.
+        The watermark is the most recent encounterdate in the stored cohort, not the ES ingest time, so notes ingested late with an encounterdate before the watermark are not picked up by a refresh (a full build is needed for those).
+        The number of matching documents at or after the lower bound of each retrieval is counted before retrieving and saved with the cohort, and the next refresh returns the stored cohort without retrieving anything when that count has not changed.
+        Documents ingested while a build or refresh runs are retrieved or not, but are never in the saved count, so they make the next refresh retrieve rather than being missed
+        search_term: a string term to conduct text search with, or a list of terms and/or structured ES search queries whose results are unioned
+        cohort_path: filepath for the stored parquet cohort
+        index: a string with the ES index hosting target documents
+        batch_size: an integer for the number of documents to be processed in each batch of scroll API (should not require altering)
+        streaming: boolean on whether to build the cohort from bounded size chunks
+        two_phase: boolean on whether to use the two-phase metadata then note text retrieval
+        optional kwargs flag for trust_site
+        '''
+        if not os.path.exists(cohort_path):
+            print("No stored cohort found at", cohort_path, "- building full cohort")
+            watermark_count = self.count_since_watermark(search_term, None, index, batch_size)
+            cohort = self.build_cohort(search_term, index, batch_size, streaming=streaming, two_phase=two_phase, **kwargs)
+            self.save_cohort(cohort, cohort_path, search_term=search_term, index=index, count_watermark=None, watermark_count=watermark_count, **kwargs)
+            return cohort
+        
+        start = time.time()
+        print("Starting incremental cohort refresh at: ", datetime.fromtimestamp(start))
+        
+        stored_cohort, cohort_metadata = self.load_cohort(cohort_path)
+        watermark = cohort_metadata["watermark"]
+        print("Stored cohort size:", len(stored_cohort), "watermark:", watermark)
+        
+        #the saved count is for the lower bound of the last retrieval, which is at or before the watermark, so an unchanged count means nothing new at or after the watermark
+        count_watermark = cohort_metadata.get("count_watermark", watermark)
+        n_since_watermark = self.count_since_watermark(search_term, count_watermark, index, batch_size)
+        print("Number of documents at or after", count_watermark, ":", n_since_watermark, "at last build:", cohort_metadata.get("watermark_count"))
+        if n_since_watermark == cohort_metadata.get("watermark_count"):
+            print("No new documents since the last build")
+            return stored_cohort
+        
+        watermark_count = n_since_watermark
+        if count_watermark != watermark:
+            watermark_count = self.count_since_watermark(search_term, watermark, index, batch_size)
+        
+        query = self.construct_watermark_query(search_term, watermark, batch_size)
+        new_cohort = self.retrieve_cohort(query, index, streaming=streaming, two_phase=two_phase, **kwargs)
+        
+        cohort = pd.concat([stored_cohort, new_cohort], ignore_index=True)
+        cohort = cohort.drop_duplicates(subset="clinicalnotekey", keep="last")
+        cohort = self.select_most_recent_patient_doc(cohort)
+        
+        self.save_cohort(cohort, cohort_path, search_term=search_term, index=index, count_watermark=watermark, watermark_count=watermark_count, **kwargs)
+        self.get_cohort_size(cohort)
+        
+        end = time.time()
+        print("Cohort refresh finished at: ", datetime.fromtimestamp(end))
+        print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
+        return cohort
+    
     #NOTE - legacy function when was combining cohorts from different ES indices, should not be required
     def combine_cohorts(self, cohorts):
         '''
@@ -0,0 +1,128 @@
+import pandas as pd
+import hashlib
+import json
+import os
+
+class CohortCache:
+    '''
+    On-disk cache of packaged cohorts stored as parquet files.
+    Entries are keyed by a fingerprint of the query body, index, trust site and retrieval mode plus the ES document count and most recent encounterdate for the query,
+    so a cached cohort is only reused while the matching documents in the index are unchanged. The least recently used entries are evicted once the cache exceeds max_bytes
+    '''
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        '''
+        cache_dir: directory to store cached cohorts in
+        max_bytes: integer for the maximum total size of cached cohorts in bytes
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_index_state(self, es, query, index):
+        '''
+        Cheaply fingerprint the documents matching a query with a single size 0 search returning the document count and most recent encounterdate
+        es: Elasticsearch client
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        '''
+        body = {"size": 0,
+                "track_total_hits": True,
+                "query": query["query"],
+                "aggs": {"max_encounterdate": {"max": {"field": "encounterdate"}}}}
+        res = es.search(index=index, body=body)
+
+        total = res["hits"]["total"]
+        doc_count = total["value"] if isinstance(total, dict) else total
+
+        return {"doc_count": doc_count, "max_encounterdate": res["aggregations"]["max_encounterdate"].get("value_as_string", res["aggregations"]["max_encounterdate"]["value"])}
+
+    def get_key(self, query, index, trust_site, index_state, document_filters=None, retrieval=None):
+        '''
+        Return the cache key for a query, index, trust site, index state and retrieval mode
+        query: an array containing a structured ES search query
+        index: an ES index that hosts target documents
+        trust_site: string for the trust the cohort was extracted from, or None
+        index_state: dictionary returned by get_index_state
+        document_filters: optional list of trust specific document filter rules applied to the cohort
+        retrieval: optional dictionary of the retrieval mode settings that change the cohort's columns (streaming, two_phase and the _source fields they retrieve)
+        '''
+        fingerprint = json.dumps({"query": query, "index": index, "trust_site": trust_site, "index_state": index_state, "document_filters": document_filters, "retrieval": retrieval}, sort_keys=True, default=str)
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        '''
+        Return the parquet filepath for a cache key
+        key: cache key from get_key
+        '''
+        return os.path.join(self.cache_dir, key + ".parquet")
+
+    def get(self, key):
+        '''
+        Return the cached cohort for a key as a pandas dataframe, or None on a cache miss
+        key: cache key from get_key
+        '''
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            print("Cohort cache miss:", key)
+            return None
+
+        print("Cohort cache hit:", key)
+        #touch the entry so eviction is least recently used
+        os.utime(path, None)
+        return pd.read_parquet(path)
+
+    def put(self, key, cohort):
+        '''
+        Store a cohort in the cache under key and evict least recently used entries if the cache exceeds max_bytes
+        key: cache key from get_key
+        cohort: pandas dataframe containining target cohort
+        '''
+        path = self.get_path(key)
+        tmp_path = path + ".tmp"
+        cohort.reset_index(drop=True).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def list_entries(self):
+        '''
+        Return the cache entries as a list of (path, size in bytes, last access time) sorted from least to most recently used
+        '''
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".parquet"):
+                path = os.path.join(self.cache_dir, filename)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the total cache size is within max_bytes
+        '''
+        entries = self.list_entries()
+        total_bytes = sum([entry[1] for entry in entries])
+
+        for path, size, _ in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            print("Evicting cached cohort:", path)
+            os.remove(path)
+            total_bytes -= size
+
+    def invalidate(self, key=None):
+        '''
+        Remove a single cache entry, or every entry if key is None
+        key: optional cache key from get_key
+        '''
+        if key is not None:
+            paths = [self.get_path(key)]
+        else:
+            paths = [entry[0] for entry in self.list_entries()]
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        print("Invalidated %s cached cohorts" % len(paths))
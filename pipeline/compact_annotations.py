@@ -0,0 +1,246 @@
+import numpy as np
+import array
+import pickle
+import zlib
+import json
+from pipeline.annotation_checkpoint import to_json_value
+
+class CompactAnnotations:
+    '''
+    Columnar store for an annotated cohort. Each annotation is a row of parallel numpy arrays (doc index, interned cui id, negated flag, confidence, start, end)
+    with a string table for cuis, and document metadata is held in per document columns. The full MedCAT entity dictionaries are either kept zlib compressed
+    per document and only decompressed when requested, or not stored and fetched on demand through a detail_loader, so the store takes a fraction of the memory of the list of dictionaries structure.
+    Iterating yields documents in the dictionary structure -> {"pat_metadata":{}, "doc_metadata":{}, "annotations":[]} so existing consumers keep working
+    '''
+    #negated flag values, NEGATED_UNKNOWN is used for annotations without a Negated meta annotation
+    NOT_NEGATED = 0
+    NEGATED = 1
+    NEGATED_UNKNOWN = -1
+
+    def __init__(self, store_detail=False, detail_loader=None):
+        '''
+        store_detail: boolean on whether to keep the full entity dictionaries (compressed) for lazy access, otherwise only the compact fields are kept
+        detail_loader: optional function returning the full entity dictionaries for a note id, used by get_detail when they are not stored
+        '''
+        self.store_detail = store_detail
+        self.detail_loader = detail_loader
+
+        self.cui_table = []
+        self.cui_to_id = {}
+
+        #annotation columns, grown with array.array and converted to numpy by finalize
+        self.columns = {"doc_idx": array.array("i"),
+                        "cui_id": array.array("i"),
+                        "negated": array.array("b"),
+                        "confidence": array.array("f"),
+                        "start": array.array("i"),
+                        "end": array.array("i")}
+
+        #document columns
+        self.note_ids = []
+        self.pat_ids = []
+        self.encounter_dates = []
+        self.ages = array.array("d")
+        self.females = array.array("b")
+        self.details = []
+
+        self.arrays = None
+        self.doc_offsets = None
+
+    @classmethod
+    def from_docs(cls, annotated_cohort, store_detail=False, detail_loader=None):
+        '''
+        Build a compact store from an annotated cohort in dictionary structure
+        annotated_cohort: iterable of annotated documents -> [{"pat_metadata":[], "doc_metadata":[], "annotations":[]}]
+        store_detail: boolean on whether to keep the full entity dictionaries (compressed) for lazy access
+        detail_loader: optional function returning the full entity dictionaries for a note id, used by get_detail when they are not stored
+        '''
+        compact = cls(store_detail, detail_loader)
+        for doc in annotated_cohort:
+            compact.add_doc(doc["pat_metadata"], doc["doc_metadata"], doc["annotations"])
+
+        return compact.finalize()
+
+    def get_cui_id(self, cui):
+        '''
+        Return the interned integer id for a cui, adding it to the string table if new
+        cui: cui string
+        '''
+        cui_id = self.cui_to_id.get(cui)
+        if cui_id is None:
+            cui_id = len(self.cui_table)
+            self.cui_to_id[cui] = cui_id
+            self.cui_table.append(cui)
+
+        return cui_id
+
+    def get_negated_flag(self, ann):
+        '''
+        Return the negated flag for a MedCAT annotation from its Negated meta annotation
+        ann: annotation dictionary
+        '''
+        value = ann.get("meta_anns", {}).get("Negated", {}).get("value")
+        if value == "No":
+            return self.NOT_NEGATED
+        elif value == "Yes":
+            return self.NEGATED
+
+        return self.NEGATED_UNKNOWN
+
+    def add_doc(self, pat_metadata, doc_metadata, annotations):
+        '''
+        Append an annotated document to the store
+        pat_metadata: patient metadata dictionary with pat_id, age and female
+        doc_metadata: document metadata dictionary with note_id and encounter_date
+        annotations: list of annotation dictionaries for the document
+        '''
+        doc_idx = len(self.note_ids)
+
+        for ann in annotations:
+            self.columns["doc_idx"].append(doc_idx)
+            self.columns["cui_id"].append(self.get_cui_id(ann["cui"]))
+            self.columns["negated"].append(self.get_negated_flag(ann))
+            #MedCAT sets acc to None for entities it has no confidence for
+            acc = ann.get("acc")
+            self.columns["confidence"].append(float(acc) if acc is not None else np.nan)
+            self.columns["start"].append(int(ann.get("start", -1)))
+            self.columns["end"].append(int(ann.get("end", -1)))
+
+        self.note_ids.append(doc_metadata["note_id"])
+        self.encounter_dates.append(doc_metadata["encounter_date"])
+        self.pat_ids.append(pat_metadata["pat_id"])
+        self.ages.append(float(pat_metadata["age"]))
+        self.females.append(int(pat_metadata["female"]))
+
+        if self.store_detail:
+            self.details.append(zlib.compress(pickle.dumps(annotations, protocol=pickle.HIGHEST_PROTOCOL)))
+
+        self.arrays = None
+
+    def finalize(self):
+        '''
+        Convert the annotation columns to numpy arrays and index the annotations of each document, called automatically before the arrays are read
+        '''
+        self.arrays = {name: np.frombuffer(column, dtype=column.typecode).copy() if len(column) > 0 else np.array([], dtype=column.typecode) for name, column in self.columns.items()}
+        #annotations are appended in document order, so the annotations of document i are rows doc_offsets[i]:doc_offsets[i + 1]
+        self.doc_offsets = np.searchsorted(self.arrays["doc_idx"], np.arange(len(self.note_ids) + 1))
+
+        return self
+
+    def get_arrays(self):
+        '''
+        Return the annotation columns as a dictionary of numpy arrays
+        '''
+        if self.arrays is None:
+            self.finalize()
+
+        return self.arrays
+
+    def get_annotations(self, doc_idx):
+        '''
+        Return the annotation dictionaries for a document, decompressing the full entity detail when stored,
+        otherwise rebuilding the compact fields in the MedCAT annotation structure
+        doc_idx: integer index of the document in the store
+        '''
+        if self.store_detail:
+            return self.get_detail(doc_idx)
+
+        arrays = self.get_arrays()
+        negated_values = {self.NOT_NEGATED: "No", self.NEGATED: "Yes"}
+        annotations = []
+        for row in range(self.doc_offsets[doc_idx], self.doc_offsets[doc_idx + 1]):
+            ann = {"cui": self.cui_table[arrays["cui_id"][row]],
+                   "acc": float(arrays["confidence"][row]),
+                   "start": int(arrays["start"][row]),
+                   "end": int(arrays["end"][row]),
+                   "meta_anns": {}}
+            negated = int(arrays["negated"][row])
+            if negated in negated_values:
+                ann["meta_anns"]["Negated"] = {"name": "Negated", "value": negated_values[negated]}
+            annotations.append(ann)
+
+        return annotations
+
+    def get_detail(self, doc_idx):
+        '''
+        Return the full entity dictionaries for a document, decompressed when stored, otherwise fetched on demand with detail_loader
+        doc_idx: integer index of the document in the store
+        '''
+        if self.store_detail:
+            return pickle.loads(zlib.decompress(self.details[doc_idx]))
+
+        if self.detail_loader is None:
+            raise ValueError("Entity detail is not stored for the annotated cohort and no detail_loader is set")
+
+        return self.detail_loader(self.note_ids[doc_idx])
+
+    def get_doc(self, doc_idx):
+        '''
+        Return a document in the annotated cohort dictionary structure
+        doc_idx: integer index of the document in the store
+        '''
+        return {"pat_metadata": {"pat_id": self.pat_ids[doc_idx], "age": self.ages[doc_idx], "female": self.females[doc_idx]},
+                "doc_metadata": {"note_id": self.note_ids[doc_idx], "encounter_date": self.encounter_dates[doc_idx]},
+                "annotations": self.get_annotations(doc_idx)}
+
+    def __len__(self):
+        return len(self.note_ids)
+
+    def __iter__(self):
+        for doc_idx in range(len(self.note_ids)):
+            yield self.get_doc(doc_idx)
+
+    def get_nbytes(self):
+        '''
+        Return the approximate memory used by the annotation arrays and compressed detail in bytes
+        '''
+        arrays = self.get_arrays()
+        return sum([a.nbytes for a in arrays.values()]) + sum([len(detail) for detail in self.details])
+
+    def save(self, path):
+        '''
+        Save the store to a single npz file
+        path: filepath for the npz file
+        '''
+        arrays = self.get_arrays()
+        detail_lengths = np.array([len(detail) for detail in self.details], dtype=np.int64)
+        metadata = {"cui_table": self.cui_table,
+                    "note_ids": self.note_ids,
+                    "pat_ids": self.pat_ids,
+                    "encounter_dates": self.encounter_dates,
+                    "store_detail": self.store_detail}
+
+        np.savez(path,
+                 metadata=np.frombuffer(json.dumps(metadata, default=to_json_value).encode("utf-8"), dtype=np.uint8),
+                 ages=np.frombuffer(self.ages, dtype="d"),
+                 females=np.frombuffer(self.females, dtype="b"),
+                 detail_lengths=detail_lengths,
+                 details=np.frombuffer(b"".join(self.details), dtype=np.uint8),
+                 **arrays)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a store saved with save
+        path: filepath of the npz file
+        '''
+        data = np.load(path)
+        metadata = json.loads(data["metadata"].tobytes().decode("utf-8"))
+
+        compact = cls(metadata["store_detail"])
+        compact.cui_table = metadata["cui_table"]
+        compact.cui_to_id = {cui: cui_id for cui_id, cui in enumerate(compact.cui_table)}
+        compact.note_ids = metadata["note_ids"]
+        compact.pat_ids = metadata["pat_ids"]
+        compact.encounter_dates = metadata["encounter_dates"]
+        compact.ages = array.array("d", data["ages"].tobytes())
+        compact.females = array.array("b", data["females"].tobytes())
+
+        details = data["details"].tobytes()
+        offsets = np.concatenate([[0], np.cumsum(data["detail_lengths"])])
+        compact.details = [details[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+        for name in compact.columns:
+            compact.columns[name] = array.array(compact.columns[name].typecode, data[name].tobytes())
+
+        return compact.finalize()
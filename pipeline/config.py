@@ -6,12 +6,55 @@ class Config():
             #for use in cohort builder module
             
             #UCLH - gae02 (Pre-EPIC)
-            "es_url": "xxx",
+            #list of ES node urls, requests are distributed round-robin across the nodes
+            "es_hosts": ["xxx"],
             "es_user": "xxx",
             "es_password": "xxx",
             
+            #ES connection settings - sniff discovers the remaining cluster nodes, retries back off exponentially from es_retry_backoff_s
+            "es_sniff": False,
+            "es_http_compress": True,
+            "es_timeout_s": 120,
+            "es_max_retries": 3,
+            "es_retry_backoff_s": 2,
+            "es_connections_per_node": 10,
+            
             #csv with date of birth and gender that could not be ingested into cogstack due to ethics
-            "non_es_demographics_path": "./pipeline/cohort_metadata/xxx.csv"
+            "non_es_demographics_path": "./pipeline/cohort_metadata/xxx.csv",
+            #parquet lookup built from the demographics csv with DemographicsProvider.build_lookup (used while newer than the csv) and csv rows read at a time without it
+            "demographics_lookup_path": "./pipeline/cohort_metadata/demographics.parquet",
+            "demographics_chunk_size": 500000,
+            
+            #for use in streaming cohort build - _source fields retrieved from ES and number of documents held in memory per chunk
+            "cohort_source_fields": ["clinicalnotekey", "patientprimarymrn", "encounterdate", "notetext"],
+            "stream_chunk_size": 10000,
+            
+            #number of sliced scrolls (and parallel workers) used to retrieve the cohort, 1 uses a single scroll
+            "scroll_slices": 1,
+            
+            #sort used to paginate resumable point in time retrieval - sorting on a unique document field lets a build resume after the point in time has expired,
+            #[{"_shard_doc": "asc"}] (ES >= 7.12) is cheaper but its cursor cannot outlive the point in time, so a build resumed after keep_alive restarts from zero
+            "pit_sort": [{"clinicalnotekey": "asc"}],
+            
+            #for use in two-phase cohort build - metadata fields retrieved in phase one, documents per mget request and concurrent mget requests in phase two
+            "cohort_metadata_fields": ["clinicalnotekey", "patientprimarymrn", "encounterdate"],
+            "mget_batch_size": 1000,
+            "mget_workers": 4,
+            
+            #trust specific filters for invalid discharge summaries that can only be identified from the free text note
+            #rule types: "prefix" (first `length` characters stripped equal `text`), "substring" (note contains `text`), "regex" (note matches `pattern`)
+            #"es_pushdown": True adds a substring rule to the ES query as a must_not phrase match so excluded documents are never transferred
+            "document_filters": {
+                "UCLH": [
+                    {"name": "invalid_stroke_ds", "type": "prefix", "text": "Please", "length": 7},
+                    {"name": "invalid_emergency_ds", "type": "prefix", "text": "Discharge Summary (Emergency Department)", "length": 41},
+                    {"name": "invalid_cc_ds", "type": "substring", "text": "UCH Critical Care Discharge Summary", "es_pushdown": False}
+                ]
+            },
+            
+            #for use in cohort cache - directory for cached cohorts and maximum total size before least recently used cohorts are evicted
+            "cohort_cache_dir": "./cohort_cache",
+            "cohort_cache_max_bytes": 10 * 1024 ** 3
             
         }
         
@@ -19,7 +62,78 @@ class Config():
             #for use in annotation module
             "cdb_path": "./pipeline/annotation_models/xxx.dat",
             "vocab_path": "./pipeline/annotation_models/xxx.dat",
-            "meta_path": "./pipeline/annotation_models/xxx/"
+            "meta_path": "./pipeline/annotation_models/xxx/",
+            
+            #directory for the compiled CDB / vocab snapshot written by Annotator.compile_model_snapshot (None always loads the model files)
+            #and whether the model is only loaded when the first document is annotated
+            "model_snapshot_dir": "./pipeline/annotation_models/snapshot/",
+            "lazy_load_model": True,
+            
+            #MedCAT accuracy settings
+            "min_acc": 0.3,
+            "min_acc_th": 0.3,
+            "min_concept_length": 2,
+            
+            #persistent annotation cache keyed by note text hash and model fingerprint (None disables) and maximum size before least recently used entries are evicted
+            "annotation_cache_path": "./annotation_cache.sqlite",
+            "annotation_cache_max_bytes": 5 * 1024 ** 3,
+            
+            #parallel annotation - number of worker processes (1 annotates in the main process), documents per batch sent to a worker,
+            #batches in flight at once and torch / OpenMP threads per worker (n_workers * threads_per_worker should not exceed the cores available)
+            "n_workers": 1,
+            "annotation_batch_size": 32,
+            "max_in_flight_batches": 8,
+            "threads_per_worker": 1,
+            
+            #resource governor - memory ceiling for the pipeline and its workers in GB (None is 90% of the machine), available memory in GB below which
+            #batch size and batches in flight are halved and above which they grow, fraction of the ceiling at which annotated documents are spilled to spill_dir,
+            #batch size bounds and seconds between samples
+            "memory_ceiling_gb": None,
+            "min_available_gb": 2,
+            "headroom_available_gb": 8,
+            "spill_fraction": 0.85,
+            "spill_dir": "./annotation_spill",
+            "min_annotation_batch_size": 4,
+            "max_annotation_batch_size": 256,
+            "governor_interval_s": 5,
+            
+            #annotation checkpoints - directory for append-only shards of annotated documents (None keeps the annotated cohort in memory) and documents per shard
+            "annotation_checkpoint_dir": None,
+            "checkpoint_flush_every": 1000,
+            
+            #return the annotated cohort as a CompactAnnotations columnar store and whether it keeps the full (compressed) MedCAT entity detail,
+            #without it the detail of a document is fetched on demand (from the annotation cache, or by annotating the note again)
+            "compact_annotations": False,
+            "compact_store_detail": False,
+            
+            #notes longer than max_chunk_chars are split on section / line / sentence boundaries and annotated in chunks (None disables, e.g. 20000),
+            #chunks split mid sentence overlap by chunk_overlap_chars so entities on the split are not lost. Chunked notes can be annotated slightly differently near chunk edges
+            "max_chunk_chars": None,
+            "chunk_overlap_chars": 200,
+            
+            #per document annotation timeout in seconds (None disables), jsonl file for timed out / failed documents,
+            #and the relaxed chunk size and timeout used by Annotator.retry_quarantined
+            "doc_timeout_s": 300,
+            "quarantine_filepath": "./annotation_quarantine.jsonl",
+            "retry_max_chunk_chars": 5000,
+            "retry_timeout_s": 1200,
+            
+            #paragraph reuse - annotate notes paragraph by paragraph, reusing annotations of paragraphs repeated word for word (e.g. template boilerplate),
+            #and the maximum number of paragraphs cached per process
+            "paragraph_reuse": False,
+            "paragraph_cache_size": 100000,
+            
+            #tokenised doc cache - directory for DocBin shards of tokenised / tagged spacy docs (None disables), so reruns with a new CDB or thresholds only redo
+            #the pipes from docbin_resume_pipe onwards (MedCAT concept linking and MetaCAT), and the number of docs per shard
+            "docbin_cache_dir": None,
+            "docbin_resume_pipe": "cat",
+            "docbin_shard_size": 1000
+        }
+        
+        self.dictionary_config = {
+            #for use in the Dictionary annotation mode - words before / after an entity searched for negation triggers and minimum term length in characters
+            "negation_window_words": 5,
+            "min_term_length": 3
         }
         
         self.codelists_config = {
@@ -42,6 +156,22 @@ class Config():
             "cohort_raw_table_filepath": "cohort_raw_table_xxx.csv",
             "cohort_summary_table_filepath": "cohort_summary_table_xxx.csv",
             "prescribing_trends_filepath": "prescribing_trends_xxx.png",
-            "factor_plot_filepath": "factor_plot_xxx.png"
+            "factor_plot_filepath": "factor_plot_xxx.png",
+            
+            #for use in result sink - ES index for per-document annotations and scores (None disables write-back) and jsonl file for documents that could not be indexed
+            "results_index": None,
+            "results_dead_letter_filepath": "results_dead_letter_xxx.jsonl",
+            #parallel bulk settings - at most (thread_count + queue_size) chunks are in flight, transient failures are retried with exponential backoff
+            "results_bulk_thread_count": 4,
+            "results_bulk_chunk_size": 500,
+            "results_bulk_queue_size": 4,
+            "results_bulk_max_retries": 3,
+            "results_bulk_retry_backoff_s": 2,
+            
+            #annotation telemetry - JSON metrics, Prometheus textfile and top N slowest documents report (None disables each output)
+            "annotation_metrics_filepath": "annotation_metrics_xxx.json",
+            "annotation_metrics_prom_filepath": "annotation_metrics_xxx.prom",
+            "slowest_docs_filepath": "slowest_docs_xxx.csv",
+            "slowest_docs_top_n": 50
         }
         
\ No newline at end of file
@@ -0,0 +1,99 @@
+import pandas as pd
+import numpy as np
+import os
+import time
+
+class DemographicsProvider:
+    '''
+    Provides date of birth and gender for the patients in a cohort from the trust wide demographics csv.
+    Only the needed columns are read with compact dtypes and parsed dates, and the metadata is filtered to the cohort's mrns before the join,
+    either by pushing the mrn filter down into a pre-built parquet lookup file or by filtering the csv chunk by chunk
+    '''
+    #columns read from the demographics csv
+    COLUMNS = ["primary_mrn", "date_of_birth", "gender"]
+
+    def __init__(self, metadata_csv_file, lookup_path=None, chunk_size=500000):
+        '''
+        metadata_csv_file: filepath with fields primary_mrn, date_of_birth and gender
+        lookup_path: optional filepath for a parquet lookup built from the csv with build_lookup, used when it is newer than the csv
+        chunk_size: number of csv rows read at a time when there is no lookup
+        '''
+        self.metadata_csv_file = metadata_csv_file
+        self.lookup_path = lookup_path
+        self.chunk_size = chunk_size
+
+    def read_csv_chunks(self):
+        '''
+        Yield the demographics csv in chunks with only the needed columns, gender as a category and date of birth parsed
+        '''
+        return pd.read_csv(self.metadata_csv_file, usecols=self.COLUMNS, dtype={"gender": "category"}, parse_dates=["date_of_birth"], chunksize=self.chunk_size)
+
+    def build_lookup(self):
+        '''
+        One time step, write the demographics csv as a parquet lookup sorted by mrn so later runs only read the row groups for the cohort's mrns
+        '''
+        start = time.time()
+        metadata = pd.concat(self.read_csv_chunks(), ignore_index=True)
+        metadata["gender"] = metadata["gender"].astype("category")
+        metadata = metadata.sort_values("primary_mrn").reset_index(drop=True)
+
+        metadata.to_parquet(self.lookup_path + ".tmp", index=False, row_group_size=self.chunk_size)
+        os.replace(self.lookup_path + ".tmp", self.lookup_path)
+        print("Built demographics lookup for %s patients in %s seconds" % (len(metadata), round(time.time() - start, 2)))
+
+    def is_lookup_fresh(self):
+        '''
+        Return whether the parquet lookup exists and is newer than the demographics csv
+        '''
+        if self.lookup_path is None or not os.path.exists(self.lookup_path):
+            return False
+
+        return os.path.getmtime(self.lookup_path) >= os.path.getmtime(self.metadata_csv_file)
+
+    def get_metadata(self, mrns):
+        '''
+        Return the demographics for a set of mrns
+        mrns: list of patient mrns in the cohort
+        '''
+        mrns = list(set(mrns))
+
+        if self.is_lookup_fresh():
+            return pd.read_parquet(self.lookup_path, engine="pyarrow", columns=self.COLUMNS, filters=[("primary_mrn", "in", mrns)])
+
+        chunks = [chunk[chunk["primary_mrn"].isin(mrns)] for chunk in self.read_csv_chunks()]
+        return pd.concat(chunks, ignore_index=True)
+
+    def add_demographics(self, cohort):
+        '''
+        Given a cohort (pre-annotation), join date of birth and gender for the cohort's patients and return the cohort after the demographic filters
+        (removes Na's from date of birth and gender, removes legacy dates out of time range, removes individuals with age < 18 years old) applied in a single pass
+        cohort: pandas dataframe of cohort extracted from CogStack
+        '''
+        start = time.time()
+        metadata = self.get_metadata(cohort["patientprimarymrn"])
+        print("Read demographics for %s patients in %s seconds" % (len(metadata), round(time.time() - start, 2)))
+
+        print("Cohort size prior to joining age and gender metadata", len(cohort))
+        cohort = cohort.merge(metadata, left_on="patientprimarymrn", right_on="primary_mrn", how="left")
+        print("Cohort size post joining age and gender metadata", len(cohort))
+
+        cohort["female"] = (cohort["gender"] == "Female").astype(int)
+        cohort["date_of_birth_dt"] = pd.to_datetime(cohort["date_of_birth"])
+        #365.2425 days is numpy's mean year, the same as dividing by np.timedelta64(1, 'Y') which newer pandas versions reject
+        cohort["age"] = (pd.to_datetime("today") - cohort["date_of_birth_dt"]) / np.timedelta64(1, 'D') / 365.2425
+        cohort["encounterdate_dt"] = pd.to_datetime(cohort["encounterdate"])
+
+        #check and remove na's, encounter dates outside of time range (01/01/2011 - 01/01/2019) and individuals under 18 years old
+        has_demographics = cohort["gender"].notna() & cohort["date_of_birth"].notna()
+        in_time_range = (cohort["encounterdate_dt"] >= pd.to_datetime('01/01/2011')) & (cohort["encounterdate_dt"] < pd.to_datetime('01/01/2019'))
+        is_adult = cohort["age"] >= 18
+
+        print("# missing dob or gender", (~has_demographics).sum())
+        print("# dates < 01/01/2011", (cohort["encounterdate_dt"] < pd.to_datetime('01/01/2011')).sum())
+        print("# dates > 01/01/2019", (cohort["encounterdate_dt"] > pd.to_datetime('01/01/2019')).sum())
+        print("# age < 18 years old", (has_demographics & ~is_adult).sum())
+
+        cohort = cohort[has_demographics & in_time_range & is_adult].reset_index(drop=True)
+        print("Cohort size for annotation", len(cohort))
+
+        return cohort
@@ -0,0 +1,198 @@
+import pandas as pd
+import collections
+import re
+import time
+
+#words and numbers, matched case insensitively on the original text so offsets stay in document coordinates
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+", re.IGNORECASE)
+#trailing parentheticals in SNOMED-CT terms, e.g. semantic tags "(disorder)" or suppliers "(Sigma Pharmaceuticals Plc)"
+TRAILING_PARENTHETICAL_PATTERN = re.compile(r"\s*\([^()]*\)\s*$")
+
+class AhoCorasick:
+    '''
+    Aho-Corasick automaton over token sequences, finds every occurrence of every pattern in a single pass over a document's tokens
+    '''
+    def __init__(self):
+        #goto transitions, failure links and outputs (pattern length in tokens, value) per state
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+    def add(self, tokens, value):
+        '''
+        Add a pattern
+        tokens: tuple of pattern tokens
+        value: value returned with each match of the pattern
+        '''
+        state = 0
+        for token in tokens:
+            next_state = self.goto[state].get(token)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][token] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+
+        self.outputs[state].append((len(tokens), value))
+
+    def build(self):
+        '''
+        Compute failure links breadth first, call once after all patterns are added
+        '''
+        queue = collections.deque(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state != 0 and token not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(token, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def iter_matches(self, tokens):
+        '''
+        Yield (first token index, last token index, value) for every pattern occurrence in a token sequence
+        tokens: list of tokens
+        '''
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for i, token in enumerate(tokens):
+            while state != 0 and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for length, value in outputs[state]:
+                yield i - length + 1, i, value
+
+class DictionaryAnnotator:
+    '''
+    Lightweight dictionary annotator for high throughput screening or as a fallback when the MedCAT models are not available.
+    Builds a token level Aho-Corasick automaton from the term columns of the codelists and emits entities in the MedCAT get_entities structure,
+    with a NegEx style Negated meta annotation from negation triggers within a window of words before or after the entity in the same sentence
+    '''
+    PRE_NEGATION_TRIGGERS = ["no", "not", "denies", "denied", "denying", "without", "never", "negative for", "no evidence of", "no history of",
+                             "no sign of", "no signs of", "free of", "absence of", "rules out", "ruled out", "rule out", "excluded", "nil"]
+    POST_NEGATION_TRIGGERS = ["ruled out", "was ruled out", "has been ruled out", "excluded", "unlikely", "is absent", "was absent", "not seen", "negative"]
+    #words and punctuation that end the scope of a negation trigger
+    TERMINATION_WORDS = set(["but", "however", "although", "though", "except", "apart", "aside", "which", "who"])
+    TERMINATION_CHARS = set(".;:\n?!")
+
+    def __init__(self, codelist_paths, negation_window_words=5, min_term_length=3):
+        '''
+        codelist_paths: list of codelist csv filepaths with cui and term columns
+        negation_window_words: number of words before and after an entity searched for negation triggers
+        min_term_length: terms shorter than this many characters are skipped
+        '''
+        start = time.time()
+        self.negation_window_words = negation_window_words
+        self.pre_negation_pattern = self.compile_triggers(self.PRE_NEGATION_TRIGGERS)
+        self.post_negation_pattern = self.compile_triggers(self.POST_NEGATION_TRIGGERS)
+
+        codelists = pd.concat([pd.read_csv(path, usecols=["cui", "term"]) for path in codelist_paths], ignore_index=True).dropna()
+
+        #each distinct normalised term is a pattern matching the set of cuis it is a term for
+        term_cuis = collections.OrderedDict()
+        for cui, term in zip(codelists["cui"], codelists["term"]):
+            tokens = self.normalise_term(term)
+            if len(" ".join(tokens)) < min_term_length:
+                continue
+            term_cuis.setdefault(tokens, collections.OrderedDict())[cui] = term
+
+        self.terms = []
+        self.automaton = AhoCorasick()
+        for tokens, cuis in term_cuis.items():
+            self.automaton.add(tokens, len(self.terms))
+            self.terms.append(list(cuis.items()))
+        self.automaton.build()
+
+        print("Built dictionary annotator with %s terms for %s cuis in %s seconds" % (len(self.terms), codelists["cui"].nunique(), round(time.time() - start, 2)))
+
+    def compile_triggers(self, triggers):
+        return re.compile(r"\b(" + "|".join([re.escape(trigger) for trigger in sorted(triggers, key=len, reverse=True)]) + r")\b")
+
+    def normalise_term(self, term):
+        '''
+        Return a codelist term as a tuple of lower case tokens with trailing parentheticals (semantic tags, suppliers) removed
+        term: codelist term
+        '''
+        term = str(term)
+        stripped = TRAILING_PARENTHETICAL_PATTERN.sub("", term)
+        while stripped != term and len(stripped) > 0:
+            term = stripped
+            stripped = TRAILING_PARENTHETICAL_PATTERN.sub("", term)
+
+        return tuple([token.lower() for token in TOKEN_PATTERN.findall(term)])
+
+    def tokenise(self, text):
+        '''
+        Return the lower case tokens of a text and their (start, end) character offsets
+        text: the document text
+        '''
+        matches = list(TOKEN_PATTERN.finditer(text))
+        return [m.group().lower() for m in matches], [(m.start(), m.end()) for m in matches]
+
+    def breaks_scope(self, text, offsets, tokens, i, j):
+        '''
+        Return whether the text between tokens i and j (i < j) contains a sentence terminator or token j is a termination word
+        '''
+        between = text[offsets[i][1]:offsets[j][0]]
+        return any([c in self.TERMINATION_CHARS for c in between]) or tokens[j] in self.TERMINATION_WORDS
+
+    def is_negated(self, text, tokens, offsets, first, last):
+        '''
+        Return whether the entity spanning tokens first to last is negated by a trigger within the negation window in the same sentence
+        text: the document text
+        tokens: document tokens
+        offsets: token character offsets
+        first: index of the entity's first token
+        last: index of the entity's last token
+        '''
+        pre_words = []
+        i = first - 1
+        while i >= 0 and len(pre_words) < self.negation_window_words and not self.breaks_scope(text, offsets, tokens, i, i + 1):
+            pre_words.insert(0, tokens[i])
+            i -= 1
+        if self.pre_negation_pattern.search(" ".join(pre_words)):
+            return True
+
+        post_words = []
+        i = last + 1
+        while i < len(tokens) and len(post_words) < self.negation_window_words and not self.breaks_scope(text, offsets, tokens, i - 1, i):
+            post_words.append(tokens[i])
+            i += 1
+        return self.post_negation_pattern.search(" ".join(post_words)) is not None
+
+    def get_entities(self, text):
+        '''
+        Annotate a text and return a list of entities in the MedCAT get_entities structure, overlapping matches are resolved to the longest leftmost match
+        text: the text to annotate
+        '''
+        tokens, offsets = self.tokenise(text)
+
+        matches = sorted(self.automaton.iter_matches(tokens), key=lambda match: (match[0], match[0] - match[1]))
+
+        entities = []
+        next_free_token = 0
+        for first, last, term_idx in matches:
+            if first < next_free_token:
+                continue
+            next_free_token = last + 1
+
+            start = offsets[first][0]
+            end = offsets[last][1]
+            negated = "Yes" if self.is_negated(text, tokens, offsets, first, last) else "No"
+            for cui, term in self.terms[term_idx]:
+                entities.append({"cui": cui,
+                                 "pretty_name": term,
+                                 "source_value": text[start:end],
+                                 "start": start,
+                                 "end": end,
+                                 "acc": 1.0,
+                                 "id": len(entities),
+                                 "meta_anns": {"Negated": {"name": "Negated", "value": negated, "confidence": 1.0}}})
+
+        return entities
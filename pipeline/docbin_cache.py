@@ -0,0 +1,160 @@
+import sqlite3
+import hashlib
+import collections
+import uuid
+import json
+import os
+from spacy.tokens import DocBin
+
+class DocBinCache:
+    '''
+    Sharded on-disk cache of tokenised and tagged spacy docs, stored as DocBin shards with a SQLite index of note text hash to (shard, position).
+    Docs are cached after the tokenisation / tagging pipes and before the first pipe that depends on annotation settings (MedCAT's "cat" pipe by default),
+    so changing MIN_ACC, MIN_ACC_TH, MIN_CONCEPT_LENGTH or the CDB only reruns concept linking and MetaCAT
+    '''
+    #token attributes kept in the shards, custom token extensions (e.g. MedCAT's skip flags) are kept with the doc user data
+    ATTRS = ["ORTH", "NORM", "LEMMA", "TAG", "POS", "HEAD", "DEP", "ENT_IOB", "ENT_TYPE"]
+
+    def __init__(self, cache_dir, vocab, pipeline_fingerprint, shard_size=1000, max_loaded_shards=2):
+        '''
+        cache_dir: directory for the shards and index
+        vocab: spacy vocab the cached docs are loaded into
+        pipeline_fingerprint: string identifying the cached pipes (spacy model and pipe names), docs from other pipelines are not reused
+        shard_size: number of docs per shard
+        max_loaded_shards: number of recently read shards kept in memory, consecutive notes are usually in the same shard
+        '''
+        self.cache_dir = cache_dir
+        self.vocab = vocab
+        self.pipeline_fingerprint = pipeline_fingerprint
+        self.shard_size = shard_size
+        self.max_loaded_shards = max_loaded_shards
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        #annotation workers share the index, so wait for each other's writes rather than failing on a locked database
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, shard TEXT, position INTEGER)")
+        self.db.commit()
+
+        #shard names are unique to this cache instance so workers sharing the cache directory never write the same file
+        self.shard_prefix = "shard_%s_%s" % (os.getpid(), uuid.uuid4().hex[:8])
+        self.n_shards_written = 0
+
+        self.pending = DocBin(attrs=self.ATTRS, store_user_data=True)
+        self.pending_keys = set()
+        self.pending_order = []
+        self.loaded_shards = collections.OrderedDict()
+
+    def get_key(self, text):
+        '''
+        Return the cache key for a note text under the current pipeline fingerprint
+        text: the note text
+        '''
+        return hashlib.sha256((self.pipeline_fingerprint + text).encode("utf-8")).hexdigest()
+
+    def load_shard(self, shard):
+        '''
+        Return the docs of a shard, reading it from disk if it is not one of the recently read shards
+        shard: shard filename
+        '''
+        if shard in self.loaded_shards:
+            self.loaded_shards.move_to_end(shard)
+            return self.loaded_shards[shard]
+
+        with open(os.path.join(self.cache_dir, shard), "rb") as f:
+            docs = list(DocBin(store_user_data=True).from_bytes(f.read()).get_docs(self.vocab))
+
+        self.loaded_shards[shard] = docs
+        if len(self.loaded_shards) > self.max_loaded_shards:
+            self.loaded_shards.popitem(last=False)
+
+        return docs
+
+    def get(self, text):
+        '''
+        Return the cached doc for a note text, or None on a cache miss. Each loaded doc is handed out once, as the remaining pipes modify it
+        text: the note text
+        '''
+        key = self.get_key(text)
+        row = None
+        if key not in self.pending_keys:
+            row = self.db.execute("SELECT shard, position FROM docs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        docs = self.load_shard(row[0])
+        doc = docs[row[1]]
+        if doc is None:
+            #already handed out, read a fresh copy of the shard
+            del self.loaded_shards[row[0]]
+            docs = self.load_shard(row[0])
+            doc = docs[row[1]]
+        docs[row[1]] = None
+
+        self.hits += 1
+        return doc
+
+    def put(self, text, doc):
+        '''
+        Add a tokenised doc to the current shard, writing the shard once it holds shard_size docs. The doc is serialised immediately so it can then be passed to the remaining pipes
+        text: the note text
+        doc: spacy doc after the cached pipes
+        '''
+        key = self.get_key(text)
+        if key in self.pending_keys:
+            return
+
+        self.pending.add(doc)
+        self.pending_keys.add(key)
+        self.pending_order.append(key)
+        if len(self.pending_order) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the current shard to disk and index its docs
+        '''
+        if len(self.pending_order) == 0:
+            return
+
+        shard = "%s_%05d.spacy" % (self.shard_prefix, self.n_shards_written)
+        path = os.path.join(self.cache_dir, shard)
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.pending.to_bytes())
+        os.replace(path + ".tmp", path)
+        self.n_shards_written += 1
+
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO docs (key, shard, position) VALUES (?, ?, ?)",
+                                [(key, shard, position) for position, key in enumerate(self.pending_order)])
+
+        self.pending = DocBin(attrs=self.ATTRS, store_user_data=True)
+        self.pending_keys = set()
+        self.pending_order = []
+
+    def get_stats(self):
+        '''
+        Return the cache hit / miss statistics for this run
+        '''
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+    def close(self):
+        '''
+        Write the current shard and close the index
+        '''
+        self.flush()
+        self.db.close()
+
+    @staticmethod
+    def get_pipeline_fingerprint(nlp, cached_pipe_names):
+        '''
+        Return a fingerprint of the spacy model and the pipes whose output is cached
+        nlp: spacy Language
+        cached_pipe_names: names of the pipes run before a doc is cached
+        '''
+        meta = getattr(nlp, "meta", {}) or {}
+        fingerprint = json.dumps({"model": meta.get("name"), "version": meta.get("version"), "pipes": cached_pipe_names}, sort_keys=True)
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
@@ -0,0 +1,145 @@
+import pipeline.config as config
+import numpy as np
+import re
+
+class DocumentFilter:
+    '''
+    Declarative, trust specific filter for invalid documents which can only be identified from the free text note.
+    Rules are loaded from config and evaluated in a single pass over the note text column:
+    - "prefix": the first `length` characters of the note, stripped of whitespace, equal `text`
+    - "substring": the note contains `text`
+    - "regex": the note matches the regular expression `pattern`
+    Rules with "es_pushdown" set are also added to the ES query as must_not clauses so excluded documents are not transferred
+    '''
+    RULE_TYPES = ["prefix", "substring", "regex"]
+
+    def __init__(self, rules):
+        '''
+        rules: list of rule dictionaries with keys name, type and text (prefix and substring), length (prefix) or pattern (regex)
+        '''
+        for rule in rules:
+            if rule["type"] not in self.RULE_TYPES:
+                raise ValueError("Unknown document filter rule type: %s" % rule["type"])
+
+        self.rules = rules
+        self.compiled_patterns = {rule["name"]: re.compile(rule["pattern"]) for rule in rules if rule["type"] == "regex"}
+
+    @classmethod
+    def from_config(cls, trust_site):
+        '''
+        Build the document filter for a trust site from the rules in config, trusts without rules get an empty filter
+        trust_site: string for the trust the cohort was extracted from (e.g. "UCLH")
+        '''
+        return cls(config.Config().es_config["document_filters"].get(trust_site, []))
+
+    def get_rule_names(self):
+        '''
+        Return the names of the flag columns added by flag_invalid_docs
+        '''
+        return [rule["name"] for rule in self.rules]
+
+    def get_prefix_length(self):
+        '''
+        Return the number of leading note text characters needed to evaluate the prefix rules
+        '''
+        return max([rule["length"] for rule in self.rules if rule["type"] == "prefix"] + [0])
+
+    def flag_rule(self, rule, notetext):
+        '''
+        Given a rule and a pandas series of note text return a boolean series flagging documents matched by the rule
+        rule: rule dictionary
+        notetext: pandas series of note text (or of note text prefixes for prefix rules)
+        '''
+        notetext = notetext.fillna("")
+
+        if rule["type"] == "prefix":
+            return notetext.str.slice(0, rule["length"]).str.strip() == rule["text"]
+        elif rule["type"] == "substring":
+            return notetext.str.contains(rule["text"], regex=False)
+        else:
+            return notetext.str.contains(self.compiled_patterns[rule["name"]])
+
+    def flag_text_rules(self, notetext):
+        '''
+        Given a pandas series of note text return a dictionary of rule name to boolean array for the substring and regex rules, evaluated together note by note
+        so each note is read once while it is in cache rather than once per rule. Rules are searched separately within a note, as python's re is much slower
+        on one alternation of the rules than on each literal or pattern on its own
+        notetext: pandas series of note text
+        '''
+        text_rules = [rule for rule in self.rules if rule["type"] != "prefix"]
+        substrings = [(rule["name"], rule["text"]) for rule in text_rules if rule["type"] == "substring"]
+        patterns = [(rule["name"], self.compiled_patterns[rule["name"]]) for rule in text_rules if rule["type"] == "regex"]
+        flags = {rule["name"]: np.zeros(len(notetext), dtype=bool) for rule in text_rules}
+
+        for i, text in enumerate(notetext.fillna("").values):
+            for name, substring in substrings:
+                flags[name][i] = substring in text
+            for name, pattern in patterns:
+                flags[name][i] = pattern.search(text) is not None
+
+        return flags
+
+    def flag_invalid_docs(self, cohort, text_col="notetext", use_script_fields=False):
+        '''
+        Given a cohort as a pandas dataframe, add a flag column for each rule and a keep_doc column and return the cohort
+        cohort: pandas dataframe containining target cohort (or a chunk of it)
+        text_col: column with the note text to evaluate the rules against
+        use_script_fields: boolean, if True only prefix rules are evaluated against text_col and the flags for other rules are expected as columns already computed by ES (see get_script_fields)
+        '''
+        invalid = np.zeros(len(cohort), dtype=bool)
+
+        text_flags = {}
+        if not use_script_fields:
+            text_flags = self.flag_text_rules(cohort[text_col])
+
+        #prefix rules only need the start of each note, sliced once for all of them
+        prefixes = None
+        if self.get_prefix_length() > 0:
+            prefixes = cohort[text_col].fillna("").str.slice(0, self.get_prefix_length())
+
+        for rule in self.rules:
+            if rule["type"] == "prefix":
+                cohort[rule["name"]] = self.flag_rule(rule, prefixes).values
+            elif rule["name"] in text_flags:
+                cohort[rule["name"]] = text_flags[rule["name"]]
+            cohort[rule["name"]] = cohort[rule["name"]].fillna(False).astype(bool)
+            invalid |= cohort[rule["name"]].values
+
+        cohort["keep_doc"] = ~invalid
+
+        return cohort
+
+    def get_es_must_not_clauses(self, text_field="notetext"):
+        '''
+        Return ES must_not clauses for the rules marked with es_pushdown. Only substring rules can be pushed down (as phrase matches), which may exclude slightly more documents than the exact client side check as they are evaluated on analyzed text
+        text_field: ES field holding the note text
+        '''
+        clauses = []
+        for rule in self.rules:
+            if rule.get("es_pushdown", False):
+                if rule["type"] != "substring":
+                    raise ValueError("Only substring rules can be pushed down to ES: %s" % rule["name"])
+                clauses.append({"match_phrase": {text_field: rule["text"]}})
+
+        return clauses
+
+    def get_script_fields(self, text_field="notetext"):
+        '''
+        Return ES script fields which compute, server side, the note text prefix needed by prefix rules and a flag for each substring rule, so documents can be filtered without transferring the note text
+        text_field: ES field holding the note text
+        '''
+        script_fields = {
+            "notetext_prefix": {"script": {"lang": "painless",
+                                           "source": "def t = params['_source'][params.f]; if (t == null) { return ''; } return t.substring(0, (int) Math.min(t.length(), params.n));",
+                                           "params": {"f": text_field, "n": self.get_prefix_length()}}}
+        }
+
+        for rule in self.rules:
+            if rule["type"] == "substring":
+                script_fields[rule["name"]] = {"script": {"lang": "painless",
+                                                          "source": "def t = params['_source'][params.f]; return t != null && t.contains(params.s);",
+                                                          "params": {"f": text_field, "s": rule["text"]}}}
+            elif rule["type"] == "regex":
+                raise ValueError("Regex rules cannot be evaluated without the note text: %s" % rule["name"])
+
+        return script_fields
@@ -5,6 +5,11 @@ import elasticsearch.helpers
 import ssl
 import requests
 import logging
+import time
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import pipeline.config as config
 
 
 ################################
@@ -31,15 +36,28 @@ class ElasticConnectorConfig:
     ElasticSearch connector configuration
     All the hosts details are specified using RFC-1738
     """
-    def __init__(self, hosts, port = '9200', user_name = None, user_pass = None, ssl_config=None):
+    def __init__(self, hosts, port = '9200', user_name = None, user_pass = None, ssl_config=None,
+                 sniff=False, http_compress=True, timeout=60, max_retries=3, retry_backoff_s=2.0, connections_per_node=10):
         """
-        :param hosts: the ElasticSearch host names
+        :param hosts: the ElasticSearch host names, requests are distributed round-robin across hosts
+        :param sniff: whether to discover the other cluster nodes on start and on connection failure
+        :param http_compress: whether to gzip compress request and response bodies
+        :param timeout: default request timeout in seconds
+        :param max_retries: number of retries for failed requests
+        :param retry_backoff_s: initial backoff in seconds between retries, doubled on each retry
+        :param connections_per_node: size of the connection pool kept open to each node
         """
         self.hosts = hosts
         self.port = port
         self.user_name = user_name
         self.user_pass = user_pass
         self.ssl_config = ssl_config
+        self.sniff = sniff
+        self.http_compress = http_compress
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff_s = retry_backoff_s
+        self.connections_per_node = connections_per_node
 
 
 ################################
@@ -49,12 +67,29 @@ class ElasticConnectorConfig:
 class ElasticConnector:
     """
     ElasticSearch connector
-    At the moment supports only single-node clusters
+    Keeps a pool of persistent connections to each of the configured nodes, distributes requests across them round-robin
+    (optionally sniffing the rest of the cluster) and compresses HTTP bodies
     """
     def __init__(self, elastic_conf):
         """
         :param elastic_conf: ElasticSearch configuration :class:`~ElasticConnectorConfig`
         """
+        self.conf = elastic_conf
+        self.log = logging.getLogger('ElasticConnector')
+
+        client_params = {
+            "hosts": elastic_conf.hosts,
+            "http_compress": elastic_conf.http_compress,
+            "timeout": elastic_conf.timeout,
+            "max_retries": elastic_conf.max_retries,
+            "retry_on_timeout": True,
+            "maxsize": elastic_conf.connections_per_node,
+            "sniff_on_start": elastic_conf.sniff,
+            "sniff_on_connection_fail": elastic_conf.sniff
+        }
+        if elastic_conf.user_name is not None and elastic_conf.user_pass is not None:
+            client_params["http_auth"] = (elastic_conf.user_name, elastic_conf.user_pass)
+
         # check whether we can actually connect to ElasticSearch
         try:
             if elastic_conf.ssl_config is not None:
@@ -75,24 +110,13 @@ class ElasticConnector:
                 context.check_hostname = False
                 context.verify_mode = ssl.CERT_NONE
 
-                if elastic_conf.user_name is not None and elastic_conf.user_pass is not None:
-                    self.es = elasticsearch.Elasticsearch(
-                        hosts=elastic_conf.hosts,
-                        http_auth=(elastic_conf.user_name, elastic_conf.user_pass),
-                        scheme="https",
-                        port=elastic_conf.port,
-                        ssl_context=context,
-                        retry_on_timeout=True)
-                else:
-                    # usually not the case
-                    self.es = elasticsearch.Elasticsearch(
-                        hosts=elastic_conf.es_hosts,
-                        scheme="https",
-                        port=elastic_conf.port,
-                        ssl_context=context,
-                        retry_on_timeout=True)
+                self.es = elasticsearch.Elasticsearch(
+                    scheme="https",
+                    port=elastic_conf.port,
+                    ssl_context=context,
+                    **client_params)
             else:
-                self.es = elasticsearch.Elasticsearch(hosts=elastic_conf.hosts, retry_on_timeout=True)
+                self.es = elasticsearch.Elasticsearch(**client_params)
         except Exception as e:
             raise Exception("Cannot connect to ElasticSearch: %s" % str(elastic_conf.hosts), e)
             
@@ -108,6 +132,94 @@ class ElasticConnector:
     def check_connection(self):
         return self.es.ping()
 
+    def call_with_backoff(self, func, *args, **kwargs):
+        """
+        Calls the given client function, retrying with exponential backoff on connection errors, timeouts and
+        429 / 5xx responses (the client itself retries immediately)
+        :param func: the client function to call, e.g. self.es.mget
+        :return: the result of the call
+        """
+        backoff_s = self.conf.retry_backoff_s
+        for attempt in range(self.conf.max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except elasticsearch.TransportError as e:
+                retryable = isinstance(e, (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout)) \
+                    or e.status_code == 429 or (isinstance(e.status_code, int) and e.status_code >= 500)
+                if not retryable or attempt == self.conf.max_retries:
+                    raise
+                self.log.warning("Retrying ElasticSearch request in %s seconds after error: %s" % (backoff_s, str(e)))
+                time.sleep(backoff_s)
+                backoff_s *= 2
+
+
+def create_connector_config():
+    """
+    Creates the connector configuration from the pipeline config
+    :return: :class:`~ElasticConnectorConfig`
+    """
+    es_config = config.Config().es_config
+    return ElasticConnectorConfig(hosts=es_config["es_hosts"],
+                                  user_name=es_config["es_user"],
+                                  user_pass=es_config["es_password"],
+                                  sniff=es_config["es_sniff"],
+                                  http_compress=es_config["es_http_compress"],
+                                  timeout=es_config["es_timeout_s"],
+                                  max_retries=es_config["es_max_retries"],
+                                  retry_backoff_s=es_config["es_retry_backoff_s"],
+                                  connections_per_node=es_config["es_connections_per_node"])
+
+
+def create_async_client():
+    """
+    Creates an asyncio ElasticSearch client with the same hosts and connection settings as the shared connector.
+    Requires the async extra of the elasticsearch package (elasticsearch[async])
+    :return: :class:`~elasticsearch.AsyncElasticsearch`
+    """
+    from elasticsearch import AsyncElasticsearch
+
+    conf = create_connector_config()
+    client_params = {
+        "hosts": conf.hosts,
+        "http_compress": conf.http_compress,
+        "timeout": conf.timeout,
+        "max_retries": conf.max_retries,
+        "retry_on_timeout": True,
+        "maxsize": conf.connections_per_node
+    }
+    if conf.user_name is not None and conf.user_pass is not None:
+        client_params["http_auth"] = (conf.user_name, conf.user_pass)
+
+    return AsyncElasticsearch(**client_params)
+
+
+shared_connector = None
+
+def get_connector():
+    """
+    Returns the connector shared by all ElasticSearch users in the pipeline, creating it from the pipeline config on first use
+    :return: :class:`~ElasticConnector`
+    """
+    global shared_connector
+    if shared_connector is None:
+        shared_connector = ElasticConnector(create_connector_config())
+    return shared_connector
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Splits an iterable into lists of at most batch_size items without materialising it
+    :param iterable: the iterable to split
+    :param batch_size: the maximum number of items per batch
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
 
 ################################
 #
@@ -210,29 +322,66 @@ class ElasticIndexer:
         """
         index_name = self.get_index_name(index_suffix)
         try:
-            elasticsearch.helpers.bulk(self.conn.es, docs, index=index_name, doc_type=self.doc_type)
+            _, errors = elasticsearch.helpers.bulk(self.conn.es, docs, index=index_name, doc_type=self.doc_type, raise_on_error=False)
+            if errors:
+                self.log.warning("Failed indexing documents in bulk: %d " % len(errors))
+            return errors
         except Exception as e:
             self.log.error("Exception caught while indexing documents in bulk: " + str(e))
+            raise
 
     def index_docs_bulk_gen(self, actions_generator):
         """
         Indexes the documents using ElasticSearch bulk API
         :param actions_generator: the generator of documents, must include the index name
+        :return: the bulk results of the failed documents
         """
-        failed_docs = 0
+        failed_docs = []
         try:
             for status, result in elasticsearch.helpers.streaming_bulk(self.conn.es,
                                                                        actions=actions_generator,
                                                                        chunk_size=self.BULK_CHUNK_SIZE,
-                                                                       request_timeout=self.BULK_REQUEST_TIMEOUT_S):
+                                                                       request_timeout=self.BULK_REQUEST_TIMEOUT_S,
+                                                                       raise_on_error=False):
                 if status is False:
-                    failed_docs += 1
+                    failed_docs.append(result)
 
             if failed_docs:
-                self.log.warn("Failed indexing documents in bulk: %d " % failed_docs)
+                self.log.warning("Failed indexing documents in bulk: %d " % len(failed_docs))
 
         except Exception as e:
             self.log.error("Exception caught while indexing documents in bulk: " + str(e))
+            raise
+
+        return failed_docs
+
+    def index_docs_parallel_bulk(self, actions, thread_count=4, chunk_size=500, queue_size=4):
+        """
+        Indexes the documents using the ElasticSearch parallel bulk helper, with at most
+        (thread_count + queue_size) chunks of documents in flight at any time
+        :param actions: the iterable of bulk actions, must include the index name
+        :param thread_count: the number of threads sending bulk requests
+        :param chunk_size: the number of documents per bulk request
+        :param queue_size: the number of chunks buffered for the sending threads
+        :return: generator of (ok, action, result) for each action, in input order
+        """
+        # parallel_bulk returns results in input order, so keep the in-flight actions to pair them with their results
+        in_flight = collections.deque()
+
+        def track(actions):
+            for action in actions:
+                in_flight.append(action)
+                yield action
+
+        for ok, result in elasticsearch.helpers.parallel_bulk(self.conn.es,
+                                                              actions=track(actions),
+                                                              thread_count=thread_count,
+                                                              chunk_size=chunk_size,
+                                                              queue_size=queue_size,
+                                                              request_timeout=self.BULK_REQUEST_TIMEOUT_S,
+                                                              raise_on_error=False,
+                                                              raise_on_exception=False):
+            yield ok, in_flight.popleft(), result
 
     def get_doc(self, doc_id, index_suffix=""):
         """
@@ -245,26 +394,113 @@ class ElasticIndexer:
         assert '_source' in res
         return res['_source']
 
-    def get_doc_ids(self, index_suffix=""):
+    def get_docs_batch(self, doc_ids, index_name, fields=None):
         """
-        Retrieves the ids of all the documents
+        Retrieves a batch of documents with a single mget request
+        :param doc_ids: the ids of the documents
+        :param index_name: the name of the index storing the documents
+        :param fields: optional list of _source fields to retrieve
+        :return: the documents represented as KVPs dictionaries in input order, None for documents not found
+        """
+        params = {}
+        if fields is not None:
+            params["_source_includes"] = fields
+
+        res = self.conn.call_with_backoff(self.conn.es.mget, body={"ids": doc_ids}, index=index_name, **params)
+        return [doc['_source'] if doc.get('found') else None for doc in res['docs']]
+
+    def get_docs(self, doc_ids, fields=None, index_suffix="", batch_size=1000, n_workers=1):
+        """
+        Retrieves the given documents in batches using ElasticSearch mget API
+        :param doc_ids: iterable of document ids, may be a generator
+        :param fields: optional list of _source fields to retrieve
         :param index_suffix: optional suffix of the index to store the document
-        :return: the document ids in array
+        :param batch_size: the number of documents per mget request
+        :param n_workers: the number of concurrent mget requests, at most 2 * n_workers batches are in flight
+        :return: generator of the documents represented as KVPs dictionaries in input order, None for documents not found
+        """
+        index_name = self.get_index_name(index_suffix)
+        batches = iter_batches(doc_ids, batch_size)
+
+        if n_workers <= 1:
+            for batch in batches:
+                for doc in self.get_docs_batch(batch, index_name, fields):
+                    yield doc
+            return
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(executor.submit(self.get_docs_batch, batch, index_name, fields))
+                if len(pending) >= 2 * n_workers:
+                    for doc in pending.popleft().result():
+                        yield doc
+
+            while pending:
+                for doc in pending.popleft().result():
+                    yield doc
+
+    def get_doc_ids_page(self, pit_id, page_size=1000, search_after=None, keep_alive="5m"):
+        """
+        Retrieves one page of document ids from a point in time using search_after pagination on _shard_doc,
+        which is unique for every document of any index and needs no field data
+        :param pit_id: the id of a point in time opened on the index
+        :param page_size: the number of ids per page
+        :param search_after: the cursor returned with the previous page, None for the first page
+        :param keep_alive: how long the point in time is kept alive for the next page
+        :return: tuple of the document ids in array, the cursor for the next page (None when there are no more pages)
+                 and the point in time id to use for the next page
         """
         query_body = {
             "query": {
                 "match_all": {}
             },
-            "stored_fields": []
+            "stored_fields": [],
+            "size": page_size,
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "sort": [{"_shard_doc": "asc"}]
         }
+        if search_after is not None:
+            query_body["search_after"] = search_after
 
-        meta = self.conn.es.search(index=self.get_index_name(suffix=index_suffix, search_only=True),
-                                   body=query_body)
-        if 'hits' not in meta:
-            return []
+        meta = self.conn.call_with_backoff(self.conn.es.search, body=query_body)
+        pit_id = meta.get('pit_id', pit_id)
+        hits = meta.get('hits', {}).get('hits', [])
+        if len(hits) == 0:
+            return [], None, pit_id
 
-        ids = [hit['_id'] for hit in meta['hits']['hits']]
-        return ids
+        return [hit['_id'] for hit in hits], hits[-1]['sort'], pit_id
+
+    def iter_doc_ids(self, index_suffix="", page_size=1000, keep_alive="5m"):
+        """
+        Streams the ids of all the documents page by page from a point in time (requires ElasticSearch >= 7.12)
+        :param index_suffix: optional suffix of the index to store the document
+        :param page_size: the number of ids retrieved per request
+        :param keep_alive: how long the point in time is kept alive between pages
+        :return: generator of the document ids
+        """
+        pit_id = self.conn.call_with_backoff(self.conn.es.open_point_in_time,
+                                             index=self.get_index_name(suffix=index_suffix, search_only=True),
+                                             keep_alive=keep_alive)['id']
+        try:
+            search_after = None
+            while True:
+                page, search_after, pit_id = self.get_doc_ids_page(pit_id, page_size, search_after, keep_alive)
+                for doc_id in page:
+                    yield doc_id
+                if search_after is None or len(page) < page_size:
+                    return
+        finally:
+            self.conn.es.close_point_in_time(body={"id": pit_id})
+
+    def get_doc_ids(self, index_suffix="", page_size=1000):
+        """
+        Retrieves the ids of all the documents, page by page. Prefer iter_doc_ids on large indices, this holds every id in memory
+        :param index_suffix: optional suffix of the index to store the document
+        :param page_size: the number of ids retrieved per request
+        :return: the document ids in array
+        """
+        return list(self.iter_doc_ids(index_suffix, page_size))
 
     def doc_exists(self, match_criteria, index_suffix=""):
         """
@@ -285,11 +521,11 @@ class ElasticIndexer:
         res = self.conn.es.count(index=index_name, body=query_body)
         return int(res['count']) > 0
 
-    def get_doc_ids_scan(self, index_suffix=""):
+    def iter_doc_ids_scan(self, index_suffix=""):
         """
-        Retrieves the ids of all the documents using ElasticSearch scan API
+        Streams the ids of all the documents using ElasticSearch scan API
         :param index_suffix: optional suffix of the index to store the document
-        :return: the document ids in array
+        :return: generator of the document ids
         """
         query_body = {
             "query": {
@@ -303,8 +539,16 @@ class ElasticIndexer:
                                                    index=self.get_index_name(suffix=index_suffix,
                                                                              search_only=True),
                                                    doc_type=self.doc_type)
-        ids = [hit['_id'] for hit in ids_generator]
-        return ids
+        for hit in ids_generator:
+            yield hit['_id']
+
+    def get_doc_ids_scan(self, index_suffix=""):
+        """
+        Retrieves the ids of all the documents using ElasticSearch scan API
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the document ids in array
+        """
+        return list(self.iter_doc_ids_scan(index_suffix))
 
 
 ################################
@@ -315,15 +559,15 @@ class ElasticRangedIndexer(ElasticIndexer):
     def __init__(self, es_connector, index_name):
         super().__init__(es_connector, index_name)
 
-    def get_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
+    def iter_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
         """
-        Retrieves the ids of all the documents using ElasticSearch scan API
+        Streams the ids of all the documents within a date range using ElasticSearch scan API
         :param date_field: the name of the field containing the date
         :param date_begin: begin of the range, inclusive
         :param date_end: optional suffix of the index to store the document
         :param date_format: the format of the date field
         :param index_suffix: end of the range, inclusive
-        :return: the document ids in array
+        :return: generator of the document ids
         """
         query_body = {
             "query": {
@@ -342,5 +586,17 @@ class ElasticRangedIndexer(ElasticIndexer):
                                                    query=query_body,
                                                    index=self.get_index_name(index_suffix),
                                                    doc_type=self.doc_type)
-        ids = [hit['_id'] for hit in ids_generator]
-        return ids
\ No newline at end of file
+        for hit in ids_generator:
+            yield hit['_id']
+
+    def get_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
+        """
+        Retrieves the ids of all the documents within a date range using ElasticSearch scan API
+        :param date_field: the name of the field containing the date
+        :param date_begin: begin of the range, inclusive
+        :param date_end: optional suffix of the index to store the document
+        :param date_format: the format of the date field
+        :param index_suffix: end of the range, inclusive
+        :return: the document ids in array
+        """
+        return list(self.iter_doc_ids_by_range_scan(date_field, date_begin, date_end, date_format, index_suffix))
\ No newline at end of file
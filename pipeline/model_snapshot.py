@@ -0,0 +1,92 @@
+import numpy as np
+import pickle
+import mmap
+import json
+import time
+import os
+
+class ModelSnapshot:
+    '''
+    Ready-to-load snapshot of annotation model objects (e.g. MedCAT CDB and Vocab) written once by a compile step.
+    Objects are pickled with protocol 4 and every numpy array of at least min_array_bytes is written out of band to a single binary file,
+    which is memory mapped on load so the vectors are paged in on demand rather than copied into memory up front
+    '''
+    def __init__(self, snapshot_dir, min_array_bytes=1024):
+        '''
+        snapshot_dir: directory for the snapshot files
+        min_array_bytes: numpy arrays at least this size are stored out of band and memory mapped on load
+        '''
+        self.snapshot_dir = snapshot_dir
+        self.min_array_bytes = min_array_bytes
+        self.objects_path = os.path.join(snapshot_dir, "objects.pkl")
+        self.arrays_path = os.path.join(snapshot_dir, "arrays.bin")
+        self.meta_path = os.path.join(snapshot_dir, "meta.json")
+
+    def is_fresh(self, source_fingerprint):
+        '''
+        Return whether a snapshot exists and was compiled from model files with the given fingerprint
+        source_fingerprint: fingerprint of the source model files, see AnnotationCache.get_model_fingerprint
+        '''
+        if not os.path.exists(self.meta_path):
+            return False
+
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+
+        return meta["source_fingerprint"] == source_fingerprint
+
+    def write(self, objects, source_fingerprint):
+        '''
+        Write a snapshot of a dictionary of model objects
+        objects: dictionary of picklable model objects, e.g. {"cdb": cdb, "vocab": vocab}
+        source_fingerprint: fingerprint of the source model files the objects were loaded from
+        '''
+        start = time.time()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+        min_array_bytes = self.min_array_bytes
+        with open(self.arrays_path + ".tmp", "wb") as arrays_file:
+            class SnapshotPickler(pickle.Pickler):
+                def persistent_id(self, obj):
+                    #write large, plain numpy arrays to the arrays file and keep a reference to them in the pickle
+                    if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= min_array_bytes:
+                        offset = arrays_file.tell()
+                        arrays_file.write(np.ascontiguousarray(obj).tobytes())
+                        return ("ndarray", offset, obj.dtype.str, obj.shape)
+                    return None
+
+            with open(self.objects_path + ".tmp", "wb") as objects_file:
+                SnapshotPickler(objects_file, protocol=4).dump(objects)
+
+        os.replace(self.arrays_path + ".tmp", self.arrays_path)
+        os.replace(self.objects_path + ".tmp", self.objects_path)
+        with open(self.meta_path, "w") as f:
+            json.dump({"source_fingerprint": source_fingerprint, "objects": sorted(objects.keys()), "compiled_at": time.time()}, f)
+
+        print("Wrote model snapshot to %s in %s seconds (%s MB of arrays)" % (self.snapshot_dir, round(time.time() - start, 2), round(os.path.getsize(self.arrays_path) / 1024 ** 2, 2)))
+
+    def load(self):
+        '''
+        Load the snapshot and return the dictionary of model objects, with large arrays backed by a copy-on-write memory map of the arrays file
+        '''
+        start = time.time()
+
+        buffer = b""
+        if os.path.getsize(self.arrays_path) > 0:
+            with open(self.arrays_path, "rb") as f:
+                #copy-on-write so in-place updates to the vectors never reach the snapshot file
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        class SnapshotUnpickler(pickle.Unpickler):
+            def persistent_load(self, pid):
+                _, offset, dtype, shape = pid
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape))
+                return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+        with open(self.objects_path, "rb") as f:
+            objects = SnapshotUnpickler(f).load()
+
+        print("Loaded model snapshot from %s in %s seconds" % (self.snapshot_dir, round(time.time() - start, 2)))
+
+        return objects
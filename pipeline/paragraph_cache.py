@@ -0,0 +1,87 @@
+import collections
+import hashlib
+import re
+
+#paragraphs are separated by blank lines
+PARAGRAPH_BREAK_PATTERN = re.compile(r"\n[ \t\r\f\v]*\n")
+
+def split_paragraphs(text):
+    '''
+    Split a text on blank lines and return a list of (offset in text, paragraph) tuples, the separators and whitespace only paragraphs are dropped
+    text: the document text
+    '''
+    paragraphs = []
+    start = 0
+    for match in PARAGRAPH_BREAK_PATTERN.finditer(text):
+        if match.start() > start:
+            paragraphs.append((start, text[start:match.start()]))
+        start = match.end()
+
+    if start < len(text):
+        paragraphs.append((start, text[start:]))
+
+    return [(offset, paragraph) for offset, paragraph in paragraphs if len(paragraph.strip()) > 0]
+
+class ParagraphCache:
+    '''
+    Bounded least recently used in-memory cache of paragraph annotations keyed by a hash of the paragraph text, so paragraphs repeated word for word
+    across templated notes (headers, standard advice, medication table scaffolding) are only annotated once per run. Annotation offsets are relative to the paragraph
+    '''
+    def __init__(self, max_paragraphs=100000):
+        '''
+        max_paragraphs: maximum number of cached paragraphs before the least recently used are evicted
+        '''
+        self.max_paragraphs = max_paragraphs
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.hit_chars = 0
+        self.miss_chars = 0
+
+    def get_key(self, paragraph):
+        return hashlib.sha1(paragraph.encode("utf-8")).digest()
+
+    def get(self, paragraph):
+        '''
+        Return the cached annotations for a paragraph, or None on a cache miss
+        paragraph: the paragraph text
+        '''
+        key = self.get_key(paragraph)
+        annotations = self.entries.get(key)
+
+        if annotations is None:
+            self.misses += 1
+            self.miss_chars += len(paragraph)
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.hit_chars += len(paragraph)
+        return annotations
+
+    def put(self, paragraph, annotations):
+        '''
+        Store the annotations for a paragraph, evicting the least recently used paragraph if the cache is full
+        paragraph: the paragraph text
+        annotations: list of annotation dictionaries with offsets relative to the paragraph
+        '''
+        self.entries[self.get_key(paragraph)] = annotations
+        if len(self.entries) > self.max_paragraphs:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        '''
+        Return the paragraph reuse counts for this run
+        '''
+        return {"hits": self.hits, "misses": self.misses, "hit_chars": self.hit_chars, "miss_chars": self.miss_chars}
+
+    @staticmethod
+    def get_reuse_rates(stats):
+        '''
+        Return the share of paragraphs and of paragraph characters served from the cache
+        stats: dictionary of counts from get_stats, possibly summed over workers
+        '''
+        n_paragraphs = stats["hits"] + stats["misses"]
+        n_chars = stats["hit_chars"] + stats["miss_chars"]
+        return {"paragraph_reuse_rate": stats["hits"] / n_paragraphs if n_paragraphs > 0 else 0.0,
+                "char_reuse_rate": stats["hit_chars"] / n_chars if n_chars > 0 else 0.0}
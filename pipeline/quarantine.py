@@ -0,0 +1,106 @@
+import threading
+import signal
+import json
+import time
+import os
+from pipeline.annotation_checkpoint import to_json_value
+
+class AnnotationTimeout(Exception):
+    '''
+    Raised when annotating a document takes longer than the per document timeout
+    '''
+    pass
+
+def call_with_timeout(func, timeout_s, *args):
+    '''
+    Call func(*args), raising AnnotationTimeout if it runs longer than timeout_s. Uses a SIGALRM interval timer, so the timeout only applies
+    on platforms with SIGALRM and in a process's main thread (the main pipeline process and process pool workers), elsewhere func runs without a timeout.
+    The signal is handled between Python bytecodes, so a long running call inside a C extension (e.g. a torch or spacy kernel) is only interrupted once it
+    returns to Python, and a call that never returns is not interrupted at all
+    func: function to call
+    timeout_s: timeout in seconds, None or 0 for no timeout
+    args: arguments for func
+    '''
+    if not timeout_s or not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        return func(*args)
+
+    def on_timeout(signum, frame):
+        raise AnnotationTimeout("timed out after %s seconds" % timeout_s)
+
+    previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout_s)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def call_without_timeout(func, *args):
+    '''
+    Call func(*args) with SIGALRM blocked, so a timeout from call_with_timeout that expires meanwhile is raised only once func has returned.
+    Used for updates to shared state (e.g. caches) that must not be left half done by an AnnotationTimeout
+    func: function to call
+    args: arguments for func
+    '''
+    if not hasattr(signal, "pthread_sigmask"):
+        return func(*args)
+
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+    try:
+        return func(*args)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGALRM])
+
+class AnnotationQuarantine:
+    '''
+    Persisted jsonl list of documents that timed out or failed annotation, with the failure reason, for a later retry pass
+    '''
+    def __init__(self, filepath):
+        '''
+        filepath: jsonl file for quarantined documents
+        '''
+        self.filepath = filepath
+
+    def add(self, note_id, reason, n_chars, attempts=1):
+        '''
+        Quarantine a document
+        note_id: clinicalnotekey of the document
+        reason: failure reason, e.g. the exception message or timeout
+        n_chars: length of the note text
+        attempts: number of times annotation of the document has failed
+        '''
+        entry = {"clinicalnotekey": note_id, "reason": reason, "n_chars": n_chars, "attempts": attempts, "quarantined_at": time.time()}
+        with open(self.filepath, "a") as f:
+            f.write(json.dumps(entry, default=to_json_value) + "\n")
+
+    def load(self):
+        '''
+        Return the quarantined documents as a dictionary of clinicalnotekey to the latest quarantine entry
+        '''
+        entries = {}
+        if not os.path.exists(self.filepath):
+            return entries
+
+        with open(self.filepath) as f:
+            for line in f:
+                entry = json.loads(line)
+                entries[entry["clinicalnotekey"]] = entry
+
+        return entries
+
+    def rewrite(self, entries):
+        '''
+        Replace the quarantine with a list of entries
+        entries: list of quarantine entry dictionaries
+        '''
+        with open(self.filepath + ".tmp", "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, default=to_json_value) + "\n")
+        os.replace(self.filepath + ".tmp", self.filepath)
+
+    def clear(self):
+        '''
+        Remove all quarantined documents
+        '''
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
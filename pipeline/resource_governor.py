@@ -0,0 +1,147 @@
+import psutil
+import threading
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+class ResourceGovernor:
+    '''
+    Samples memory and annotation throughput on a background timer and adapts the annotation batch size and number of batches in flight (and with it the number of busy workers):
+    both are halved when available memory drops below min_available_gb or the pipeline's memory nears the ceiling, and grown again while there is headroom.
+    When the pipeline's memory reaches spill_fraction of the ceiling it asks annotate_cohort to spill completed results to disk
+    '''
+    def __init__(self, batch_size, max_in_flight_batches, memory_ceiling_gb=None, min_available_gb=2, headroom_available_gb=8, spill_fraction=0.85,
+                 min_batch_size=4, max_batch_size=256, interval_s=5):
+        '''
+        batch_size: initial number of documents sent to a worker at a time
+        max_in_flight_batches: initial (and maximum) number of batches submitted but not yet consumed
+        memory_ceiling_gb: maximum memory for the pipeline process and its workers in GB, defaults to 90% of the machine's memory
+        min_available_gb: available system memory in GB below which batch size and batches in flight are reduced
+        headroom_available_gb: available system memory in GB above which batch size and batches in flight are grown
+        spill_fraction: fraction of memory_ceiling_gb at which completed results are spilled to disk
+        min_batch_size: smallest batch size the governor will shrink to
+        max_batch_size: largest batch size the governor will grow to
+        interval_s: seconds between samples
+        '''
+        self.batch_size = batch_size
+        self.max_in_flight_batches = max_in_flight_batches
+        self.in_flight_limit = max_in_flight_batches
+        self.memory_ceiling_gb = memory_ceiling_gb if memory_ceiling_gb is not None else 0.9 * psutil.virtual_memory().total / (1024.0 ** 3)
+        self.min_available_gb = min_available_gb
+        self.headroom_available_gb = headroom_available_gb
+        self.spill_fraction = spill_fraction
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.interval_s = interval_s
+
+        self.n_docs = 0
+        self.spill_requested = False
+        self.status = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''
+        Take a first sample and start sampling on the background timer
+        '''
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="resource-governor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop the background timer
+        '''
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_s):
+            try:
+                self.sample()
+            except Exception as e:
+                log.error("Resource governor sample failed: " + str(e))
+
+    def record_docs(self, n_docs=1):
+        '''
+        Count completed documents for the throughput sample, cheap enough to call per document
+        n_docs: number of documents completed
+        '''
+        self.n_docs += n_docs
+
+    def get_pipeline_rss_gb(self):
+        '''
+        Return the resident memory of this process and its worker processes in GB
+        '''
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+
+        return rss / (1024.0 ** 3)
+
+    def sample(self):
+        '''
+        Sample memory and throughput and adapt batch size, batches in flight and the spill request
+        '''
+        now = time.time()
+        available_gb = psutil.virtual_memory().available / (1024.0 ** 3)
+        rss_gb = self.get_pipeline_rss_gb()
+
+        previous = self.status
+        docs_per_sec = 0.0
+        if "time" in previous:
+            docs_per_sec = (self.n_docs - previous["n_docs"]) / max(now - previous["time"], 1e-6)
+
+        with self.lock:
+            if available_gb < self.min_available_gb or rss_gb > 0.8 * self.memory_ceiling_gb:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                self.in_flight_limit = max(1, self.in_flight_limit // 2)
+            elif available_gb > self.headroom_available_gb and rss_gb < 0.5 * self.memory_ceiling_gb:
+                self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.5) + 1)
+                self.in_flight_limit = min(self.max_in_flight_batches, self.in_flight_limit + 1)
+
+            if rss_gb >= self.spill_fraction * self.memory_ceiling_gb:
+                self.spill_requested = True
+
+            self.status = {"time": now,
+                           "n_docs": self.n_docs,
+                           "docs_per_sec": round(docs_per_sec, 2),
+                           "available_gb": round(available_gb, 2),
+                           "pipeline_rss_gb": round(rss_gb, 2),
+                           "batch_size": self.batch_size,
+                           "in_flight_limit": self.in_flight_limit}
+
+        if previous.get("batch_size") != self.batch_size or previous.get("in_flight_limit") != self.in_flight_limit:
+            log.info("Resource governor: " + str(self.status))
+
+    def get_batch_size(self):
+        with self.lock:
+            return self.batch_size
+
+    def get_in_flight_limit(self):
+        with self.lock:
+            return self.in_flight_limit
+
+    def should_spill(self):
+        '''
+        Return whether completed results should be spilled to disk, clearing the request
+        '''
+        with self.lock:
+            spill_requested = self.spill_requested
+            self.spill_requested = False
+
+        return spill_requested
+
+    def get_status(self):
+        '''
+        Return the latest sample
+        '''
+        with self.lock:
+            return dict(self.status)
@@ -0,0 +1,146 @@
+import pipeline.esconn as esconn
+import pipeline.config as config
+import json
+import time
+from datetime import datetime
+
+class ResultSink:
+    '''
+    Streams per-document annotations and risk scores into an Elasticsearch results index with parallel bulk requests.
+    Failed documents are retried with exponential backoff and documents that still fail are written to a dead letter jsonl file
+    '''
+    def __init__(self, index_name=None, dead_letter_filepath=None):
+        '''
+        index_name: the results index, defaults to output_config["results_index"]
+        dead_letter_filepath: jsonl file for documents that could not be indexed, defaults to output_config["results_dead_letter_filepath"]
+        '''
+        print("Initializing ResultSink")
+
+        output_config = config.Config().output_config
+        self.index_name = index_name if index_name is not None else output_config["results_index"]
+        self.dead_letter_filepath = dead_letter_filepath if dead_letter_filepath is not None else output_config["results_dead_letter_filepath"]
+        self.thread_count = output_config["results_bulk_thread_count"]
+        self.chunk_size = output_config["results_bulk_chunk_size"]
+        self.queue_size = output_config["results_bulk_queue_size"]
+        self.max_retries = output_config["results_bulk_max_retries"]
+        self.retry_backoff_s = output_config["results_bulk_retry_backoff_s"]
+
+        self.indexer = esconn.ElasticIndexer(esconn.get_connector(), self.index_name)
+
+    def build_annotation_entries(self, annotations):
+        '''
+        Given the annotations for a document, return the compact annotation fields written to the results index
+        annotations: list of annotation dictionaries for a document
+        '''
+        entries = []
+        for ann in annotations:
+            entry = {"cui": ann["cui"],
+                     "pretty_name": ann.get("pretty_name"),
+                     "start": ann.get("start"),
+                     "end": ann.get("end"),
+                     "negated": ann.get("meta_anns", {}).get("Negated", {}).get("value")}
+            entries.append(entry)
+
+        return entries
+
+    def build_actions(self, annotated_cohort, cohort_scores=None):
+        '''
+        Given an annotated cohort and optional risk scores, yield one bulk index action per document keyed by note id
+        annotated_cohort: an annotated cohort in dictionary structure -> [{"pat_metadata":[], "doc_metadata":[], "annotations":[]}]
+        cohort_scores: optional pandas dataframe of risk scores (and medication flags) with a doc_id column
+        '''
+        scores_by_doc = {}
+        if cohort_scores is not None:
+            #replace NaN with None so the documents serialise to valid json
+            cohort_scores = cohort_scores.astype(object).where(cohort_scores.notna(), None)
+            scores_by_doc = {row["doc_id"]: row for row in cohort_scores.to_dict("records")}
+
+        for doc in annotated_cohort:
+            note_id = doc["doc_metadata"]["note_id"]
+            body = {"note_id": note_id,
+                    "pat_id": doc["pat_metadata"]["pat_id"],
+                    "encounter_date": doc["doc_metadata"]["encounter_date"],
+                    "age": doc["pat_metadata"]["age"],
+                    "female": doc["pat_metadata"]["female"],
+                    "annotations": self.build_annotation_entries(doc["annotations"]),
+                    "scores": scores_by_doc.get(note_id, {}),
+                    "indexed_at": datetime.now().isoformat()}
+
+            yield {"_index": self.index_name, "_id": note_id, "_source": body}
+
+    def is_retryable(self, result):
+        '''
+        Given a failed bulk item result, return whether the failure is transient (rejected, timed out or server error)
+        result: bulk item result dictionary
+        '''
+        item = list(result.values())[0]
+        status = item.get("status")
+        return "exception" in item or status == 429 or (isinstance(status, int) and status >= 500)
+
+    def write_dead_letters(self, failed):
+        '''
+        Append permanently failed actions and their errors to the dead letter file
+        failed: list of (action, result) tuples
+        '''
+        with open(self.dead_letter_filepath, "a") as f:
+            for action, result in failed:
+                f.write(json.dumps({"action": action, "error": result}, default=str) + "\n")
+
+    def write(self, actions):
+        '''
+        Index a stream of bulk actions with bounded in-flight chunks, retrying transient failures with exponential backoff, and return the number of indexed and dead lettered documents
+        actions: iterable of bulk index actions
+        '''
+        start = time.time()
+        n_indexed = 0
+        n_total = 0
+        dead_letters = []
+        retry = []
+
+        for ok, action, result in self.indexer.index_docs_parallel_bulk(actions, self.thread_count, self.chunk_size, self.queue_size):
+            n_total += 1
+            if ok:
+                n_indexed += 1
+            elif self.is_retryable(result):
+                retry.append(action)
+            else:
+                dead_letters.append((action, result))
+
+            if n_total % 10000 == 0:
+                print("Indexed", n_indexed, "of", n_total, "documents (%s docs/sec)" % round(n_total / max(time.time() - start, 1e-6), 2))
+
+        backoff_s = self.retry_backoff_s
+        for attempt in range(self.max_retries):
+            if len(retry) == 0:
+                break
+            print("Retrying", len(retry), "failed documents in", backoff_s, "seconds")
+            time.sleep(backoff_s)
+            backoff_s *= 2
+
+            still_failing = []
+            for ok, action, result in self.indexer.index_docs_parallel_bulk(retry, self.thread_count, self.chunk_size, self.queue_size):
+                if ok:
+                    n_indexed += 1
+                elif self.is_retryable(result) and attempt < self.max_retries - 1:
+                    still_failing.append(action)
+                else:
+                    dead_letters.append((action, result))
+            retry = still_failing
+
+        dead_letters.extend([(action, {"index": {"error": "retries exhausted"}}) for action in retry])
+        if len(dead_letters) > 0:
+            print("Writing", len(dead_letters), "failed documents to", self.dead_letter_filepath)
+            self.write_dead_letters(dead_letters)
+
+        elapsed = max(time.time() - start, 1e-6)
+        print("Indexed %s of %s documents into %s in %s seconds (%s docs/sec)" % (n_indexed, n_total, self.index_name, round(elapsed, 2), round(n_indexed / elapsed, 2)))
+
+        return n_indexed, len(dead_letters)
+
+    def write_results(self, annotated_cohort, cohort_scores=None):
+        '''
+        Top level convenience function to stream the annotations and risk scores of a cohort into the results index
+        annotated_cohort: an annotated cohort in dictionary structure -> [{"pat_metadata":[], "doc_metadata":[], "annotations":[]}]
+        cohort_scores: optional pandas dataframe of risk scores (and medication flags) with a doc_id column
+        '''
+        return self.write(self.build_actions(annotated_cohort, cohort_scores))
@@ -1,9 +1,11 @@
 import pandas as pd
+import numpy as np
 import time
 from datetime import datetime
 import random
 import json
 from functools import reduce
+from pipeline.compact_annotations import CompactAnnotations
 
 class RiskScorer:
     def __init__(self):
@@ -43,6 +45,9 @@ class RiskScorer:
         score_unique_code_list: set of unique codes for the risk score components
         code_to_risk_component: dictionary of codes to risk score components
         '''
+        if isinstance(cohort, CompactAnnotations):
+            return self.generate_cohort_by_component_list_compact(cohort, score_risk_components, score_unique_code_list, code_to_risk_component)
+        
         start = time.time()
         print("Start generating cohort by risk component table at: ", datetime.fromtimestamp(start))
         cohort_by_risk_component = []
@@ -71,6 +76,41 @@ class RiskScorer:
         
         return cohort_by_risk_component
     
+    def generate_cohort_by_component_list_compact(self, cohort, score_risk_components, score_unique_code_list, code_to_risk_component):
+        '''
+        Vectorised version of generate_cohort_by_component_list for a CompactAnnotations cohort, counts non negated annotations of each risk component per document directly from the annotation arrays
+        cohort: CompactAnnotations store for target cohort
+        score_risk_components: set of unique risk score components
+        score_unique_code_list: set of unique codes for the risk score components
+        code_to_risk_component: dictionary of codes to risk score components
+        '''
+        start = time.time()
+        print("Start generating cohort by risk component table at: ", datetime.fromtimestamp(start))
+        
+        components = list(score_risk_components)
+        component_idx = {component: i for i, component in enumerate(components)}
+        
+        #map each interned cui to its risk component column, -1 for cuis outside the codelist
+        cui_to_component = np.array([component_idx[code_to_risk_component[cui]] if cui in score_unique_code_list else -1 for cui in cohort.cui_table], dtype=np.int64)
+        
+        arrays = cohort.get_arrays()
+        counts = np.zeros((len(cohort), len(components)), dtype=np.int64)
+        if len(cohort.cui_table) > 0:
+            ann_components = cui_to_component[arrays["cui_id"]]
+            mask = (ann_components >= 0) & (arrays["negated"] == CompactAnnotations.NOT_NEGATED)
+            np.add.at(counts, (arrays["doc_idx"][mask], ann_components[mask]), 1)
+        
+        cohort_by_risk_component = []
+        for doc_idx in range(len(cohort)):
+            components_counter = dict(zip(components, counts[doc_idx].tolist()))
+            doc_entry = {"doc_id":cohort.note_ids[doc_idx], "pat_id":cohort.pat_ids[doc_idx], "encounter_date":cohort.encounter_dates[doc_idx], "age":cohort.ages[doc_idx], "female": cohort.females[doc_idx], "components": components_counter}
+            cohort_by_risk_component.append(doc_entry)
+        
+        end = time.time()
+        print("Finish generating cohort by risk component table at: ", datetime.fromtimestamp(end))
+        print("Completed in %s minutes" % ( round(end - start,2) / 60 ) )
+        
+        return cohort_by_risk_component
  
     def add_non_coded_risk_score_components(self, cohort_by_risk_component, score_name):
         '''
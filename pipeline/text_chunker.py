@@ -0,0 +1,88 @@
+class TextChunker:
+    '''
+    Splits long notes into bounded chunks on section, line or sentence boundaries so the annotation model never sees a document longer than max_chunk_chars,
+    and merges the annotations of the chunks back into document coordinates
+    '''
+    #boundaries tried in order of preference, a chunk ends just after the boundary
+    BOUNDARIES = ["\n\n", "\n", ". "]
+
+    def __init__(self, max_chunk_chars, overlap_chars=200):
+        '''
+        max_chunk_chars: maximum number of characters in a chunk, None disables chunking
+        overlap_chars: number of characters repeated between chunks when no boundary is found and the text is split mid sentence, so entities on the split are seen whole by one chunk
+        '''
+        self.max_chunk_chars = max_chunk_chars
+        self.overlap_chars = overlap_chars
+        if max_chunk_chars is not None:
+            self.overlap_chars = min(overlap_chars, max_chunk_chars // 4)
+
+    def needs_chunking(self, text):
+        '''
+        Return whether a text is longer than max_chunk_chars
+        text: the document text
+        '''
+        return self.max_chunk_chars is not None and len(text) > self.max_chunk_chars
+
+    def find_split(self, text, start):
+        '''
+        Return the end of the chunk starting at start and whether it ends on a boundary, looking for the last boundary in the second half of the chunk
+        text: the document text
+        start: offset of the chunk in the document
+        '''
+        end = start + self.max_chunk_chars
+        if end >= len(text):
+            return len(text), True
+
+        min_end = start + self.max_chunk_chars // 2
+        for boundary in self.BOUNDARIES:
+            idx = text.rfind(boundary, min_end, end)
+            if idx != -1:
+                return idx + len(boundary), True
+
+        return end, False
+
+    def split(self, text):
+        '''
+        Split a text into chunks and return a list of (offset in document, chunk text) tuples
+        text: the document text
+        '''
+        if not self.needs_chunking(text):
+            return [(0, text)]
+
+        chunks = []
+        start = 0
+        while start < len(text):
+            end, on_boundary = self.find_split(text, start)
+            chunks.append((start, text[start:end]))
+            if end >= len(text):
+                break
+            start = end if on_boundary else end - self.overlap_chars
+
+        return chunks
+
+    def merge(self, chunk_annotations):
+        '''
+        Shift chunk annotations into document coordinates and drop duplicates found by overlapping chunks, keeping the longest of overlapping annotations with the same cui
+        chunk_annotations: list of (offset in document, list of annotation dictionaries) tuples
+        '''
+        annotations = []
+        for offset, chunk_anns in chunk_annotations:
+            for ann in chunk_anns:
+                ann = dict(ann)
+                ann["start"] += offset
+                ann["end"] += offset
+                annotations.append(ann)
+
+        annotations.sort(key=lambda ann: (ann["start"], ann["start"] - ann["end"]))
+
+        merged = []
+        #end offset of the last kept annotation for each cui
+        last_end_by_cui = {}
+        for ann in annotations:
+            if ann["start"] < last_end_by_cui.get(ann["cui"], -1):
+                continue
+            last_end_by_cui[ann["cui"]] = ann["end"]
+            ann["id"] = len(merged)
+            merged.append(ann)
+
+        return merged
@@ -3,10 +3,6 @@ from datetime import datetime
 import pandas as pd
 import logging
 import psutil
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.style.use('ggplot')
-from plotnine import ggplot, aes, geom_point, geom_pointrange, geom_hline, coord_flip, xlab, ylab, theme_bw, facet_grid, geom_text
 
 current_time = datetime.now().strftime("%H:%M:%S")
 logging_filename = "annotation" + current_time + ".log"
@@ -33,10 +29,12 @@ analyzer = al.Analyzer()
 search_term = "atrial fibrillation"
 es_index_name = "ads_letters"
 batch_size = 10000
-cohort = builder.build_cohort(search_term, es_index_name, batch_size, trust_site = "UCLH")
+cohort = builder.build_cohort(search_term, es_index_name, batch_size, use_cache = True, trust_site = "UCLH")
 
 #annotate cohort
 annotated_cohort = annotator.annotate_cohort(cohort, config.Config().es_config["non_es_demographics_path"])
+#retry documents that timed out or failed with smaller chunks and a longer timeout
+annotated_cohort = annotator.retry_quarantined(cohort, config.Config().es_config["non_es_demographics_path"], annotated_cohort)
 print("Final cohort length:", len(annotated_cohort))
 
 memory_post_annotation = psutil.virtual_memory().available / (1024.0 ** 3)
@@ -51,6 +49,11 @@ print("Scored cohort shape", scores.shape)
 med_scores = risk_scorer.generate_medication_flags(annotated_cohort, scores, config.Config().codelists_config["meds_path"])
 print("Medications added to cohort shape", med_scores.shape)
 
+#write annotations and scores back to ES for downstream dashboards
+if config.Config().output_config["results_index"] is not None:
+    import pipeline.result_sink as sink
+    sink.ResultSink().write_results(annotated_cohort, med_scores)
+
 #prep for analysis
 cols_to_binary = config.Config().codelists_config["chadsvasc_components_2pts"] + config.Config().codelists_config["medications"]
 cohort_df = analyzer.add_medication_categories(analyzer.convert_counts_to_binary_flags(med_scores, cols_to_binary))
@@ -69,6 +72,14 @@ print("Cohort summary", cohort_summary)
 med_scores_gtech2 = med_scores[med_scores["total_chadsvasc"]>=2]
 print("Cohort CHA2DS2-VASc >=2 shape", med_scores_gtech2.shape)
 
+#plotting libraries are only imported once the analysis stage is reached
+import_start = time.time()
+import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.style.use('ggplot')
+from plotnine import ggplot, aes, geom_point, geom_pointrange, geom_hline, coord_flip, xlab, ylab, theme_bw, facet_grid, geom_text
+print("Imported plotting libraries in %s seconds" % round(time.time() - import_start, 2))
+
 #create prescribing trends plot and save
 print("Create and save prescribing trends plot")
 drug_categories = ["ac_only", "ac_and_ap", "ap_only", "no_at"]
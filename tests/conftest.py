@@ -0,0 +1,84 @@
+import pandas as pd
+import pytest
+import pipeline.config as config
+
+@pytest.fixture
+def codelist_path(tmp_path):
+    '''
+    Small codelist csv in the risk score definition format
+    '''
+    codelist = pd.DataFrame({"score": ["chadsvasc", "chadsvasc", "chadsvasc", "chadsvasc"],
+                             "component": ["hypertension", "congestive_heart_failure", "congestive_heart_failure", "diabetes"],
+                             "cui": ["S-38341003", "S-42343007", "S-84114007", "S-44054006"],
+                             "term": ["Hypertension (disorder)", "Congestive heart failure (disorder)", "Heart failure (disorder)", "Type 2 diabetes mellitus (disorder)"],
+                             "points": [1, 1, 1, 1]})
+    path = str(tmp_path / "codelist.csv")
+    codelist.to_csv(path)
+    return path
+
+@pytest.fixture
+def test_config(tmp_path, codelist_path, monkeypatch):
+    '''
+    Config with the codelists, caches and output files pointed at a temporary directory
+    '''
+    class TestConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.es_config["demographics_lookup_path"] = None
+            self.medcat_config["annotation_cache_path"] = None
+            self.medcat_config["quarantine_filepath"] = str(tmp_path / "quarantine.jsonl")
+            self.medcat_config["spill_dir"] = str(tmp_path / "spill")
+            self.codelists_config["chadsvasc_path"] = codelist_path
+            self.codelists_config["hasbled_path"] = codelist_path
+            self.codelists_config["meds_path"] = codelist_path
+            self.output_config["annotation_metrics_filepath"] = str(tmp_path / "annotation_metrics.json")
+            self.output_config["annotation_metrics_prom_filepath"] = str(tmp_path / "annotation_metrics.prom")
+            self.output_config["slowest_docs_filepath"] = str(tmp_path / "slowest_docs.csv")
+
+    monkeypatch.setattr(config, "Config", TestConfig)
+    return TestConfig()
+
+@pytest.fixture
+def metadata_csv_file(tmp_path):
+    '''
+    Demographics csv for the patients of the cohort fixture, all adults
+    '''
+    path = str(tmp_path / "demographics.csv")
+    pd.DataFrame({"primary_mrn": ["p%s" % i for i in range(1, 6)],
+                  "date_of_birth": ["1950-01-01", "1955-02-01", "1960-03-01", "1965-04-01", "1970-05-01"],
+                  "gender": ["Female", "Male", "Female", "Male", "Female"]}).to_csv(path, index=False)
+    return path
+
+@pytest.fixture
+def cohort():
+    '''
+    Cohort of five notes in the cohort builder output format, matched by the codelist fixture terms
+    '''
+    return pd.DataFrame({"clinicalnotekey": ["n1", "n2", "n3", "n4", "n5"],
+                         "patientprimarymrn": ["p1", "p2", "p3", "p4", "p5"],
+                         "encounterdate": ["2015-03-01", "2015-06-01", "2016-01-01", "2016-07-01", "2017-02-01"],
+                         "notetext": ["Hypertension.", "No heart failure.", "Type 2 diabetes mellitus and hypertension.", "Congestive heart failure.", "Nothing of note."]})
+
+class FakeConnector:
+    '''
+    Stands in for the shared ElasticConnector, calling the given client without retries
+    '''
+    def __init__(self, es):
+        self.es = es
+
+    def call_with_backoff(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+@pytest.fixture
+def make_cohort_builder(test_config, monkeypatch):
+    '''
+    Return a function creating a CohortBuilder connected to the given fake ES client
+    '''
+    import pipeline.esconn as esconn
+    from pipeline.cohort_builder import CohortBuilder
+
+    def make(es):
+        monkeypatch.setattr(esconn, "get_connector", lambda: FakeConnector(es))
+        return CohortBuilder()
+
+    return make
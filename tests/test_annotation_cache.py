@@ -0,0 +1,94 @@
+import os
+import pytest
+import pipeline.config as config
+from pipeline.annotator import Annotator
+from pipeline.annotation_cache import AnnotationCache
+
+@pytest.fixture
+def cache_config(test_config, tmp_path, monkeypatch):
+    '''
+    Test config with the annotation cache enabled
+    '''
+    class CacheConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.medcat_config["annotation_cache_path"] = str(tmp_path / "annotation_cache.sqlite")
+    monkeypatch.setattr(config, "Config", CacheConfig)
+    return CacheConfig()
+
+def record_annotated_note_ids(annotator):
+    '''
+    Record the notes an annotator sends to its annotation model
+    '''
+    annotated_note_ids = []
+    add_annotations = annotator.add_annotations
+    def recording_add_annotations(doc):
+        annotated_note_ids.append(doc["clinicalnotekey"])
+        return add_annotations(doc)
+    annotator.add_annotations = recording_add_annotations
+    return annotated_note_ids
+
+def get_annotations(annotated_cohort):
+    return [(doc["doc_metadata"]["note_id"], [ann["cui"] for ann in doc["annotations"]]) for doc in annotated_cohort]
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_cache_hits_keep_cohort_order(cache_config, cohort, metadata_csv_file, n_workers):
+    expected = get_annotations(Annotator("Dictionary").annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False))
+
+    Annotator("Dictionary").annotate_cohort(cohort.iloc[[0, 2, 4]], metadata_csv_file, n_workers=1)
+
+    annotator = Annotator("Dictionary")
+    annotated_note_ids = record_annotated_note_ids(annotator)
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=n_workers)
+
+    #hits for n1, n3 and n5 are interleaved with the annotated misses in cohort order
+    assert get_annotations(annotated_cohort) == expected
+    if n_workers == 1:
+        assert annotated_note_ids == ["n2", "n4"]
+
+def test_cache_is_reused_until_the_model_changes(cache_config, cohort, metadata_csv_file, codelist_path):
+    Annotator("Dictionary").annotate_cohort(cohort, metadata_csv_file, n_workers=1)
+
+    annotator = Annotator("Dictionary")
+    annotated_note_ids = record_annotated_note_ids(annotator)
+    annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1)
+    assert annotated_note_ids == []
+
+    #a modified codelist changes the fingerprint, so every note is annotated again
+    stat = os.stat(codelist_path)
+    os.utime(codelist_path, (stat.st_atime, stat.st_mtime + 10))
+    annotator = Annotator("Dictionary")
+    annotated_note_ids = record_annotated_note_ids(annotator)
+    annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1)
+    assert annotated_note_ids == ["n1", "n2", "n3", "n4", "n5"]
+
+def test_fingerprint_changes_with_annotation_settings(cache_config, monkeypatch):
+    fingerprint = Annotator("Dictionary").get_model_fingerprint()
+    assert Annotator("Dictionary").get_model_fingerprint() == fingerprint
+
+    for section, key, value in [("dictionary_config", "negation_window_words", 2), ("medcat_config", "max_chunk_chars", 20000), ("medcat_config", "paragraph_reuse", True)]:
+        class ChangedConfig(config.Config):
+            def __init__(self):
+                super().__init__()
+                getattr(self, section)[key] = value
+        with monkeypatch.context() as m:
+            m.setattr(config, "Config", ChangedConfig)
+            assert Annotator("Dictionary").get_model_fingerprint() != fingerprint
+
+def test_cache_entries_are_keyed_by_model_fingerprint(tmp_path):
+    db_path = str(tmp_path / "annotation_cache.sqlite")
+    annotations = [{"cui": "S-38341003", "start": 0, "end": 12}]
+
+    annotation_cache = AnnotationCache(db_path, "model_a")
+    annotation_cache.put("Hypertension.", annotations)
+    annotation_cache.close()
+
+    annotation_cache = AnnotationCache(db_path, "model_a")
+    assert annotation_cache.get("Hypertension.") == annotations
+    assert annotation_cache.get("Hypertension!") is None
+    annotation_cache.close()
+
+    annotation_cache = AnnotationCache(db_path, "model_b")
+    assert annotation_cache.get("Hypertension.") is None
+    assert annotation_cache.get_stats() == {"hits": 0, "misses": 1, "hit_rate": 0.0}
+    annotation_cache.close()
@@ -0,0 +1,70 @@
+import json
+import os
+import pipeline.config as config
+from pipeline.annotator import Annotator
+from pipeline.annotation_checkpoint import AnnotationCheckpoint, ShardedAnnotatedCohort
+
+def make_doc_entry(note_id):
+    return {"pat_metadata": {"pat_id": "p" + note_id[1:], "age": 70.0, "female": 1},
+            "doc_metadata": {"note_id": note_id, "encounter_date": "2015-03-01"},
+            "annotations": [{"cui": "S-38341003", "start": 0, "end": 12, "meta_anns": {}}]}
+
+def test_shards_are_flushed_and_listed_in_manifest(tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    checkpoint = AnnotationCheckpoint(checkpoint_dir, flush_every=2)
+    for note_id in ["n1", "n2", "n3"]:
+        checkpoint.append(make_doc_entry(note_id))
+
+    #the third document is still buffered
+    with open(os.path.join(checkpoint_dir, "manifest.json")) as f:
+        assert json.load(f) == {"shards": [{"name": "shard_00000.jsonl", "n_docs": 2}], "n_docs": 2}
+    assert checkpoint.get_completed_note_ids() == {"n1", "n2"}
+
+    checkpoint.flush()
+    assert AnnotationCheckpoint(checkpoint_dir).manifest["n_docs"] == 3
+    assert sorted(os.listdir(checkpoint_dir)) == ["manifest.json", "shard_00000.jsonl", "shard_00001.jsonl"]
+
+def test_shards_missing_from_manifest_are_ignored(tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    checkpoint = AnnotationCheckpoint(checkpoint_dir, flush_every=1)
+    checkpoint.append(make_doc_entry("n1"))
+
+    #a shard written by a run that crashed before updating the manifest
+    with open(os.path.join(checkpoint_dir, "shard_00001.jsonl"), "w") as f:
+        f.write(json.dumps(make_doc_entry("n2")) + "\n")
+
+    annotated_cohort = ShardedAnnotatedCohort(checkpoint_dir)
+    assert len(annotated_cohort) == 1
+    assert [doc["doc_metadata"]["note_id"] for doc in annotated_cohort] == ["n1"]
+
+    #the next shard replaces the unlisted one
+    checkpoint.append(make_doc_entry("n3"))
+    assert [doc["doc_metadata"]["note_id"] for doc in ShardedAnnotatedCohort(checkpoint_dir)] == ["n1", "n3"]
+
+def test_resumed_run_skips_checkpointed_documents(test_config, cohort, metadata_csv_file, tmp_path, monkeypatch):
+    class SmallShardConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.medcat_config["checkpoint_flush_every"] = 2
+    monkeypatch.setattr(config, "Config", SmallShardConfig)
+
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    Annotator("Dictionary").annotate_cohort(cohort.iloc[:3], metadata_csv_file, n_workers=1, use_cache=False, checkpoint_dir=checkpoint_dir)
+
+    annotator = Annotator("Dictionary")
+    annotated_note_ids = []
+    add_annotations = annotator.add_annotations
+    def recording_add_annotations(doc):
+        annotated_note_ids.append(doc["clinicalnotekey"])
+        return add_annotations(doc)
+    annotator.add_annotations = recording_add_annotations
+
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False, checkpoint_dir=checkpoint_dir, resume=True)
+    assert annotated_note_ids == ["n4", "n5"]
+
+    #the checkpointed cohort is read lazily from the shards and can be iterated repeatedly
+    assert isinstance(annotated_cohort, ShardedAnnotatedCohort)
+    assert len(annotated_cohort) == 5
+    assert [doc["doc_metadata"]["note_id"] for doc in annotated_cohort] == ["n1", "n2", "n3", "n4", "n5"]
+    assert [[ann["cui"] for ann in doc["annotations"]] for doc in annotated_cohort][2] == ["S-44054006", "S-38341003"]
+    assert len(annotated_cohort.manifest["shards"]) == 3
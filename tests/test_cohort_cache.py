@@ -0,0 +1,30 @@
+import pandas as pd
+from pipeline.cohort_cache import CohortCache
+
+QUERY = {"size": 10, "query": {"bool": {"must": [{"query_string": {"query": "heart*"}}], "filter": [], "should": [], "must_not": []}}}
+INDEX_STATE = {"doc_count": 5, "max_encounterdate": "2017-02-01"}
+
+def test_key_depends_on_retrieval_mode(make_cohort_builder, tmp_path):
+    builder = make_cohort_builder(None)
+    cohort_cache = CohortCache(str(tmp_path / "cohort_cache"))
+
+    keys = [cohort_cache.get_key(QUERY, "notes", None, INDEX_STATE, None, builder.get_retrieval_settings(streaming, two_phase))
+            for streaming, two_phase in [(False, False), (True, False), (False, True)]]
+    assert len(set(keys)) == 3
+    #streaming takes precedence over two_phase in retrieve_cohort, so the two build the same cohort
+    assert cohort_cache.get_key(QUERY, "notes", None, INDEX_STATE, None, builder.get_retrieval_settings(True, True)) == keys[1]
+
+    #changing the retrieved fields invalidates cached streaming cohorts
+    builder.config.es_config["cohort_source_fields"] = builder.config.es_config["cohort_source_fields"] + ["notetype"]
+    assert cohort_cache.get_key(QUERY, "notes", None, INDEX_STATE, None, builder.get_retrieval_settings(True, False)) != keys[1]
+
+def test_put_get_roundtrip(tmp_path, cohort):
+    cohort_cache = CohortCache(str(tmp_path / "cohort_cache"))
+    key = cohort_cache.get_key(QUERY, "notes", None, INDEX_STATE)
+
+    assert cohort_cache.get(key) is None
+    cohort_cache.put(key, cohort)
+    pd.testing.assert_frame_equal(cohort_cache.get(key), cohort)
+
+    cohort_cache.invalidate(key)
+    assert cohort_cache.get(key) is None
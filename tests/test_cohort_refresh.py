@@ -0,0 +1,57 @@
+import pandas as pd
+
+class FakeCountElasticsearch:
+    '''
+    Counts the documents of an in memory index, honouring the encounterdate range filter of watermark queries
+    '''
+    def __init__(self, docs):
+        self.docs = docs
+
+    def match(self, query):
+        matched = self.docs
+        for clause in query["bool"]["filter"]:
+            matched = [doc for doc in matched if doc["encounterdate"] >= clause["range"]["encounterdate"]["gte"]]
+        return matched
+
+    def count(self, index, body):
+        return {"count": len(self.match(body["query"]))}
+
+def make_doc(note_id, pat_id, encounterdate):
+    return {"clinicalnotekey": note_id, "patientprimarymrn": pat_id, "encounterdate": encounterdate, "notetext": "Hypertension."}
+
+def test_refresh_retrieves_documents_ingested_during_the_last_refresh(make_cohort_builder, tmp_path):
+    es = FakeCountElasticsearch([make_doc("n1", "p1", "2015-03-01"), make_doc("n2", "p2", "2016-01-01")])
+    builder = make_cohort_builder(es)
+
+    retrievals = []
+    ingest_during_retrieval = []
+    def retrieve_cohort(query, index, **kwargs):
+        matched = es.match(query["query"])
+        retrievals.append([doc["clinicalnotekey"] for doc in matched])
+        es.docs.extend(ingest_during_retrieval)
+        del ingest_during_retrieval[:]
+        return builder.select_most_recent_patient_doc(pd.DataFrame(matched))
+    builder.retrieve_cohort = retrieve_cohort
+
+    cohort_path = str(tmp_path / "cohort.parquet")
+    cohort = builder.refresh_cohort("hypertension", cohort_path, index="notes")
+    assert sorted(cohort["clinicalnotekey"]) == ["n1", "n2"]
+
+    #nothing new, the stored cohort is returned without retrieving
+    builder.refresh_cohort("hypertension", cohort_path, index="notes")
+    assert len(retrievals) == 1
+
+    #n4 is ingested while the refresh retrieving n3 runs, it is not retrieved and is not in the saved count
+    es.docs.append(make_doc("n3", "p3", "2016-06-01"))
+    ingest_during_retrieval.append(make_doc("n4", "p4", "2017-01-01"))
+    cohort = builder.refresh_cohort("hypertension", cohort_path, index="notes")
+    assert retrievals[-1] == ["n2", "n3"]
+    assert sorted(cohort["clinicalnotekey"]) == ["n1", "n2", "n3"]
+
+    #so the next refresh retrieves it rather than taking the no new documents shortcut
+    cohort = builder.refresh_cohort("hypertension", cohort_path, index="notes")
+    assert len(retrievals) == 3
+    assert sorted(cohort["clinicalnotekey"]) == ["n1", "n2", "n3", "n4"]
+
+    builder.refresh_cohort("hypertension", cohort_path, index="notes")
+    assert len(retrievals) == 3
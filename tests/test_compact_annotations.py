@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from pipeline.compact_annotations import CompactAnnotations
+from pipeline.risk_scorer import RiskScorer
+
+def make_annotation(cui, negated, start, end):
+    ann = {"cui": cui, "acc": 0.9, "start": start, "end": end, "meta_anns": {}}
+    if negated is not None:
+        ann["meta_anns"]["Negated"] = {"name": "Negated", "value": negated}
+    return ann
+
+ANNOTATED_COHORT = [
+    {"pat_metadata": {"pat_id": "p1", "age": 70.5, "female": 1},
+     "doc_metadata": {"note_id": "n1", "encounter_date": "2015-03-01"},
+     "annotations": [make_annotation("C1", "No", 0, 5), make_annotation("C2", "Yes", 10, 15), make_annotation("C1", "No", 20, 25)]},
+    {"pat_metadata": {"pat_id": "p2", "age": 65.0, "female": 0},
+     "doc_metadata": {"note_id": "n2", "encounter_date": "2016-04-01"},
+     "annotations": []},
+    {"pat_metadata": {"pat_id": "p3", "age": 80.0, "female": 1},
+     "doc_metadata": {"note_id": "n3", "encounter_date": "2017-05-01"},
+     "annotations": [make_annotation("C3", None, 0, 4), make_annotation("C2", "No", 5, 9)]}]
+
+def test_arrays_and_doc_offsets():
+    compact = CompactAnnotations.from_docs(ANNOTATED_COHORT)
+    arrays = compact.get_arrays()
+
+    assert len(compact) == 3
+    assert compact.cui_table == ["C1", "C2", "C3"]
+    assert arrays["doc_idx"].tolist() == [0, 0, 0, 2, 2]
+    assert arrays["negated"].tolist() == [0, 1, 0, -1, 0]
+    assert compact.doc_offsets.tolist() == [0, 3, 3, 5]
+
+def test_iteration_round_trips_documents():
+    assert list(CompactAnnotations.from_docs(ANNOTATED_COHORT, store_detail=True)) == ANNOTATED_COHORT
+
+def test_annotations_without_detail():
+    compact = CompactAnnotations.from_docs(ANNOTATED_COHORT, store_detail=False)
+    annotations = compact.get_annotations(2)
+
+    assert [(ann["cui"], ann["start"], ann["end"]) for ann in annotations] == [("C3", 0, 4), ("C2", 5, 9)]
+    assert annotations[0]["meta_anns"] == {}
+    assert annotations[1]["meta_anns"]["Negated"]["value"] == "No"
+    assert compact.get_annotations(1) == []
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "annotations.npz")
+    CompactAnnotations.from_docs(ANNOTATED_COHORT, store_detail=True).save(path)
+    compact = CompactAnnotations.load(path)
+
+    assert list(compact) == ANNOTATED_COHORT
+    assert compact.get_cui_id("C2") == 1
+
+def test_compact_component_counts_match_list_cohort():
+    risk_scorer = RiskScorer()
+    components = {"component_a", "component_b"}
+    code_to_component = {"C1": "component_a", "C2": "component_b"}
+    codes = set(code_to_component.keys())
+
+    expected = risk_scorer.generate_cohort_by_component_list(ANNOTATED_COHORT, components, codes, code_to_component)
+    actual = risk_scorer.generate_cohort_by_component_list(CompactAnnotations.from_docs(ANNOTATED_COHORT), components, codes, code_to_component)
+
+    assert [doc["components"] for doc in actual] == [doc["components"] for doc in expected]
+    assert actual[0]["components"] == {"component_a": 2, "component_b": 0}
+    assert actual[2]["components"] == {"component_a": 0, "component_b": 1}
+    assert np.isclose(actual[0]["age"], 70.5)
+
+def test_missing_confidence_is_nan():
+    ann = make_annotation("C1", "No", 0, 5)
+    ann["acc"] = None
+    compact = CompactAnnotations.from_docs([{"pat_metadata": {"pat_id": "p1", "age": 70.5, "female": 1},
+                                             "doc_metadata": {"note_id": "n1", "encounter_date": "2015-03-01"},
+                                             "annotations": [ann, make_annotation("C2", "No", 10, 15)]}])
+
+    assert np.isnan(compact.get_arrays()["confidence"][0])
+    assert np.isclose(compact.get_arrays()["confidence"][1], 0.9)
+
+def test_detail_fetched_on_demand():
+    requested = []
+    def load_detail(note_id):
+        requested.append(note_id)
+        return ANNOTATED_COHORT[[doc["doc_metadata"]["note_id"] for doc in ANNOTATED_COHORT].index(note_id)]["annotations"]
+
+    compact = CompactAnnotations.from_docs(ANNOTATED_COHORT)
+    assert compact.details == []
+    with pytest.raises(ValueError):
+        compact.get_detail(0)
+
+    compact = CompactAnnotations.from_docs(ANNOTATED_COHORT, detail_loader=load_detail)
+    assert compact.get_detail(2) == ANNOTATED_COHORT[2]["annotations"]
+    assert requested == ["n3"]
+
+def test_annotate_cohort_compact_detail(test_config, cohort, metadata_csv_file):
+    from pipeline.annotator import Annotator
+
+    annotated_cohort = Annotator("Dictionary").annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False, compact=True)
+
+    assert annotated_cohort.details == []
+    assert [ann["cui"] for ann in annotated_cohort.get_annotations(2)] == ["S-44054006", "S-38341003"]
+    assert [ann["pretty_name"] for ann in annotated_cohort.get_detail(2)] == ["Type 2 diabetes mellitus (disorder)", "Hypertension (disorder)"]
@@ -0,0 +1,63 @@
+import pandas as pd
+from pipeline.dictionary_annotator import AhoCorasick, DictionaryAnnotator
+from pipeline.annotator import Annotator
+
+def build_automaton(patterns):
+    automaton = AhoCorasick()
+    for i, tokens in enumerate(patterns):
+        automaton.add(tokens, i)
+    automaton.build()
+    return automaton
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = build_automaton([("heart", "failure"), ("congestive", "heart", "failure"), ("failure",)])
+    matches = sorted(automaton.iter_matches(["congestive", "heart", "failure", "noted"]))
+    assert matches == [(0, 2, 1), (1, 2, 0), (2, 2, 2)]
+
+def test_aho_corasick_follows_failure_links():
+    automaton = build_automaton([("a", "b", "c"), ("b", "d")])
+    assert list(automaton.iter_matches(["a", "b", "d"])) == [(1, 2, 1)]
+    assert list(automaton.iter_matches(["x", "y"])) == []
+
+def test_get_entities_matches_longest_term(codelist_path):
+    annotator = DictionaryAnnotator([codelist_path])
+    text = "Known congestive heart failure and hypertension."
+    entities = annotator.get_entities(text)
+
+    assert [entity["cui"] for entity in entities] == ["S-42343007", "S-38341003"]
+    assert [text[entity["start"]:entity["end"]] for entity in entities] == ["congestive heart failure", "hypertension"]
+    assert entities[0]["pretty_name"] == "Congestive heart failure (disorder)"
+
+def test_negation_window(codelist_path):
+    annotator = DictionaryAnnotator([codelist_path], negation_window_words=3)
+
+    def negated(text):
+        return [entity["meta_anns"]["Negated"]["value"] for entity in annotator.get_entities(text)]
+
+    assert negated("Patient denies hypertension") == ["Yes"]
+    assert negated("Heart failure was ruled out") == ["Yes"]
+    assert negated("History of hypertension") == ["No"]
+    #triggers outside the window or beyond a sentence / scope terminator do not negate
+    assert negated("No chest pain today at rest, hypertension") == ["No"]
+    assert negated("No chest pain. Hypertension") == ["No"]
+    assert negated("No fever but hypertension") == ["No"]
+
+def test_annotate_cohort_dictionary_mode(test_config, tmp_path):
+    metadata_csv_file = str(tmp_path / "demographics.csv")
+    pd.DataFrame({"primary_mrn": ["p1", "p2", "p3"],
+                  "date_of_birth": ["1950-01-01", "1960-06-15", "2015-01-01"],
+                  "gender": ["Female", "Male", "Female"]}).to_csv(metadata_csv_file, index=False)
+
+    cohort = pd.DataFrame({"clinicalnotekey": ["n1", "n2", "n3"],
+                           "patientprimarymrn": ["p1", "p2", "p3"],
+                           "encounterdate": ["2015-03-01", "2016-04-01", "2017-05-01"],
+                           "notetext": ["Type 2 diabetes mellitus. No heart failure.", "Hypertension", "Hypertension"]})
+
+    annotator = Annotator("Dictionary")
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False)
+
+    #p3 is under 18 and filtered out before annotation
+    assert [doc["doc_metadata"]["note_id"] for doc in annotated_cohort] == ["n1", "n2"]
+    assert annotated_cohort[0]["pat_metadata"]["female"] == 1
+    assert [(ann["cui"], ann["meta_anns"]["Negated"]["value"]) for ann in annotated_cohort[0]["annotations"]] == [("S-44054006", "No"), ("S-84114007", "Yes")]
+    assert [ann["cui"] for ann in annotated_cohort[1]["annotations"]] == ["S-38341003"]
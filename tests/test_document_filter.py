@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+from pipeline.document_filter import DocumentFilter
+
+RULES = [{"name": "invalid_stroke_ds", "type": "prefix", "text": "Please", "length": 7},
+         {"name": "invalid_cc_ds", "type": "substring", "text": "Critical Care Discharge Summary", "es_pushdown": True},
+         {"name": "invalid_test_note", "type": "regex", "pattern": r"^TEST\b"}]
+
+def test_flag_invalid_docs():
+    cohort = pd.DataFrame({"notetext": ["Please see attached", "UCH Critical Care Discharge Summary", "TEST note", "Patient has AF", None]})
+    cohort = DocumentFilter(RULES).flag_invalid_docs(cohort)
+
+    assert cohort["invalid_stroke_ds"].tolist() == [True, False, False, False, False]
+    assert cohort["invalid_cc_ds"].tolist() == [False, True, False, False, False]
+    assert cohort["invalid_test_note"].tolist() == [False, False, True, False, False]
+    assert cohort["keep_doc"].tolist() == [False, False, False, True, True]
+
+def test_flag_invalid_docs_with_script_fields():
+    rules = RULES[:2]
+    cohort = pd.DataFrame({"notetext_prefix": ["Please ", "Discharge"], "invalid_cc_ds": [None, True]})
+    cohort = DocumentFilter(rules).flag_invalid_docs(cohort, text_col="notetext_prefix", use_script_fields=True)
+
+    assert cohort["keep_doc"].tolist() == [False, False]
+
+def test_es_pushdown_clauses():
+    document_filter = DocumentFilter(RULES)
+    assert document_filter.get_es_must_not_clauses() == [{"match_phrase": {"notetext": "Critical Care Discharge Summary"}}]
+    assert document_filter.get_prefix_length() == 7
+
+def test_invalid_rules_are_rejected():
+    with pytest.raises(ValueError):
+        DocumentFilter([{"name": "bad", "type": "suffix", "text": "x"}])
+    with pytest.raises(ValueError):
+        DocumentFilter([{"name": "bad", "type": "prefix", "text": "x", "length": 1, "es_pushdown": True}]).get_es_must_not_clauses()
+    with pytest.raises(ValueError):
+        DocumentFilter(RULES).get_script_fields()
+
+def test_from_config_without_rules():
+    assert DocumentFilter.from_config("unknown trust").get_rule_names() == []
+
+def test_text_rules_match_rule_by_rule_evaluation():
+    rules = RULES + [{"name": "grouped", "type": "regex", "pattern": r"(?:ab){2}"},
+                     {"name": "inline_flags", "type": "regex", "pattern": r"(?i)draft"}]
+    notetext = ["abab", "DRAFT letter", "ab", "TEST Critical Care Discharge Summary", None]
+    flags = DocumentFilter(rules).flag_text_rules(pd.Series(notetext))
+
+    assert sorted(flags.keys()) == ["grouped", "inline_flags", "invalid_cc_ds", "invalid_test_note"]
+    assert flags["grouped"].tolist() == [True, False, False, False, False]
+    assert flags["inline_flags"].tolist() == [False, True, False, False, False]
+    assert flags["invalid_cc_ds"].tolist() == [False, False, False, True, False]
+    assert flags["invalid_test_note"].tolist() == [False, False, False, True, False]
+
+def test_overlapping_rules_are_all_flagged():
+    rules = [{"name": "cc_ds", "type": "substring", "text": "Critical Care Discharge Summary"},
+             {"name": "care_discharge", "type": "substring", "text": "Care Discharge"},
+             {"name": "summary_end", "type": "regex", "pattern": r"Summary$"}]
+    notetext = ["UCH Critical Care Discharge Summary", "Care Discharge planned", "Critical Care Discharge Summary follows", None]
+    cohort = DocumentFilter(rules).flag_invalid_docs(pd.DataFrame({"notetext": notetext}, index=[10, 11, 12, 13]))
+
+    assert cohort["cc_ds"].tolist() == [True, False, True, False]
+    assert cohort["care_discharge"].tolist() == [True, True, True, False]
+    assert cohort["summary_end"].tolist() == [True, False, False, False]
+    for rule in rules:
+        expected = DocumentFilter(rules).flag_rule(rule, pd.Series(notetext)).tolist()
+        assert cohort[rule["name"]].tolist() == expected
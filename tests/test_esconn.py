@@ -0,0 +1,44 @@
+from pipeline.esconn import ElasticIndexer
+from conftest import FakeConnector
+
+class FakePitElasticsearch:
+    '''
+    Pages through the ids of an in memory index with point in time search_after requests, rotating the point in time id per response
+    '''
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self.open_pits = set()
+        self.n_pits = 0
+
+    def open_point_in_time(self, index, keep_alive):
+        self.n_pits += 1
+        pit_id = "pit_%s" % self.n_pits
+        self.open_pits.add(pit_id)
+        return {"id": pit_id}
+
+    def search(self, body):
+        assert body["pit"]["id"] in self.open_pits and body["sort"] == [{"_shard_doc": "asc"}]
+        #the point in time id can change between responses, the latest one must be used for the next page
+        self.open_pits.remove(body["pit"]["id"])
+        self.n_pits += 1
+        pit_id = "pit_%s" % self.n_pits
+        self.open_pits.add(pit_id)
+
+        start = body.get("search_after", [-1])[0] + 1
+        hits = [{"_id": doc_id, "sort": [position]} for position, doc_id in enumerate(self.doc_ids)][start:start + body["size"]]
+        return {"pit_id": pit_id, "hits": {"hits": hits}}
+
+    def close_point_in_time(self, body):
+        self.open_pits.remove(body["id"])
+
+def test_iter_doc_ids_pages_through_point_in_time():
+    es = FakePitElasticsearch(["d%s" % i for i in range(7)])
+    indexer = ElasticIndexer(FakeConnector(es), "notes")
+
+    doc_ids = indexer.iter_doc_ids(page_size=3)
+    assert next(doc_ids) == "d0"
+    assert list(doc_ids) == ["d%s" % i for i in range(1, 7)]
+    assert es.open_pits == set()
+
+    assert indexer.get_doc_ids(page_size=7) == ["d%s" % i for i in range(7)]
+    assert es.open_pits == set()
@@ -0,0 +1,67 @@
+import pandas as pd
+import pytest
+import pipeline.config as config
+from pipeline.annotator import Annotator
+from pipeline.paragraph_cache import ParagraphCache, split_paragraphs
+
+TEMPLATE = "Discharge advice: return if heart failure symptoms worsen."
+
+@pytest.fixture
+def templated_cohort():
+    '''
+    Cohort of notes sharing a boilerplate paragraph at different offsets
+    '''
+    return pd.DataFrame({"clinicalnotekey": ["n1", "n2", "n3"],
+                         "patientprimarymrn": ["p1", "p2", "p3"],
+                         "encounterdate": ["2015-03-01", "2015-06-01", "2016-01-01"],
+                         "notetext": ["Hypertension.\n\n" + TEMPLATE,
+                                      "Type 2 diabetes mellitus and hypertension.\n \n" + TEMPLATE,
+                                      TEMPLATE + "\n\nHypertension."]})
+
+def test_split_paragraphs():
+    text = "First line\nsame paragraph\n\n  \n\nSecond\n \t\nThird\n\n"
+    paragraphs = split_paragraphs(text)
+
+    assert [paragraph for _, paragraph in paragraphs] == ["First line\nsame paragraph", "Second", "Third"]
+    assert all([text[offset:offset + len(paragraph)] == paragraph for offset, paragraph in paragraphs])
+    assert split_paragraphs(" \n\n ") == []
+
+def test_paragraph_cache_evicts_least_recently_used():
+    paragraph_cache = ParagraphCache(max_paragraphs=2)
+    paragraph_cache.put("a", [1])
+    paragraph_cache.put("b", [2])
+    assert paragraph_cache.get("a") == [1]
+    paragraph_cache.put("c", [3])
+
+    assert paragraph_cache.get("b") is None
+    assert paragraph_cache.get("a") == [1]
+    assert paragraph_cache.get_stats() == {"hits": 2, "misses": 1, "hit_chars": 2, "miss_chars": 1}
+    assert ParagraphCache.get_reuse_rates(paragraph_cache.get_stats())["paragraph_reuse_rate"] == 2 / 3
+
+def test_repeated_paragraphs_are_annotated_once(test_config, templated_cohort, metadata_csv_file, monkeypatch):
+    class ParagraphReuseConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.medcat_config["paragraph_reuse"] = True
+    monkeypatch.setattr(config, "Config", ParagraphReuseConfig)
+
+    annotator = Annotator("Dictionary")
+    annotated_texts = []
+    annotate_text = annotator.annotate_text
+    def recording_annotate_text(text):
+        annotated_texts.append(text)
+        return annotate_text(text)
+    annotator.annotate_text = recording_annotate_text
+
+    annotated_cohort = annotator.annotate_cohort(templated_cohort, metadata_csv_file, n_workers=1, use_cache=False)
+
+    assert annotated_texts.count(TEMPLATE) == 1
+    assert annotated_texts.count("Hypertension.") == 1
+    assert annotator.get_paragraph_stats()["hits"] == 3
+
+    #reused annotations are shifted to the offsets of each note, and the cached copy is left unchanged
+    for doc, notetext in zip(annotated_cohort, templated_cohort["notetext"]):
+        assert [notetext[ann["start"]:ann["end"]] for ann in doc["annotations"]] == [ann["source_value"] for ann in doc["annotations"]]
+    assert [ann["cui"] for ann in annotated_cohort[0]["annotations"]] == ["S-38341003", "S-84114007"]
+    assert [ann["cui"] for ann in annotated_cohort[1]["annotations"]] == ["S-44054006", "S-38341003", "S-84114007"]
+    assert [ann["cui"] for ann in annotated_cohort[2]["annotations"]] == ["S-84114007", "S-38341003"]
@@ -0,0 +1,127 @@
+import pytest
+import pipeline.config as config
+from elasticsearch import NotFoundError
+
+class FakePitElasticsearch:
+    '''
+    Serves an in memory index through point in time searches sorted on clinicalnotekey or _shard_doc. expire_pits simulates points in time timing out
+    '''
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda doc: doc["clinicalnotekey"])
+        self.open_pits = set()
+        self.n_pits_opened = 0
+        self.n_searches = 0
+
+    def open_point_in_time(self, index, keep_alive):
+        self.n_pits_opened += 1
+        pit_id = "pit_%s" % self.n_pits_opened
+        self.open_pits.add(pit_id)
+        return {"id": pit_id}
+
+    def expire_pits(self):
+        self.open_pits = set()
+
+    def search(self, body):
+        self.n_searches += 1
+        if body["pit"]["id"] not in self.open_pits:
+            raise NotFoundError(404, "search_phase_execution_exception", {})
+
+        field = list(body["sort"][0].keys())[0]
+        hits = [{"_id": doc["clinicalnotekey"], "_source": doc, "sort": [doc["clinicalnotekey"] if field == "clinicalnotekey" else position]}
+                for position, doc in enumerate(self.docs)]
+        if "search_after" in body:
+            hits = [hit for hit in hits if hit["sort"] > body["search_after"]]
+        return {"pit_id": body["pit"]["id"], "hits": {"hits": hits[:body["size"]]}}
+
+    def close_point_in_time(self, body):
+        self.open_pits.discard(body["id"])
+
+class RetrievalInterrupted(Exception):
+    pass
+
+def make_docs(n):
+    return [{"clinicalnotekey": "n%s" % i, "patientprimarymrn": "p%s" % i, "encounterdate": "2015-03-01", "notetext": "Hypertension."} for i in range(n)]
+
+def interrupt_after_pages(builder, n_pages):
+    '''
+    Make the builder fail after writing n_pages pages of hits, before the checkpoint for the last one is saved
+    '''
+    save_pit_checkpoint = builder.save_pit_checkpoint
+    saved = []
+    def interrupted_save_pit_checkpoint(checkpoint_dir, checkpoint):
+        if len(saved) == n_pages - 1:
+            raise RetrievalInterrupted()
+        saved.append(checkpoint["n_hits"])
+        save_pit_checkpoint(checkpoint_dir, checkpoint)
+    builder.save_pit_checkpoint = interrupted_save_pit_checkpoint
+
+def get_note_ids(es_response):
+    return [hit["_source"]["clinicalnotekey"] for hit in es_response]
+
+def test_interrupted_retrieval_resumes_from_checkpoint(make_cohort_builder, tmp_path):
+    es = FakePitElasticsearch(make_docs(7))
+    query = {"size": 2, "query": {"match_all": {}}}
+    checkpoint_dir = str(tmp_path / "pit")
+
+    builder = make_cohort_builder(es)
+    interrupt_after_pages(builder, 3)
+    with pytest.raises(RetrievalInterrupted):
+        builder.query_es_pit(query, "notes", checkpoint_dir)
+
+    #the third page was written to hits.jsonl but not checkpointed, it is dropped and retrieved again
+    n_searches = es.n_searches
+    es_response = make_cohort_builder(es).query_es_pit(query, "notes", checkpoint_dir)
+    assert get_note_ids(es_response) == ["n%s" % i for i in range(7)]
+    assert es.n_searches - n_searches == 3
+    assert es.n_pits_opened == 1
+    assert es.open_pits == set()
+
+def test_expired_point_in_time_resumes_with_unique_sort(make_cohort_builder, tmp_path):
+    es = FakePitElasticsearch(make_docs(7))
+    query = {"size": 2, "query": {"match_all": {}}}
+    checkpoint_dir = str(tmp_path / "pit")
+
+    builder = make_cohort_builder(es)
+    interrupt_after_pages(builder, 3)
+    with pytest.raises(RetrievalInterrupted):
+        builder.query_es_pit(query, "notes", checkpoint_dir)
+    es.expire_pits()
+
+    es_response = make_cohort_builder(es).query_es_pit(query, "notes", checkpoint_dir)
+    assert get_note_ids(es_response) == ["n%s" % i for i in range(7)]
+    assert es.n_pits_opened == 2
+
+def test_expired_point_in_time_restarts_with_shard_doc_sort(make_cohort_builder, tmp_path, monkeypatch):
+    class ShardDocConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.es_config["pit_sort"] = [{"_shard_doc": "asc"}]
+    monkeypatch.setattr(config, "Config", ShardDocConfig)
+
+    es = FakePitElasticsearch(make_docs(7))
+    query = {"size": 2, "query": {"match_all": {}}}
+    checkpoint_dir = str(tmp_path / "pit")
+
+    builder = make_cohort_builder(es)
+    interrupt_after_pages(builder, 3)
+    with pytest.raises(RetrievalInterrupted):
+        builder.query_es_pit(query, "notes", checkpoint_dir)
+    es.expire_pits()
+
+    #the _shard_doc cursor is not valid in the new point in time, so every document is retrieved again without duplicates
+    n_searches = es.n_searches
+    es_response = make_cohort_builder(es).query_es_pit(query, "notes", checkpoint_dir)
+    assert get_note_ids(es_response) == ["n%s" % i for i in range(7)]
+    assert es.n_searches - n_searches == 1 + 5
+
+def test_checkpoint_for_another_query_is_rejected(make_cohort_builder, tmp_path):
+    es = FakePitElasticsearch(make_docs(3))
+    checkpoint_dir = str(tmp_path / "pit")
+
+    builder = make_cohort_builder(es)
+    interrupt_after_pages(builder, 2)
+    with pytest.raises(RetrievalInterrupted):
+        builder.query_es_pit({"size": 2, "query": {"match_all": {}}}, "notes", checkpoint_dir)
+
+    with pytest.raises(ValueError):
+        builder.query_es_pit({"size": 2, "query": {"match_all": {}}}, "other_notes", checkpoint_dir)
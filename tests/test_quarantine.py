@@ -0,0 +1,104 @@
+import time
+import os
+import pytest
+import pipeline.config as config
+import pipeline.annotator as annotator_module
+from pipeline.annotator import Annotator
+from pipeline.quarantine import AnnotationQuarantine, AnnotationTimeout, call_with_timeout, call_without_timeout
+
+def fail_on(annotator, note_ids):
+    '''
+    Make an annotator fail on the given notes
+    '''
+    annotate_doc_text = annotator.annotate_doc_text
+    def failing_annotate_doc_text(doc):
+        if doc["clinicalnotekey"] in note_ids:
+            raise RuntimeError("model failure")
+        return annotate_doc_text(doc)
+    annotator.annotate_doc_text = failing_annotate_doc_text
+
+def get_note_ids(annotated_cohort):
+    return sorted([doc["doc_metadata"]["note_id"] for doc in annotated_cohort])
+
+def test_call_with_timeout():
+    with pytest.raises(AnnotationTimeout):
+        call_with_timeout(time.sleep, 0.05, 1)
+    assert call_with_timeout(sum, 1, [1, 2]) == 3
+
+def test_call_without_timeout_defers_the_timeout():
+    events = []
+    def timed():
+        call_without_timeout(time.sleep, 0.2)
+        events.append("after deferred call")
+        time.sleep(1)
+
+    with pytest.raises(AnnotationTimeout):
+        call_with_timeout(timed, 0.05)
+    assert events == []
+
+def test_failed_documents_are_quarantined_and_retried(test_config, cohort, metadata_csv_file):
+    annotator = Annotator("Dictionary")
+    fail_on(annotator, ["n2"])
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False)
+
+    entries = AnnotationQuarantine(test_config.medcat_config["quarantine_filepath"]).load()
+    assert list(entries.keys()) == ["n2"]
+    assert "model failure" in entries["n2"]["reason"]
+    assert get_note_ids(annotated_cohort) == ["n1", "n3", "n4", "n5"]
+
+    annotated_cohort = Annotator("Dictionary").retry_quarantined(cohort, metadata_csv_file, annotated_cohort)
+    assert get_note_ids(annotated_cohort) == ["n1", "n2", "n3", "n4", "n5"]
+    assert AnnotationQuarantine(test_config.medcat_config["quarantine_filepath"]).load() == {}
+
+def test_resumed_run_removes_recovered_documents_from_quarantine(test_config, cohort, metadata_csv_file, tmp_path):
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    annotator = Annotator("Dictionary")
+    fail_on(annotator, ["n1"])
+    annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False, checkpoint_dir=checkpoint_dir)
+
+    annotator = Annotator("Dictionary")
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False, checkpoint_dir=checkpoint_dir, resume=True)
+    assert AnnotationQuarantine(test_config.medcat_config["quarantine_filepath"]).load() == {}
+
+    annotated_cohort = annotator.retry_quarantined(cohort, metadata_csv_file, annotated_cohort)
+    assert get_note_ids(annotated_cohort) == ["n1", "n2", "n3", "n4", "n5"]
+
+def test_retry_skips_documents_already_annotated(test_config, cohort, metadata_csv_file):
+    annotated_cohort = Annotator("Dictionary").annotate_cohort(cohort, metadata_csv_file, n_workers=1, use_cache=False)
+    quarantine = AnnotationQuarantine(test_config.medcat_config["quarantine_filepath"])
+    quarantine.add("n3", "stale entry", 10)
+
+    annotated_cohort = Annotator("Dictionary").retry_quarantined(cohort, metadata_csv_file, annotated_cohort)
+    assert get_note_ids(annotated_cohort) == ["n1", "n2", "n3", "n4", "n5"]
+    assert quarantine.load() == {}
+
+annotate_batch = annotator_module.annotate_batch
+
+def dying_annotate_batch(batch):
+    '''
+    annotate_batch that kills its worker process on note n2, as an out of memory kill or segfault would
+    '''
+    if "n2" in [doc["clinicalnotekey"] for doc in batch]:
+        os._exit(1)
+    return annotate_batch(batch)
+
+def test_dead_worker_quarantines_its_batch_and_restarts_the_pool(test_config, cohort, metadata_csv_file, monkeypatch):
+    class SingleDocBatchConfig(config.Config):
+        def __init__(self):
+            super().__init__()
+            self.medcat_config["annotation_batch_size"] = 1
+            self.medcat_config["min_annotation_batch_size"] = 1
+            self.medcat_config["max_annotation_batch_size"] = 1
+    monkeypatch.setattr(config, "Config", SingleDocBatchConfig)
+    monkeypatch.setattr(annotator_module, "annotate_batch", dying_annotate_batch)
+
+    annotator = Annotator("Dictionary")
+    annotated_cohort = annotator.annotate_cohort(cohort, metadata_csv_file, n_workers=2, use_cache=False)
+
+    #batches in flight when the worker died may be quarantined with it, every document is either annotated or quarantined
+    entries = AnnotationQuarantine(test_config.medcat_config["quarantine_filepath"]).load()
+    assert "BrokenProcessPool" in entries["n2"]["reason"]
+    assert sorted(get_note_ids(annotated_cohort) + list(entries.keys())) == ["n1", "n2", "n3", "n4", "n5"]
+
+    annotated_cohort = annotator.retry_quarantined(cohort, metadata_csv_file, annotated_cohort)
+    assert get_note_ids(annotated_cohort) == ["n1", "n2", "n3", "n4", "n5"]
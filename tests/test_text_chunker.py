@@ -0,0 +1,42 @@
+from pipeline.text_chunker import TextChunker
+
+def test_short_text_is_not_chunked():
+    chunker = TextChunker(100)
+    assert not chunker.needs_chunking("a" * 100)
+    assert chunker.split("short note") == [(0, "short note")]
+
+def test_none_disables_chunking():
+    chunker = TextChunker(None)
+    assert not chunker.needs_chunking("a" * 100000)
+    assert chunker.split("a" * 100000) == [(0, "a" * 100000)]
+
+def test_split_prefers_paragraph_boundaries():
+    text = "a" * 60 + "\n\n" + "b" * 30 + "\n" + "c" * 60
+    chunks = TextChunker(100).split(text)
+
+    assert chunks[0] == (0, "a" * 60 + "\n\n")
+    #chunks split on boundaries do not overlap and cover the whole text
+    assert "".join([chunk for offset, chunk in chunks]) == text
+    for offset, chunk in chunks:
+        assert text[offset:offset + len(chunk)] == chunk
+        assert len(chunk) <= 100
+
+def test_split_without_boundary_overlaps():
+    text = "x" * 250
+    chunker = TextChunker(100, overlap_chars=10)
+    chunks = chunker.split(text)
+
+    assert [offset for offset, chunk in chunks] == [0, 90, 180]
+    assert chunks[-1][0] + len(chunks[-1][1]) == len(text)
+
+def test_merge_shifts_offsets_and_drops_overlap_duplicates():
+    chunker = TextChunker(100, overlap_chars=10)
+    merged = chunker.merge([(0, [{"cui": "C1", "start": 92, "end": 98, "id": 0}]),
+                            (90, [{"cui": "C1", "start": 2, "end": 8, "id": 0}, {"cui": "C2", "start": 20, "end": 25, "id": 1}])])
+
+    assert [(ann["cui"], ann["start"], ann["end"], ann["id"]) for ann in merged] == [("C1", 92, 98, 0), ("C2", 110, 115, 1)]
+
+def test_merge_does_not_modify_input():
+    chunk_anns = [{"cui": "C1", "start": 0, "end": 4, "id": 0}]
+    TextChunker(100).merge([(50, chunk_anns)])
+    assert chunk_anns[0]["start"] == 0